@@ -7,6 +7,8 @@ from bika.lims.permissions import *
 from bika.lims.utils import to_utf8 as _c
 from bika.lims.utils import to_unicode as _u
 from bika.lims.interfaces import IReferenceWidgetVocabulary
+from bika.lims.utils.typeahead import SEARCH_LIMIT
+from bika.lims.utils.typeahead import typeahead_search
 from Products.CMFCore.utils import getToolByName
 from zope.interface import implements
 import json
@@ -33,11 +35,40 @@ class DefaultReferenceWidgetVocabulary(object):
         # first with all queries
         contentFilter = dict((k, v) for k, v in base_query.items())
         contentFilter.update(search_query)
+        limit = int(self.request.get('limit', SEARCH_LIMIT))
+        brains = self.search(catalog, contentFilter, searchTerm,
+                             searchFields, limit)
+        # Then just base_query alone ("show all if no match")
+        if not brains and force_all.lower() == 'true':
+            if search_query:
+                brains = catalog(base_query)
+                if brains and searchTerm:
+                    _brains = self.search(catalog, base_query, searchTerm,
+                                          ('Title',), limit)
+                    if _brains:
+                        brains = _brains
+        return brains
+
+    def search(self, catalog, query, searchTerm, searchFields, limit):
+        """ Returns the brains that match the query and have searchTerm in
+            any of the searchFields.  The type-ahead index of the portal
+            types of the query is used when available.
+        """
+        if searchTerm:
+            try:
+                brains = typeahead_search(catalog, query, searchTerm,
+                                          searchFields, limit)
+            except:
+                from bika.lims import logger
+                logger.info(query)
+                raise
+            if brains is not None:
+                return brains
         try:
-            brains = catalog(contentFilter)
+            brains = catalog(query)
         except:
             from bika.lims import logger
-            logger.info(contentFilter)
+            logger.info(query)
             raise
         if brains and searchTerm:
             _brains = []
@@ -61,13 +92,4 @@ class DefaultReferenceWidgetVocabulary(object):
                             break
 
             brains = _brains
-        # Then just base_query alone ("show all if no match")
-        if not brains and force_all.lower() == 'true':
-            if search_query:
-                brains = catalog(base_query)
-                if brains and searchTerm:
-                    _brains = [p for p in brains
-                               if p.Title.lower().find(searchTerm) > -1]
-                    if _brains:
-                        brains = _brains
         return brains
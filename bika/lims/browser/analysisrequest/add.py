@@ -16,6 +16,8 @@ from bika.lims.utils import getHiddenAttributesForClass, dicts_to_dict
 from bika.lims.utils import t
 from bika.lims.utils import tmpID
 from bika.lims.utils.analysisrequest import create_analysisrequest as crar
+from bika.lims.utils.analysisrequest import create_analysisrequests
+from bika.lims.utils.services import get_service_keywords
 from magnitude import mg
 from plone.app.layout.globals.interfaces import IViewView
 from Products.Archetypes import PloneMessageFactory as PMF
@@ -238,15 +240,14 @@ class AnalysisRequestAddView(AnalysisRequestViewView):
             return {}
         uids =  copy_from.split(",")
 
+        keywords = get_service_keywords(self.context)
         n = 0
         for uid in uids:
             proxies = self.bika_catalog(UID=uid)
             rr = proxies[0].getObject().getResultsRange()
             new_rr = []
             for i, r in enumerate(rr):
-                s_uid = self.bika_setup_catalog(portal_type='AnalysisService',
-                                              getKeyword=r['keyword'])[0].UID
-                r['uid'] = s_uid
+                r['uid'] = keywords.uid(r['keyword'])
                 new_rr.append(r)
             specs[n] = new_rr
             n += 1
@@ -442,16 +443,16 @@ class ajaxAnalysisRequestSubmit():
         if self.errors:
             return json.dumps({'errors': self.errors})
 
-        # Now, we will create the specified ARs.
+        # Now, we will create the specified ARs, in one batch per client.
+        by_client = {}
+        for arnum in sorted(valid_states.keys()):
+            state = valid_states[arnum]
+            by_client.setdefault(state['Client'], []).append(state)
         ARs = []
-        for arnum, state in valid_states.items():
-            # Create the Analysis Request
-            ar = crar(
-                portal_catalog(UID=state['Client'])[0].getObject(),
-                self.request,
-                state
-            )
-            ARs.append(ar.Title())
+        for client_uid, states in by_client.items():
+            client = portal_catalog(UID=client_uid)[0].getObject()
+            for ar in create_analysisrequests(client, self.request, states):
+                ARs.append(ar.Title())
 
         # Display the appropriate message after creation
         if len(ARs) > 1:
@@ -12,6 +12,7 @@ from bika.lims.content.analysisrequest import schema as AnalysisRequestSchema
 from bika.lims.permissions import *
 from bika.lims.utils import logged_in_client
 from bika.lims.utils import to_utf8
+from bika.lims.utils.services import get_service_keywords
 from bika.lims.workflow import doActionFor
 from DateTime import DateTime
 from Products.Archetypes import PloneMessageFactory as PMF
@@ -120,16 +121,15 @@ class AnalysisRequestAnalysesView(BikaListingView):
         """Return the AR Specs sorted by Service UID, so that the JS can
         work easily with the values.
         """
-        bsc = self.bika_setup_catalog
+        keywords = get_service_keywords(self.context)
         rr_dict_by_service_uid = {}
         rr = self.context.getResultsRange()
         for r in rr:
             keyword = r['keyword']
-            try:
-                service_uid = bsc(portal_type='AnalysisService',
-                                  getKeyword=keyword)[0].UID
+            service_uid = keywords.uid(keyword)
+            if service_uid:
                 rr_dict_by_service_uid[service_uid] = r
-            except IndexError:
+            else:
                 from bika.lims import logger
                 error = "No Analysis Service found for Keyword '%s'. "\
                         "Related: LIMS-1614"
@@ -10,11 +10,16 @@ from bika.lims.config import POINTS_OF_CAPTURE
 from bika.lims.idserver import renameAfterCreation
 from bika.lims.interfaces import IResultOutOfRange
 from bika.lims.utils import isnumber
-from bika.lims.utils import to_utf8, encode_header, createPdf, attachPdf
+from bika.lims.utils import to_utf8, encode_header, attachPdf
 from bika.lims.utils import to_utf8, formatDecimalMark, format_supsub
 from bika.lims.utils.analysis import format_uncertainty
+from bika.lims.utils.mailqueue import queue_mail
+from bika.lims.utils.publishqueue import queue_publication
+from bika.lims.utils.resultshistory import get_batch_request_uids
+from bika.lims.utils.resultshistory import get_previous_results
 from bika.lims.vocabularies import getARReportTemplates
 from DateTime import DateTime
+from Missing import Value
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.Utils import formataddr
@@ -25,7 +30,6 @@ from Products.CMFCore.utils import getToolByName
 from Products.CMFCore.WorkflowCore import WorkflowException
 from Products.CMFPlone.utils import safe_unicode, _createObjectByType
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
-from smtplib import SMTPServerDisconnected, SMTPRecipientsRefused
 from zope.component import getAdapters, getUtility
 
 from plone.registry import Record
@@ -57,7 +61,12 @@ class AnalysisRequestPublishView(BrowserView):
         self._cache = {
             '_analysis_data': {},
             '_qcanalyses_data': {},
-            '_ar_data': {}
+            '_ar_data': {},
+            '_lab_data': {},
+            '_client_data': {},
+            '_contact_data': {},
+            '_services_data': {},
+            '_batch_request_uids': {},
         }
 
     @property
@@ -493,10 +502,12 @@ class AnalysisRequestPublishView(BrowserView):
         return self.format_address(lab_address)
 
     def _lab_data(self):
+        if 'lab' in self._cache['_lab_data']:
+            return self._cache['_lab_data']['lab']
         portal = self.context.portal_url.getPortalObject()
         lab = self.context.bika_setup.laboratory
 
-        return {'obj': lab,
+        data = {'obj': lab,
                 'title': to_utf8(lab.Title()),
                 'url': to_utf8(lab.getLabURL()),
                 'address': to_utf8(self._lab_address(lab)),
@@ -505,22 +516,28 @@ class AnalysisRequestPublishView(BrowserView):
                 'accreditation_body': to_utf8(lab.getAccreditationBody()),
                 'accreditation_logo': lab.getAccreditationBodyLogo(),
                 'logo': "%s/logo_print.png" % portal.absolute_url()}
+        self._cache['_lab_data']['lab'] = data
+        return data
 
     def _contact_data(self, ar):
         data = {}
         contact = ar.getContact()
         if contact:
+            if contact.UID() in self._cache['_contact_data']:
+                return self._cache['_contact_data'][contact.UID()]
             data = {'obj': contact,
                     'fullname': to_utf8(contact.getFullname()),
                     'email': to_utf8(contact.getEmailAddress()),
                     'pubpref': contact.getPublicationPreference()}
+            self._cache['_contact_data'][contact.UID()] = data
         return data
 
-    def _client_address(self, client):
+    def _client_address(self, client, contact=None):
         client_address = client.getPostalAddress()
         if not client_address:
-            # Data from the first contact
-            contact = self.getAnalysisRequest().getContact()
+            # Data from the contact of the AR, or from the first contact
+            if contact is None:
+                contact = self.getAnalysisRequestObj().getContact()
             if contact and contact.getBillingAddress():
                 client_address = contact.getBillingAddress()
             elif contact and contact.getPhysicalAddress():
@@ -531,6 +548,12 @@ class AnalysisRequestPublishView(BrowserView):
         data = {}
         client = ar.aq_parent
         if client:
+            # the address of clients without postal address is taken from
+            # the contact of the AR
+            contact = ar.getContact()
+            key = (client.UID(), contact and contact.UID())
+            if key in self._cache['_client_data']:
+                return self._cache['_client_data'][key]
             data['obj'] = client
             data['id'] = client.id
             data['url'] = client.absolute_url()
@@ -538,7 +561,8 @@ class AnalysisRequestPublishView(BrowserView):
             data['phone'] = to_utf8(client.getPhone())
             data['fax'] = to_utf8(client.getFax())
 
-            data['address'] = to_utf8(self._client_address(client))
+            data['address'] = to_utf8(self._client_address(client, contact))
+            self._cache['_client_data'][key] = data
         return data
 
     def _specs_data(self, ar):
@@ -560,7 +584,6 @@ class AnalysisRequestPublishView(BrowserView):
         analyses = []
         dm = ar.aq_parent.getDecimalMark()
         batch = ar.getBatch()
-        workflow = getToolByName(self.context, 'portal_workflow')
         showhidden = self.isHiddenAnalysesVisible()
         for an in ar.getAnalyses(full_objects=True,
                                  review_state=analysis_states):
@@ -580,23 +603,24 @@ class AnalysisRequestPublishView(BrowserView):
             andict['previous'] = []
             andict['previous_results'] = ""
             if batch:
-                keyword = an.getKeyword()
-                bars = [bar for bar in batch.getAnalysisRequests() \
-                            if an.aq_parent.UID() != bar.UID() \
-                            and keyword in bar]
-                for bar in bars:
-                    pan = bar[keyword]
-                    pan_state = workflow.getInfoFor(pan, 'review_state')
-                    if pan.getResult() and pan_state in analysis_states:
-                        pandict = self._analysis_data(pan)
-                        andict['previous'].append(pandict)
-
-                andict['previous'] = sorted(andict['previous'], key=itemgetter("capture_date"))
+                # From the results history of the batch, already sorted by
+                # capture date
+                andict['previous'] = get_previous_results(
+                    batch, an.getKeyword(), an.aq_parent.UID(),
+                    self._batch_request_uids(batch))
                 andict['previous_results'] = ", ".join([p['formatted_result'] for p in andict['previous'][-5:]])
 
             analyses.append(andict)
         return analyses
 
+    def _batch_request_uids(self, batch):
+        """ The UIDs of the ARs of the batch, shared by all the ARs
+        """
+        if batch.UID() not in self._cache['_batch_request_uids']:
+            self._cache['_batch_request_uids'][batch.UID()] = \
+                get_batch_request_uids(batch)
+        return self._cache['_batch_request_uids'][batch.UID()]
+
     def _analysis_data(self, analysis, decimalmark=None):
         if analysis.UID() in self._cache['_analysis_data']:
             return self._cache['_analysis_data'][analysis.UID()]
@@ -787,159 +811,191 @@ class AnalysisRequestPublishView(BrowserView):
         style = self.request.form.get('style')
         uids = self.request.form.get('uid').split(':')
         reporthtml = "<html><head>%s</head><body><div id='report'>%s</body></html>" % (style, html)
-        publishedars = []
-        for uid in uids:
-            ars = self.publishFromHTML(uid, safe_unicode(reporthtml).encode('utf-8'))
-            publishedars.extend(ars)
-        return publishedars
+        reporthtml = safe_unicode(reporthtml).encode('utf-8')
+        uc = getToolByName(self.context, 'uid_catalog')
+        ars = [brain.getObject() for brain in uc(UID=uids)]
+        return self.publishReports([(ar, reporthtml) for ar in ars])
 
     def publishFromHTML(self, aruid, results_html):
-        # The AR can be published only and only if allowed
         uc = getToolByName(self.context, 'uid_catalog')
         ars = uc(UID=aruid)
         if not ars or len(ars) != 1:
             return []
-
-        ar = ars[0].getObject();
+        return self.publishReports([(ars[0].getObject(), results_html)])
+
+    def publishReports(self, reports):
+        """ Publishes the (AR, results html) pairs passed in.  The ARs that
+            can't be published are discarded, and the recipients of the
+            others are gathered, with the lab, client and contact data
+            shared by all the ARs.  The ARs are then published by a
+            background job (see bika.lims.utils.publishqueue), once the
+            request is committed: their PDFs are rendered, the ARReports
+            created, the ARs transitioned and the emails queued, a batch
+            of ARs per transaction.  The ARs which PDF could not be rendered
+            are not published.
+            Returns the list of ARs queued for publication.
+        """
+        items = [item for item in [self._publication_data(ar, html)
+                                   for ar, html in reports] if item]
+        if not items:
+            return []
+        queue_publication(
+            self.context, [dict(item, ar=item['ar'].UID()) for item in items])
+        return [item['ar'] for item in items]
+
+    def publishReport(self, job, pdf_report, job_id=''):
+        """ Creates the ARReport of the AR of the publication data passed
+            in, transitions the AR and queues the emails with the report.
+            Returns the ARReport.
+        """
+        report = self._create_report(job, pdf_report, job_id)
+        for message, recipients in self._report_messages(job, pdf_report):
+            queue_mail(report, message, recipients)
+        return report
+
+    def _publication_data(self, ar, results_html):
+        """ Returns the data needed to publish the AR, or None if the AR
+            can't be published
+        """
         wf = getToolByName(ar, 'portal_workflow')
         allowed_states = ['verified', 'published']
         # Publish/Republish allowed?
         if wf.getInfoFor(ar, 'review_state') not in allowed_states:
             # Pre-publish allowed?
             if not ar.getAnalyses(review_state=allowed_states):
-                return []
+                return None
 
         # HTML written to debug file
-        debug_mode = App.config.getConfiguration().debug_mode
-        if debug_mode:
-            tmp_fn = tempfile.mktemp(suffix=".html")
-            logger.debug("Writing HTML for %s to %s" % (ar.Title(), tmp_fn))
-            open(tmp_fn, "wb").write(results_html)
-
-        # Create the pdf report (will always be attached to the AR)
-        # we must supply the file ourself so that createPdf leaves it alone.
-        pdf_fn = tempfile.mktemp(suffix=".pdf")
-        pdf_report = createPdf(htmlreport=results_html, outfile=pdf_fn)
-
-        # PDF written to debug file
-        if debug_mode:
-            logger.debug("Writing PDF for %s to %s" % (ar.Title(), pdf_fn))
-        else:
-            os.remove(pdf_fn)
+        if App.config.getConfiguration().debug_mode:
+            with tempfile.NamedTemporaryFile(
+                    suffix=".html", delete=False) as tmp_file:
+                logger.debug("Writing HTML for %s to %s" %
+                             (ar.Title(), tmp_file.name))
+                tmp_file.write(results_html)
 
         recipients = []
-        contact = ar.getContact()
-        lab = ar.bika_setup.laboratory
-        if pdf_report:
-            if contact:
-                recipients = [{
-                    'UID': contact.UID(),
-                    'Username': to_utf8(contact.getUsername()),
-                    'Fullname': to_utf8(contact.getFullname()),
-                    'EmailAddress': to_utf8(contact.getEmailAddress()),
-                    'PublicationModes': contact.getPublicationPreference()
-                }]
-            reportid = ar.generateUniqueId('ARReport')
-            report = _createObjectByType("ARReport", ar, reportid)
-            report.edit(
-                AnalysisRequest=ar.UID(),
-                Pdf=pdf_report,
-                Html=results_html,
-                Recipients=recipients
-            )
-            report.unmarkCreationFlag()
-            renameAfterCreation(report)
-
-            # Set status to prepublished/published/republished
-            status = wf.getInfoFor(ar, 'review_state')
-            transitions = {'verified': 'publish',
-                           'published' : 'republish'}
-            transition = transitions.get(status, 'prepublish')
-            try:
-                wf.doActionFor(ar, transition)
-            except WorkflowException:
-                pass
-
-            # compose and send email.
-            # The managers of the departments for which the current AR has
-            # at least one AS must receive always the pdf report by email.
-            # https://github.com/bikalabs/Bika-LIMS/issues/1028
-            mime_msg = MIMEMultipart('related')
-            mime_msg['Subject'] = self.get_mail_subject(ar)[0]
-            mime_msg['From'] = formataddr(
-                (encode_header(lab.getName()), lab.getEmailAddress()))
-            mime_msg.preamble = 'This is a multi-part MIME message.'
-            msg_txt = MIMEText(results_html, _subtype='html')
-            mime_msg.attach(msg_txt)
-
-            to = []
-            mngrs = ar.getResponsible()
-            for mngrid in mngrs['ids']:
-                name = mngrs['dict'][mngrid].get('name', '')
-                email = mngrs['dict'][mngrid].get('email', '')
-                if (email != ''):
-                    to.append(formataddr((encode_header(name), email)))
-
-            if len(to) > 0:
-                # Send the email to the managers
-                mime_msg['To'] = ','.join(to)
-                attachPdf(mime_msg, pdf_report, ar.id)
-
-                try:
-                    host = getToolByName(ar, 'MailHost')
-                    host.send(mime_msg.as_string(), immediate=True)
-                except SMTPServerDisconnected as msg:
-                    logger.warn("SMTPServerDisconnected: %s." % msg)
-                except SMTPRecipientsRefused as msg:
-                    raise WorkflowException(str(msg))
-
-        # Send report to recipients
-        recips = self.get_recipients(ar)
-        for recip in recips:
-            if 'email' not in recip.get('pubpref', []) \
-                    or not recip.get('email', ''):
-                continue
-
-            title = encode_header(recip.get('title', ''))
-            email = recip.get('email')
-            formatted = formataddr((title, email))
-
-            # Create the new mime_msg object, cause the previous one
-            # has the pdf already attached
-            mime_msg = MIMEMultipart('related')
-            mime_msg['Subject'] = self.get_mail_subject(ar)[0]
-            mime_msg['From'] = formataddr(
+        contact = self._contact_data(ar)
+        if contact:
+            recipients = [{
+                'UID': contact['obj'].UID(),
+                'Username': to_utf8(contact['obj'].getUsername()),
+                'Fullname': contact['fullname'],
+                'EmailAddress': contact['email'],
+                'PublicationModes': contact['pubpref']
+            }]
+        # The managers of the departments for which the current AR has
+        # at least one AS must receive always the pdf report by email.
+        # https://github.com/bikalabs/Bika-LIMS/issues/1028
+        managers = []
+        mngrs = ar.getResponsible()
+        for mngrid in mngrs['ids']:
+            name = mngrs['dict'][mngrid].get('name', '')
+            email = mngrs['dict'][mngrid].get('email', '')
+            if (email != ''):
+                managers.append(formataddr((encode_header(name), email)))
+        return {'ar': ar,
+                'html': results_html,
+                'recipients': recipients,
+                'managers': managers,
+                'notified': self.get_recipients(ar),
+                'subject': self.get_mail_subject(ar)[0]}
+
+    def _create_report(self, job, pdf_report, job_id=''):
+        """ Creates the ARReport of the AR and transitions the AR to
+            published, republished or prepublished.  The ARReport keeps the
+            id of the publication job that created it.
+        """
+        ar = job['ar']
+        wf = getToolByName(ar, 'portal_workflow')
+        reportid = ar.generateUniqueId('ARReport')
+        report = _createObjectByType("ARReport", ar, reportid)
+        report.edit(
+            AnalysisRequest=ar.UID(),
+            Pdf=pdf_report,
+            Html=job['html'],
+            Recipients=job['recipients'],
+            PublicationJob=job_id
+        )
+        report.unmarkCreationFlag()
+        renameAfterCreation(report)
+
+        # Set status to prepublished/published/republished
+        status = wf.getInfoFor(ar, 'review_state')
+        transitions = {'verified': 'publish',
+                       'published' : 'republish'}
+        transition = transitions.get(status, 'prepublish')
+        try:
+            wf.doActionFor(ar, transition)
+        except WorkflowException:
+            pass
+        return report
+
+    def _report_message(self, job, pdf_report=None):
+        """ Returns the email (MIME string, without To header) with the
+            results html, and the pdf attached if passed in
+        """
+        lab = self._lab_data()['obj']
+        mime_msg = MIMEMultipart('related')
+        mime_msg['Subject'] = job['subject']
+        mime_msg['From'] = formataddr(
             (encode_header(lab.getName()), lab.getEmailAddress()))
-            mime_msg.preamble = 'This is a multi-part MIME message.'
-            msg_txt = MIMEText(results_html, _subtype='html')
-            mime_msg.attach(msg_txt)
-            mime_msg['To'] = formatted
-
-            # Attach the pdf to the email if requested
-            if pdf_report and 'pdf' in recip.get('pubpref'):
-                attachPdf(mime_msg, pdf_report, ar.id)
+        mime_msg.preamble = 'This is a multi-part MIME message.'
+        msg_txt = MIMEText(job['html'], _subtype='html')
+        mime_msg.attach(msg_txt)
+        if pdf_report:
+            attachPdf(mime_msg, pdf_report, job['ar'].id)
+        return mime_msg.as_string()
+
+    def _report_messages(self, job, pdf_report):
+        """ Returns the emails that send the report of the AR to the
+            department managers and to the recipients, as (MIME string,
+            recipients) pairs.  Each email is built once: the one with the
+            pdf attached for the managers and the recipients that want the
+            pdf, and the one without for the others.
+        """
+        ar = job['ar']
+        with_pdf = list(job['managers'])
+        without_pdf = []
+
+        # For now, I will simply ignore mail send under test.
+        if not hasattr(self.portal, 'robotframework'):
+            for recip in job['notified']:
+                if 'email' not in recip.get('pubpref', []) \
+                        or not recip.get('email', ''):
+                    continue
+                title = encode_header(recip.get('title', ''))
+                formatted = formataddr((title, recip.get('email')))
+                # Attach the pdf to the email if requested
+                if 'pdf' in recip.get('pubpref'):
+                    with_pdf.append(formatted)
+                else:
+                    without_pdf.append(formatted)
 
-            # For now, I will simply ignore mail send under test.
-            if hasattr(self.portal, 'robotframework'):
+        messages = []
+        debug_mode = App.config.getConfiguration().debug_mode
+        for recipients, pdf in ((with_pdf, pdf_report), (without_pdf, None)):
+            if not recipients:
                 continue
-
-            msg_string = mime_msg.as_string()
-
+            msg_string = self._report_message(job, pdf)
             # content of outgoing email written to debug file
             if debug_mode:
-                tmp_fn = tempfile.mktemp(suffix=".email")
-                logger.debug("Writing MIME message for %s to %s" % (ar.Title(), tmp_fn))
-                open(tmp_fn, "wb").write(msg_string)
-
-            try:
-                host = getToolByName(ar, 'MailHost')
-                host.send(msg_string, immediate=True)
-            except SMTPServerDisconnected as msg:
-                logger.warn("SMTPServerDisconnected: %s." % msg)
-            except SMTPRecipientsRefused as msg:
-                raise WorkflowException(str(msg))
-
-        return [ar]
+                with tempfile.NamedTemporaryFile(
+                        suffix=".email", delete=False) as tmp_file:
+                    logger.debug("Writing MIME message for %s to %s" %
+                                 (ar.Title(), tmp_file.name))
+                    tmp_file.write(msg_string)
+            messages.append((msg_string, recipients))
+        return messages
+
+    def _render_report(self, ar):
+        """ Renders the results html of the AR, with the data of the lab,
+            clients and contacts cached by this view
+        """
+        self._ars = [ar]
+        self._arsbyclient = [[ar]]
+        self._current_ar_index = 0
+        self._current_arsbyclient_index = 0
+        return safe_unicode(self.template()).encode('utf-8')
 
     def publish(self):
         """ Publish the AR report/s. Generates a results pdf file
@@ -947,22 +1003,21 @@ class AnalysisRequestPublishView(BrowserView):
             the lab manager and sends a notification (usually an email
             with the PDF attached) to the AR's contact and CCs.
             Transitions each published AR to statuses 'published',
-            'prepublished' or 'republished'.
-            Returns a list with the AR identifiers that have been
-            published/prepublished/republished (only those 'verified',
-            'published' or at least have one 'verified' result).
+            'prepublished' or 'republished'.  The publication runs in a
+            background job, once the request is committed.
+            Returns a list with the AR identifiers that have been queued
+            for publication (only those 'verified', 'published' or at
+            least have one 'verified' result).
         """
-        if len(self._ars) > 1:
-            published_ars = []
-            for ar in self._ars:
-                arpub = AnalysisRequestPublishView(ar, self.request, publish=True)
-                ar = arpub.publish()
-                published_ars.extend(ar)
-            published_ars = [par.id for par in published_ars]
-            return published_ars
-
-        results_html = safe_unicode(self.template()).encode('utf-8')
-        return self.publishFromHTML(results_html)
+        ars = self._ars
+        try:
+            reports = [(ar, self._render_report(ar)) for ar in ars]
+        finally:
+            self._ars = ars
+        published_ars = self.publishReports(reports)
+        if len(ars) > 1:
+            return [par.id for par in published_ars]
+        return published_ars
 
     def get_recipients(self, ar):
         """ Returns a list with the recipients and all its publication prefs
@@ -1058,53 +1113,135 @@ class AnalysisRequestPublishView(BrowserView):
         sort_keys = dict([(b.Title, "{:04}".format(a)) for a, b in enumerate(analysis_categories)])
         return sorted(category_keys, key=lambda title, sk=sort_keys: sk.get(title))
 
+    def _services_data(self, uids):
+        """ Returns a dict service UID -> dict with the title, keyword,
+            category title, accredited flag, unit and method title of the
+            Analysis Service, read from bika_setup_catalog once per view
+        """
+        cache = self._cache['_services_data']
+        missing = [uid for uid in uids if uid not in cache]
+        if missing:
+            bsc = getToolByName(self.context, 'bika_setup_catalog')
+            for brain in bsc(portal_type='AnalysisService', UID=missing):
+                # the method is not in the catalog: one service object
+                # per report, not one per analysis
+                method = brain.getObject().getMethod()
+                cache[brain.UID] = {
+                    'uid': brain.UID,
+                    'title': brain.Title,
+                    'keyword': brain.getKeyword,
+                    'category': brain.getCategoryTitle,
+                    'accredited': brain.getAccredited,
+                    'unit': brain.getUnit or '',
+                    'method': method.Title() if method else ''}
+        return dict([(uid, cache[uid]) for uid in uids if uid in cache])
+
+    def getTransposedMatrix(self, ars):
+        """ Returns the results of the analyses of the ARs, as a matrix with
+            a column per AR and a row per service:
+            {'ars': ['ar1_id', 'ar2_id', ...],
+             'categories': [
+                {'title': 'category_1_title',
+                 'services': [
+                    {'uid': 'service_1_uid',
+                     'title': 'service_1_title',
+                     'keyword': 'service_1_keyword',
+                     'accredited': True,
+                     'unit': 'mg/l',
+                     'method': 'method_title',
+                     'results': ['ar1 formatted result', '', ...]},
+                    ...
+                 ]},
+                ...
+             ]}
+            Categories and services are sorted by title.  The matrix is
+            built from the metadata of bika_analysis_catalog, without waking
+            up the analyses.
+            The title and keyword of each service are those of the version
+            of the service the analyses were created with (getServiceTitle
+            and getKeyword metadata), as in the single AR reports.  The
+            category, accredited flag, unit and method are read from the
+            current version of the service, from bika_setup_catalog.  The
+            services bika_setup_catalog does not return for the current
+            user are read from the versioned service of their analyses.
+        """
+        columns = dict([(ar.id, index) for index, ar in enumerate(ars)])
+        # service UID -> results, one per AR
+        rows = {}
+        # service UID -> first analysis brain of the service
+        analyses = {}
+        for ar in ars:
+            for brain in ar.getAnalyses():
+                result = brain.getFormattedResult
+                if result is None or result is Value:
+                    # not catalogued yet
+                    result = brain.getObject().getFormattedResult()
+                uid = brain.getServiceUID
+                if uid not in rows:
+                    rows[uid] = [''] * len(ars)
+                    analyses[uid] = brain
+                rows[uid][columns[ar.id]] = result
+        services = self._services_data(rows.keys())
+        categories = {}
+        for uid, results in rows.items():
+            brain = analyses[uid]
+            if uid in services:
+                row = dict(services[uid])
+            else:
+                row = self._service_data(brain.getObject().getService())
+            for key, column in (('title', 'getServiceTitle'),
+                                ('keyword', 'getKeyword')):
+                value = getattr(brain, column, None)
+                if value and value is not Value:
+                    row[key] = value
+            row['results'] = results
+            categories.setdefault(row['category'], []).append(row)
+        matrix = {'ars': [ar.id for ar in ars], 'categories': []}
+        for title in sorted(categories.keys()):
+            rows = sorted(categories[title], key=itemgetter('title'))
+            matrix['categories'].append({'title': title, 'services': rows})
+        return matrix
+
+    def _service_data(self, service):
+        """ Returns the same dict as _services_data, read from the service
+            object passed in
+        """
+        method = service.getMethod()
+        return {'uid': service.UID(),
+                'title': service.Title(),
+                'keyword': service.getKeyword(),
+                'category': service.getCategoryTitle(),
+                'accredited': service.getAccredited(),
+                'unit': service.getUnit() or '',
+                'method': method.Title() if method else ''}
+
     def getAnaysisBasedTransposedMatrix(self, ars):
         """ Returns a dict with the following structure:
             {'category_1_name':
                 {'service_1_title':
-                    {'service_1_uid':
-                        {'service': <AnalysisService-1>,
-                         'ars': {'ar1_id': [<Analysis (for as-1)>,
-                                           <Analysis (for as-1)>],
-                                 'ar2_id': [<Analysis (for as-1)>]
-                                },
-                        },
+                    {'service': <AnalysisService-1>,
+                     'accredited': True,
+                     'ars': {'ar1_id': 'formatted result',
+                             'ar2_id': 'formatted result'},
                     },
-                {'service_2_title':
-                     {'service_2_uid':
-                        {'service': <AnalysisService-2>,
-                         'ars': {'ar1_id': [<Analysis (for as-2)>,
-                                           <Analysis (for as-2)>],
-                                 'ar2_id': [<Analysis (for as-2)>]
-                                },
-                        },
-                    },
-                ...
+                 'service_2_title':
+                    ...
                 },
             }
+            Kept for the report templates that use it.  See
+            getTransposedMatrix.
         """
+        uc = getToolByName(self.context, 'uid_catalog')
+        matrix = self.getTransposedMatrix(ars)
         analyses = {}
-        for ar in ars:
-            ans = [an.getObject() for an in ar.getAnalyses()]
-            for an in ans:
-                service = an.getService()
-                cat = service.getCategoryTitle()
-                if cat not in analyses:
-                    analyses[cat] = {
-                        service.title: {
-                            'service': service,
-                            'accredited': service.getAccredited(),
-                            'ars': {ar.id: an.getFormattedResult()}
-                        }
-                    }
-                elif service.title not in analyses[cat]:
-                    analyses[cat][service.title] = {
-                        'service': service,
-                        'accredited': service.getAccredited(),
-                        'ars': {ar.id: an.getFormattedResult()}
-                    }
-                else:
-                    d = analyses[cat][service.title]
-                    d['ars'][ar.id] = an.getFormattedResult()
-                    analyses[cat][service.title]=d
+        for category in matrix['categories']:
+            services = analyses.setdefault(category['title'], {})
+            for row in category['services']:
+                results = dict([(arid, result) for arid, result
+                                in zip(matrix['ars'], row['results'])
+                                if result])
+                services[row['title']] = {
+                    'service': uc(UID=row['uid'])[0].getObject(),
+                    'accredited': row['accredited'],
+                    'ars': results}
         return analyses
@@ -10,6 +10,8 @@ from bika.lims.browser import BrowserView, ulocalized_time
 from bika.lims.browser.bika_listing import BikaListingView
 from bika.lims.interfaces import IClient
 from bika.lims.utils import tmpID
+from bika.lims.utils.arimportqueue import can_resume
+from bika.lims.utils.arimportqueue import queue_arimport
 from bika.lims.workflow import getTransitionDate
 from plone.app.contentlisting.interfaces import IContentListing
 from plone.app.layout.globals.interfaces import IViewView
@@ -64,6 +66,7 @@ class ARImportsView(BikaListingView):
             'DateCreated': {'title': _('Date Created')},
             'DateValidated': {'title': _('Date Validated')},
             'DateImported': {'title': _('Date Imported')},
+            'Progress': {'title': _('Progress')},
             'state_title': {'title': _('State')},
         }
         self.review_states = [
@@ -88,6 +91,7 @@ class ARImportsView(BikaListingView):
                          'DateCreated',
                          'DateValidated',
                          'DateImported',
+                         'Progress',
                          'state_title']},
             {'id': 'cancelled',
              'title': _('Cancelled'),
@@ -130,6 +134,17 @@ class ARImportsView(BikaListingView):
             items[x]['DateValidated'] = date if date else ''
             date = getTransitionDate(obj, 'import')
             items[x]['DateImported'] = date if date else ''
+            items[x]['Progress'] = ''
+            status = obj.getImportStatus()
+            if status:
+                items[x]['Progress'] = "%s/%s (%s)" % (
+                    obj.getImportedRows(), len(obj.getSampleData()),
+                    self.context.translate(_(status)))
+                if can_resume(obj):
+                    items[x]['replace']['Progress'] = \
+                        "%s <a href='%s/arimport_resume'>%s</a>" % (
+                            items[x]['Progress'], obj.absolute_url(),
+                            self.context.translate(_('Resume')))
 
         return items
 
@@ -161,6 +176,7 @@ class ClientARImportsView(ARImportsView):
                          'DateCreated',
                          'DateValidated',
                          'DateImported',
+                         'Progress',
                          'state_title']},
             {'id': 'cancelled',
              'title': _('Cancelled'),
@@ -231,3 +247,17 @@ class ClientARImportAddView(BrowserView):
             if not existing:
                 return newname
             nr += 1
+
+
+class ARImportResumeView(BrowserView):
+    """Queues again the background import of an ARImport that failed or was
+    interrupted.  The import resumes from the last committed row.
+    """
+
+    def __call__(self):
+        if can_resume(self.context):
+            queue_arimport(self.context)
+            addStatusMessage(self.request, _("AR Import resumed"))
+        else:
+            addStatusMessage(self.request, _("AR Import is not interrupted"))
+        self.request.response.redirect(self.context.absolute_url())
@@ -36,6 +36,8 @@ from bika.lims.utils import isActive, getHiddenAttributesForClass
 from bika.lims.utils import t, format_supsub
 from bika.lims.utils import to_utf8
 from bika.lims.utils import getFromString
+from bika.lims.utils.paging import lazy_slice
+from bika.lims.utils.paging import result_count
 from plone.app.content.browser import tableview
 from plone.app.content.browser.foldercontents import FolderContentsView, FolderContentsTable
 from plone.app.content.browser.interfaces import IFolderContentsView
@@ -358,6 +360,17 @@ class BikaListingView(BrowserView):
     # it only searches visible items
     manual_sort_on = None
 
+    # Metadata-only rendering.  When render_from_metadata is True, the
+    # rows are built from the catalog brains alone, and the values of the
+    # columns listed in metadata_columns are read from the catalog metadata
+    # (the column id, and the column's 'attr' if set, are metadata columns
+    # of self.catalog).  A column's 'replace_url' must be 'absolute_url' or
+    # a metadata column too.  Objects are only woken up for the rows that
+    # really need them: when isItemAllowed or folderitem are overriden by
+    # the subclass, these hooks still receive the full object.
+    render_from_metadata = False
+    metadata_columns = []
+
     # Column definitions:
     #
     # The keys of the columns dictionary must all exist in all
@@ -455,6 +468,9 @@ class BikaListingView(BrowserView):
         self.show_all = False
         self.show_more = False
         self.limit_from = 0
+        self.total = 0
+        # number of brains read and objects woken by folderitems
+        self.counters = {'brains': 0, 'objects': 0}
 
     @property
     def review_state(self):
@@ -811,6 +827,142 @@ class BikaListingView(BrowserView):
         """
         return item
 
+    def wake_object(self, brain):
+        """ Returns the object for the brain passed in, keeping track of the
+            number of objects woken up in self.counters.  If an object is
+            passed in, it is returned as is.
+        """
+        if not hasattr(brain, 'getObject'):
+            return brain
+        self.counters['objects'] += 1
+        return brain.getObject()
+
+    def hooks_require_object(self):
+        """ Returns True if isItemAllowed or folderitem are overriden by
+            the current class, in which case, the full object must be woken
+            up for each row, even when render_from_metadata is set.
+        """
+        klass = self.__class__
+        for name in ('isItemAllowed', 'folderitem'):
+            func = getattr(klass, name).im_func
+            if func is not getattr(BikaListingView, name).im_func:
+                return True
+        return False
+
+    def update_request_counters(self):
+        """ Adds the counters of this listing to the per-request counters
+            stored in 'bika_listing_counters', keyed by form_id.
+        """
+        counters = self.request.get('bika_listing_counters', None) or {}
+        current = counters.get(self.form_id, {'brains': 0, 'objects': 0})
+        for key, value in self.counters.items():
+            current[key] = current.get(key, 0) + value
+        counters[self.form_id] = current
+        self.request.set('bika_listing_counters', counters)
+        logger.debug("%s: %s brains read, %s objects woken" %
+                     (self.form_id, self.counters['brains'],
+                      self.counters['objects']))
+
+    def folderitem_from_brain(self, brain, path):
+        """ Builds the item dict for the brain passed in, reading all values
+            from the catalog metadata.  Returns a dict with the same keys as
+            the ones set by folderitems for full objects, except 'obj',
+            which is the brain itself.
+        """
+        tools = self._listing_tools
+        workflow = tools['workflow']
+        portal_type = brain.portal_type
+        uid = brain.UID
+        description = getattr(brain, 'Description', '') or ''
+        url = brain.getURL()
+        fti = tools['portal_types'].get(portal_type)
+        type_title_msgid = fti.Title() if fti is not None else portal_type
+        url_href_title = '%s at %s: %s' % (
+            t(type_title_msgid),
+            path,
+            to_utf8(description))
+        modified = getattr(brain, 'modified', None)
+        modified = self.ulocalized_time(modified) if modified else ''
+        type_class = 'contenttype-' + \
+            tools['plone_utils'].normalizeString(portal_type)
+
+        state_class = ''
+        states = {}
+        for state_var in ('review_state', 'cancellation_state',
+                          'inactive_state', 'worksheetanalysis_review_state'):
+            state = getattr(brain, state_var, None)
+            if state and isinstance(state, basestring):
+                states[state_var] = state
+                state_class += "state-%s " % state
+
+        results_dict = dict(
+            obj = brain,
+            id = path.split('/')[-1],
+            parent_id = path.split('/')[-2],
+            title = brain.Title,
+            uid = uid,
+            path = path,
+            url = url,
+            fti = fti,
+            item_data = json.dumps([]),
+            url_href_title = url_href_title,
+            obj_type = getattr(brain, 'Type', portal_type),
+            size = getattr(brain, 'getObjSize', ''),
+            modified = modified,
+            icon = tools['plone_layout'].getIcon(brain).html_tag(),
+            type_class = type_class,
+            choices = {},
+            state_class = state_class,
+            relative_url = brain.getURL(relative = True),
+            view_url = url,
+            table_row_class = "",
+            category = 'None',
+            allow_edit = [],
+            required = [],
+            field={},
+            before = {},
+            after = {},
+            replace = {},
+        )
+        rs = states.get('review_state', 'active')
+        st_title = workflow.getTitleForStateOnType(rs, portal_type)
+        results_dict['review_state'] = rs
+        for state_var, state in states.items():
+            results_dict[state_var] = state
+        results_dict['state_title'] = t(PMF(st_title)) if st_title else None
+        results_dict['class'] = {}
+
+        for key in self.columns.keys():
+            column = self.columns[key]
+            if key not in results_dict:
+                value = ''
+                if key in self.metadata_columns:
+                    # as for objects, the 'attr' of the column wins
+                    value = self.metadata_value(brain, key)
+                    if column.get('attr', None):
+                        value = self.metadata_value(
+                            brain, column['attr']) or value
+                results_dict[key] = value if value else ''
+            replace_url = column.get('replace_url', None)
+            if replace_url:
+                url = self.metadata_value(brain, replace_url)
+                if url:
+                    results_dict['replace'][key] = \
+                        '<a href="%s">%s</a>' % (url, results_dict[key])
+        return results_dict
+
+    def metadata_value(self, brain, name):
+        """ Returns the value of the metadata column name of the brain, or
+            '' if the catalog has no such column.  'absolute_url' is the URL
+            of the brain.
+        """
+        if name == 'absolute_url':
+            return brain.getURL()
+        if name not in brain.__record_schema__:
+            return ''
+        value = getattr(brain, name, '')
+        return value() if callable(value) else value
+
     def folderitems(self, full_objects = False):
         """
         >>> portal = layer['portal']
@@ -851,6 +1003,13 @@ class BikaListingView(BrowserView):
         addition = self.get_filter_bar_queryaddition()
         if addition:
             contentFilterTemp.update(addition)
+        # Push the page limit down to the catalog, so only the items up to
+        # the end of the current page get sorted. Only possible if no item
+        # can be discarded by the isItemAllowed/folderitem hooks.
+        if not show_all and hasattr(self.contentsMethod, '_catalog') \
+                and not self.hooks_require_object():
+            contentFilterTemp['sort_limit'] = \
+                self.limit_from + self.pagesize + 1
         if (hasattr(self, 'And') and self.And) \
            or (hasattr(self, 'Or') and self.Or):
             # if contentsMethod is capable, we do an AdvancedQuery.
@@ -879,7 +1038,17 @@ class BikaListingView(BrowserView):
         idx = 0
         results = []
         self.show_more = False
-        brains = brains[self.limit_from:]
+        self.counters = {'brains': 0, 'objects': 0}
+        self._listing_tools = dict(
+            plone_layout = plone_layout,
+            plone_utils = plone_utils,
+            portal_types = portal_types,
+            workflow = workflow)
+        metadata_only = self.render_from_metadata
+        hooks_require_object = metadata_only and self.hooks_require_object()
+        # number of items matching the query; objects are not woken up
+        self.total = result_count(brains)
+        brains = lazy_slice(brains, self.limit_from)
         for i, obj in enumerate(brains):
             # avoid creating unnecessary info for items outside the current
             # batch;  only the path is needed for the "select all" case...
@@ -893,8 +1062,47 @@ class BikaListingView(BrowserView):
             path = hasattr(obj, 'getPath') and obj.getPath() or \
                  "/".join(obj.getPhysicalPath())
 
+            if metadata_only and hasattr(obj, 'getObject'):
+                # Build the item from the brain, and only wake the object
+                # up if the isItemAllowed/folderitem hooks need it
+                brain = obj
+                self.counters['brains'] += 1
+                obj = self.wake_object(brain) if hooks_require_object \
+                    else brain
+                if not obj or not self.isItemAllowed(obj):
+                    continue
+                results_dict = self.folderitem_from_brain(brain, path)
+                if obj is not brain:
+                    results_dict['obj'] = obj
+                    self.update_field_icons(obj)
+                    for key in self.columns.keys():
+                        if results_dict.get(key, '') \
+                                or key in self.metadata_columns:
+                            continue
+                        # the same as for the rows built from objects
+                        attrobj = getFromString(obj, key)
+                        value = attrobj if attrobj else ''
+                        vattr = self.columns[key].get('attr', None)
+                        if vattr:
+                            attrobj = getFromString(obj, vattr)
+                            value = attrobj if attrobj else value
+                        results_dict[key] = value
+                        replace_url = self.columns[key].get('replace_url')
+                        if replace_url:
+                            attrobj = getFromString(obj, replace_url)
+                            if attrobj:
+                                results_dict['replace'][key] = \
+                                    '<a href="%s">%s</a>' % (attrobj, value)
+                item = self.folderitem(obj, results_dict, idx)
+                if item:
+                    results.append(item)
+                    idx += 1
+                continue
+
             # This item must be rendered, we need the object instead of a brain
-            obj = obj.getObject() if hasattr(obj, 'getObject') else obj
+            if hasattr(obj, 'getObject'):
+                self.counters['brains'] += 1
+            obj = self.wake_object(obj)
 
             # check if the item must be rendered or not (prevents from
             # doing it later in folderitems) and dealing with paging
@@ -935,6 +1143,7 @@ class BikaListingView(BrowserView):
             results_dict = dict(
                 obj = obj,
                 id = obj.getId(),
+                parent_id = path.split('/')[-2],
                 title = title,
                 uid = uid,
                 path = path,
@@ -993,17 +1202,7 @@ class BikaListingView(BrowserView):
 
             # extra classes for individual fields on this item { field_id : "css classes" }
             results_dict['class'] = {}
-            for name, adapter in getAdapters((obj, ), IFieldIcons):
-                auid = obj.UID() if hasattr(obj, 'UID') and callable(obj.UID) else None
-                if not auid:
-                    continue
-                alerts = adapter()
-                # logger.info(str(alerts))
-                if alerts and auid in alerts:
-                    if auid in self.field_icons:
-                        self.field_icons[auid].extend(alerts[auid])
-                    else:
-                        self.field_icons[auid] = alerts[auid]
+            self.update_field_icons(obj)
 
             # Search for values for all columns in obj
             for key in self.columns.keys():
@@ -1037,6 +1236,8 @@ class BikaListingView(BrowserView):
                 results.append(item)
                 idx+=1
 
+        self.update_request_counters()
+
         # Need manual_sort?
         # Note that the order has already been set in contentFilter, so
         # there is no need to reverse
@@ -1046,6 +1247,22 @@ class BikaListingView(BrowserView):
 
         return results
 
+    def update_field_icons(self, obj):
+        """ Collects the alerts from the IFieldIcons adapters for obj into
+            self.field_icons
+        """
+        for name, adapter in getAdapters((obj, ), IFieldIcons):
+            auid = obj.UID() if hasattr(obj, 'UID') and callable(obj.UID) else None
+            if not auid:
+                continue
+            alerts = adapter()
+            # logger.info(str(alerts))
+            if alerts and auid in alerts:
+                if auid in self.field_icons:
+                    self.field_icons[auid].extend(alerts[auid])
+                else:
+                    self.field_icons[auid] = alerts[auid]
+
     def contents_table(self, table_only = False):
         """ If you set table_only to true, then nothing outside of the
             <table/> tag will be printed (form tags, authenticator, etc).
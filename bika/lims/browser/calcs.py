@@ -14,12 +14,13 @@ from Products.Archetypes.config import REFERENCE_CATALOG
 from Products.CMFCore.utils import getToolByName
 from Products.PythonScripts.standard import html_quote
 from bika.lims.utils.analysis import format_numeric_result
+from bika.lims.utils.formula import get_compiled_formula
+from bika.lims.utils.services import get_service_keywords
 from zope.component import adapts
 from zope.component import getAdapters
 from zope.interface import implements
 
 import json
-import math
 import plone
 
 
@@ -85,6 +86,7 @@ class ajaxCalculateAnalysisEntry(BrowserView):
                 deps[dep.UID()] = dep
         path = '++resource++bika.lims.images'
         mapping = {}
+        keywords = get_service_keywords(self.context)
 
         # values to be returned to form for this UID
         Result = {'uid': uid, 'result': form_result}
@@ -135,7 +137,8 @@ class ajaxCalculateAnalysisEntry(BrowserView):
                 if analysisvalues['result']=='':
                     unsatisfied = True
                     break;
-                key = analysisvalues.get('keyword',dependency.getService().getKeyword())
+                key = analysisvalues.get('keyword', None) or \
+                    keywords.keyword(dependency.getServiceUID())
 
                 # Analysis result
                 # All result mappings must be float, or they are ignored.
@@ -177,8 +180,9 @@ class ajaxCalculateAnalysisEntry(BrowserView):
 
                     # all interims are ServiceKeyword.InterimKeyword
                     if i_uid in deps:
-                        key = "%s.%s" % (deps[i_uid].getService().getKeyword(),
-                                         i['keyword'])
+                        key = "%s.%s" % (
+                            keywords.keyword(deps[i_uid].getServiceUID()),
+                            i['keyword'])
                         mapping[key] = i['value']
                     # this analysis' interims get extra reference
                     # without service keyword prefix
@@ -206,17 +210,12 @@ class ajaxCalculateAnalysisEntry(BrowserView):
                     except ValueError:
                         pass
 
-            # convert formula to a valid python string, ready for interpolation
-            formula = calculation.getMinifiedFormula()
-            formula = formula.replace('[', '%(').replace(']', ')f')
+            # the formula is compiled once per calculation version
+            compiled = get_compiled_formula(calculation)
+            formula = compiled.formula
             try:
-                formula = eval("'%s'%%mapping" % formula,
-                               {"__builtins__": None,
-                                'math': math,
-                                'context': self.context},
-                               {'mapping': mapping})
                 # calculate
-                result = eval(formula)
+                result = compiled(mapping, context=self.context)
                 Result['result'] = result
                 self.current_results[uid]['result'] = result
             except TypeError as e:
@@ -3,15 +3,120 @@
 # Copyright 2011-2016 by it's authors.
 # Some rights reserved. See LICENSE.txt, AUTHORS.txt.
 
+from AccessControl import getSecurityManager
+from BTrees.IIBTree import intersection
 from Products.CMFCore.utils import getToolByName
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
 from bika.lims.browser import BrowserView
 from bika.lims import bikaMessageFactory as _
 from calendar import monthrange
 from DateTime import DateTime
+from plone.memoize import ram
+from plone.memoize.volatile import DontCache
+from time import time
 import plone, json
 import datetime
 
+
+def _allowed_roles_and_users(catalog):
+    """ The values the catalog searches restrict allowedRolesAndUsers to,
+        for the current user
+    """
+    if not hasattr(catalog, '_listAllowedRolesAndUsers'):
+        return []
+    user = getSecurityManager().getUser()
+    return catalog._listAllowedRolesAndUsers(user)
+
+
+class CatalogStats(object):
+    """ Counts the items of a catalog straight from its indexes: the sets of
+        record ids of each index are intersected, and no brain is loaded.
+        As the catalog searches do, the items are restricted to the ones
+        the current user is allowed to see.
+    """
+
+    def __init__(self, catalog, query):
+        self.catalog = catalog
+        query = dict(query)
+        if 'allowedRolesAndUsers' in catalog.indexes():
+            query['allowedRolesAndUsers'] = _allowed_roles_and_users(catalog)
+        self.rids = self.search(query)
+
+    def search(self, query, rids=None):
+        """ Returns the set of record ids that match the query, restricted
+            to the rids passed in
+        """
+        for name, value in query.items():
+            index = self.catalog._catalog.getIndex(name)
+            result = index._apply_index({name: value})
+            if result is None:
+                continue
+            rids = intersection(rids, result[0])
+        return rids
+
+    def count(self, **query):
+        """ Returns the number of items that match the query
+        """
+        rids = self.search(query, self.rids)
+        return len(rids) if rids is not None else 0
+
+    def count_by_state(self, **query):
+        """ Returns a dict with the number of items that match the query
+            for each review state.  The review_state index is walked once.
+        """
+        rids = self.search(query, self.rids)
+        index = self.catalog._catalog.getIndex('review_state')
+        counts = {}
+        for state in index.uniqueValues():
+            result = index._apply_index({'review_state': state})
+            if result is not None and rids is not None:
+                counts[state] = len(intersection(rids, result[0]))
+        return counts
+
+
+def _brain_state(brain):
+    """ Returns 'inactive' for cancelled items, the review state of the
+        active ones, and 'other_status' for the items without cancellation
+        workflow, as the evolution charts did from the objects
+    """
+    state = getattr(brain, 'cancellation_state', None)
+    if not isinstance(state, basestring):
+        return 'other_status'
+    if state != 'active':
+        return 'inactive'
+    state = getattr(brain, 'review_state', None)
+    return state if isinstance(state, basestring) else 'other_status'
+
+
+def _brain_created(brain):
+    created = getattr(brain, 'created', None)
+    if isinstance(created, DateTime):
+        return created
+    # created is not a metadata column of this catalog
+    return brain.getObject().created()
+
+
+def _cache_key_section(method, self):
+    """ The dashboard sections are cached for the number of seconds set in
+        bika_setup, for each date range, department filter and set of roles
+    """
+    interval = self.context.bika_setup.getDashboardCacheInterval()
+    if not interval:
+        raise DontCache
+    bc = getToolByName(self.context, 'bika_catalog')
+    return (method.__name__,
+            self.portal_url,
+            self.periodicity,
+            self.date_from.Date(),
+            self.date_to.Date(),
+            self.min_date.Date(),
+            self.request.get('filter_by_department_info', ''),
+            self.context.bika_setup.getAllowDepartmentFiltering(),
+            self.context.bika_setup.getSamplingWorkflowEnabled(),
+            tuple(sorted(_allowed_roles_and_users(bc))),
+            time() // interval)
+
+
 class DashboardView(BrowserView):
     template = ViewPageTemplateFile("templates/dashboard.pt")
 
@@ -115,6 +220,7 @@ class DashboardView(BrowserView):
                     self.get_worksheets_section()]
         return sections
 
+    @ram.cache(_cache_key_section)
     def get_analysisrequests_section(self):
         """ Returns the section dictionary related with Analysis
             Requests, that contains some informative panels (like
@@ -136,29 +242,20 @@ class DashboardView(BrowserView):
                      'attachment_due',
                      'verified']
         bc = getToolByName(self.context, "bika_catalog")
-
-        query_dic = {'portal_type':"AnalysisRequest",
-                     'created':self.date_range,
-                     'cancellation_state':['active']}
-        if filtering_allowed:
-            query_dic['getDepartmentUIDs'] = { "query":cookie_dep_uid,"operator":"or" }
-        numars = len(bc(query_dic))
-        query_dic = {'portal_type':"AnalysisRequest",
-                     'review_state':active_rs,
-                     'created':self.base_date_range,
-                     'cancellation_state':['active']}
+        query_dic = {'portal_type': "AnalysisRequest"}
         if filtering_allowed:
             query_dic['getDepartmentUIDs'] = { "query":cookie_dep_uid,"operator":"or" }
-        numars += len(bc(query_dic))
+        stats = CatalogStats(bc, query_dic)
+        # Counts by review state of the active ARs, in a single pass
+        states = stats.count_by_state(cancellation_state='active')
+        numars = stats.count(created=self.date_range,
+                             cancellation_state='active')
+        base_states = stats.count_by_state(created=self.base_date_range,
+                                           cancellation_state='active')
+        numars += sum([base_states.get(s, 0) for s in active_rs])
         if (sampenabled):
             # Analysis Requests awaiting to be sampled or scheduled
-            review_state = ['to_be_sampled',]
-            query_dic = {'portal_type':"AnalysisRequest",
-                     'review_state':review_state,
-                     'cancellation_state':['active']}
-            if filtering_allowed:
-                query_dic['getDepartmentUIDs'] = { "query":cookie_dep_uid,"operator":"or" }
-            ars = len(bc(query_dic))
+            ars = states.get('to_be_sampled', 0)
             ratio = (float(ars)/float(numars))*100 if ars > 0 and numars > 0 else 0
             ratio = str("%%.%sf" % 1) % ratio
             msg = _("To be sampled")
@@ -172,13 +269,7 @@ class DashboardView(BrowserView):
                         'link':        self.portal_url + '/samples?samples_review_state=to_be_sampled'})
 
             # Analysis Requests awaiting to be preserved
-            review_state = ['to_be_preserved',]
-            query_dic = {'portal_type':"AnalysisRequest",
-                     'review_state':review_state,
-                     'cancellation_state':['active']}
-            if filtering_allowed:
-                query_dic['getDepartmentUIDs'] = { "query":cookie_dep_uid,"operator":"or" }
-            ars = len(bc(query_dic))
+            ars = states.get('to_be_preserved', 0)
             ratio = (float(ars)/float(numars))*100 if ars > 0 and numars > 0 else 0
             ratio = str("%%.%sf" % 1) % ratio
             msg = _("To be preserved")
@@ -192,13 +283,7 @@ class DashboardView(BrowserView):
                         'link':         self.portal_url + '/analysisrequests?analysisrequests_review_state=to_be_preserved'})
 
             # Analysis Requests awaiting to be sampled
-            review_state = ['scheduled_sampling',]
-            query_dic = {'portal_type':"AnalysisRequest",
-                     'review_state':review_state,
-                     'cancellation_state':['active']}
-            if filtering_allowed:
-                query_dic['getDepartmentUIDs'] = { "query":cookie_dep_uid,"operator":"or" }
-            ars = len(bc(query_dic))
+            ars = states.get('scheduled_sampling', 0)
             ratio = (float(ars)/float(numars))*100 if ars > 0 and numars > 0 else 0
             ratio = str("%%.%sf" % 1) % ratio
             msg = _("Scheduled sampling")
@@ -212,13 +297,7 @@ class DashboardView(BrowserView):
                         'link':          self.portal_url + '/samples?samples_review_state=to_be_sampled'})
 
         # Analysis Requests awaiting for reception
-        review_state = ['sample_due',]
-        query_dic = {'portal_type':"AnalysisRequest",
-                 'review_state':review_state,
-                 'cancellation_state':['active']}
-        if filtering_allowed:
-            query_dic['getDepartmentUIDs'] = { "query":cookie_dep_uid,"operator":"or" }
-        ars = len(bc(query_dic))
+        ars = states.get('sample_due', 0)
         ratio = (float(ars)/float(numars))*100 if ars > 0 and numars > 0 else 0
         ratio = str("%%.%sf" % 1) % ratio
         msg = _("Reception pending")
@@ -233,12 +312,7 @@ class DashboardView(BrowserView):
 
         # Analysis Requests under way
         review_state = ['attachment_due', 'sample_received', 'assigned']
-        query_dic = {'portal_type':"AnalysisRequest",
-                 'review_state':review_state,
-                 'cancellation_state':['active']}
-        if filtering_allowed:
-            query_dic['getDepartmentUIDs'] = { "query":cookie_dep_uid,"operator":"or" }
-        ars = len(bc(query_dic))
+        ars = sum([states.get(s, 0) for s in review_state])
         ratio = (float(ars)/float(numars))*100 if ars > 0 and numars > 0 else 0
         ratio = str("%%.%sf" % 1) % ratio
         msg = _("Results pending")
@@ -252,13 +326,7 @@ class DashboardView(BrowserView):
                     'link':         self.portal_url + '/analysisrequests?analysisrequests_review_state=sample_received'})
 
         # Analysis Requests to be verified
-        review_state = ['to_be_verified',]
-        query_dic = {'portal_type':"AnalysisRequest",
-                 'review_state':review_state,
-                 'cancellation_state':['active']}
-        if filtering_allowed:
-            query_dic['getDepartmentUIDs'] = { "query":cookie_dep_uid,"operator":"or" }
-        ars = len(bc(query_dic))
+        ars = states.get('to_be_verified', 0)
         ratio = (float(ars)/float(numars))*100 if ars > 0 and numars > 0 else 0
         ratio = str("%%.%sf" % 1) % ratio
         msg = _("To be verified")
@@ -272,13 +340,7 @@ class DashboardView(BrowserView):
                     'link':         self.portal_url + '/analysisrequests?analysisrequests_review_state=to_be_verified'})
 
         # Analysis Requests to be published
-        review_state = ['verified',]
-        query_dic = {'portal_type':"AnalysisRequest",
-                 'review_state':review_state,
-                 'cancellation_state':['active']}
-        if filtering_allowed:
-            query_dic['getDepartmentUIDs'] = { "query":cookie_dep_uid,"operator":"or" }
-        ars = len(bc(query_dic))
+        ars = states.get('verified', 0)
         ratio = (float(ars)/float(numars))*100 if ars > 0 and numars > 0 else 0
         ratio = str("%%.%sf" % 1) % ratio
         msg = _("To be published")
@@ -293,7 +355,6 @@ class DashboardView(BrowserView):
 
         # Chart with the evolution of ARs over a period, grouped by
         # periodicity
-        workflow = getToolByName(self.context, 'portal_workflow')
         query_dic = {'portal_type':"AnalysisRequest",
                      'sort_on':"created",
                      'created':self.min_date_range}
@@ -302,18 +363,9 @@ class DashboardView(BrowserView):
         allars = bc(query_dic)
         outevo = []
         for ar in allars:
-            ar = ar.getObject()
-            state = 'other_status'
-            try:
-                state = workflow.getInfoFor(ar, 'cancellation_state')
-                if (state == 'active'):
-                    state = workflow.getInfoFor(ar, 'review_state')
-                else:
-                    state = 'inactive'
-            except:
-                pass
-
-            created = self._getDateStr(self.periodicity, ar.created())
+            # from the catalog metadata, without waking the object up
+            state = _brain_state(ar)
+            created = self._getDateStr(self.periodicity, _brain_created(ar))
             state = 'sample_due' if state in ['to_be_sampled', 'to_be_preserved'] else state
             state = 'sample_received' if state in ['assigned', 'attachment_due'] else state
             if (len(outevo) > 0 and outevo[-1]['date'] == created):
@@ -343,6 +395,7 @@ class DashboardView(BrowserView):
                 'title': _('Analysis Requests'),
                 'panels': out}
 
+    @ram.cache(_cache_key_section)
     def get_worksheets_section(self):
         """ Returns the section dictionary related with Worksheets,
             that contains some informative panels (like
@@ -354,27 +407,19 @@ class DashboardView(BrowserView):
         cookie_dep_uid = self.request.get('filter_by_department_info', '').split(',') if filtering_allowed else ''
         active_ws = ['open', 'to_be_verified', 'attachment_due']
 
-        query_dic = {'portal_type':"Worksheet",
-                 'created':self.date_range}
-        if filtering_allowed:
-            query_dic['getDepartmentUIDs'] = { "query":cookie_dep_uid,"operator":"or" }
-        numws = len(bc(query_dic))
-
-        query_dic = {'portal_type':"Worksheet",
-                 'review_state':active_ws,
-                 'created':self.base_date_range}
+        query_dic = {'portal_type': "Worksheet"}
         if filtering_allowed:
             query_dic['getDepartmentUIDs'] = { "query":cookie_dep_uid,"operator":"or" }
-        numws += len(bc(query_dic))
+        stats = CatalogStats(bc, query_dic)
+        # Counts by review state of the worksheets, in a single pass
+        states = stats.count_by_state()
+        base_states = stats.count_by_state(created=self.base_date_range)
+        numws = stats.count(created=self.date_range)
+        numws += sum([base_states.get(s, 0) for s in active_ws])
 
         # Open worksheets
         review_state = ['open', 'attachment_due']
-        query_dic = {'portal_type':"Worksheet",
-                 'review_state':review_state,
-                   'created':self.base_date_range}
-        if filtering_allowed:
-            query_dic['getDepartmentUIDs'] = { "query":cookie_dep_uid,"operator":"or" }
-        ws = len(bc(query_dic))
+        ws = sum([base_states.get(s, 0) for s in review_state])
         ratio = (float(ws)/float(numws))*100 if ws > 0 and numws > 0 else 0
         ratio = str("%%.%sf" % 1) % ratio
         msg = _("Results pending")
@@ -389,11 +434,7 @@ class DashboardView(BrowserView):
 
         # Worksheets to be verified
         review_state = ['to_be_verified', ]
-        query_dic = {'portal_type':"Worksheet",
-                 'review_state':review_state}
-        if filtering_allowed:
-            query_dic['getDepartmentUIDs'] = { "query":cookie_dep_uid,"operator":"or" }
-        ws = len(bc(query_dic))
+        ws = sum([states.get(s, 0) for s in review_state])
         ratio = (float(ws)/float(numws))*100 if ws > 0 and numws > 0 else 0
         ratio = str("%%.%sf" % 1) % ratio
         msg = _("To be verified")
@@ -408,7 +449,6 @@ class DashboardView(BrowserView):
 
         # Chart with the evolution of WSs over a period, grouped by
         # periodicity
-        workflow = getToolByName(self.context, 'portal_workflow')
         query_dic = {'portal_type':"Worksheet",
                  'sort_on':"created",
                  'created':self.min_date_range}
@@ -417,18 +457,9 @@ class DashboardView(BrowserView):
         allws = bc(query_dic)
         outevo = []
         for ws in allws:
-            ws = ws.getObject()
-            state = 'other_status'
-            try:
-                state = workflow.getInfoFor(ws, 'cancellation_state')
-                if (state == 'active'):
-                    state = workflow.getInfoFor(ws, 'review_state')
-                else:
-                    state = 'inactive'
-            except:
-                pass
-
-            created = self._getDateStr(self.periodicity, ws.created())
+            # from the catalog metadata, without waking the object up
+            state = _brain_state(ws)
+            created = self._getDateStr(self.periodicity, _brain_created(ws))
 
             if (len(outevo) > 0 and outevo[-1]['date'] == created):
                 key = state if _(state) in outevo[-1] else 'other_status'
@@ -456,6 +487,7 @@ class DashboardView(BrowserView):
                 'title': _('Worksheets'),
                 'panels': out}
 
+    @ram.cache(_cache_key_section)
     def get_analyses_section(self):
         """ Returns the section dictionary related with Analyses,
             that contains some informative panels (analyses pending
@@ -476,31 +508,24 @@ class DashboardView(BrowserView):
         filtering_allowed=self.context.bika_setup.getAllowDepartmentFiltering()
         cookie_dep_uid = self.request.get('filter_by_department_info', '').split(',') if filtering_allowed else ''
 
-        query_dic = {'portal_type':"Analysis",
-                 'created':self.date_range,
-                 'cancellation_state':['active']}
-        if filtering_allowed:
-            query_dic['getDepartmentUID'] = { "query":cookie_dep_uid,"operator":"or" }
-        numans = len(bac(query_dic))
-
-        query_dic = {'portal_type':"Analysis",
-                 'created':self.base_date_range,
-                 'review_state':active_rs,
-                 'cancellation_state':['active']}
+        query_dic = {'portal_type': "Analysis"}
         if filtering_allowed:
             query_dic['getDepartmentUID'] = { "query":cookie_dep_uid,"operator":"or" }
-        numans += len(bac(query_dic))
+        stats = CatalogStats(bac, query_dic)
+        # Counts by review state of the analyses, in a single pass
+        states = stats.count_by_state()
+        numans = stats.count(created=self.date_range,
+                             cancellation_state='active')
+        base_states = stats.count_by_state(created=self.base_date_range,
+                                           cancellation_state='active')
+        numans += sum([base_states.get(s, 0) for s in active_rs])
 
         # Analyses pending
         review_state = ['sample_received',
                         'assigned',
                         'attachment_due',
                         'to_be_verified']
-        query_dic = {'portal_type':"Analysis",
-                 'review_state':review_state}
-        if filtering_allowed:
-            query_dic['getDepartmentUID'] = { "query":cookie_dep_uid,"operator":"or" }
-        ans = len(bac(query_dic))
+        ans = sum([states.get(s, 0) for s in review_state])
         ratio = (float(ans)/float(numans))*100 if ans > 0 and numans > 0 else 0
         ratio = str("%%.%sf" % 1) % ratio
         msg = _("Analyses pending")
@@ -515,11 +540,7 @@ class DashboardView(BrowserView):
 
         # Analyses to be verified
         review_state = ['to_be_verified', ]
-        query_dic = {'portal_type':"Analysis",
-                 'review_state':review_state}
-        if filtering_allowed:
-            query_dic['getDepartmentUID'] = { "query":cookie_dep_uid,"operator":"or" }
-        ans = len(bac(query_dic))
+        ans = sum([states.get(s, 0) for s in review_state])
         ratio = (float(ans)/float(numans))*100 if ans > 0 and numans > 0 else 0
         ratio = str("%%.%sf" % 1) % ratio
         msg = _("To be verified")
@@ -534,7 +555,6 @@ class DashboardView(BrowserView):
 
         # Chart with the evolution of WSs over a period, grouped by
         # periodicity
-        workflow = getToolByName(self.context, 'portal_workflow')
         query_dic = {'portal_type':"Analysis",
                  'sort_on':"created",
                  "created":self.min_date_range}
@@ -543,18 +563,9 @@ class DashboardView(BrowserView):
         allans = bac(query_dic)
         outevo = []
         for an in allans:
-            an = an.getObject()
-            state = 'other_status'
-            try:
-                state = workflow.getInfoFor(an, 'cancellation_state')
-                if (state == 'active'):
-                    state = workflow.getInfoFor(an, 'review_state')
-                else:
-                    state = 'inactive'
-            except:
-                pass
-
-            created = self._getDateStr(self.periodicity, an.created())
+            # from the catalog metadata, without waking the object up
+            state = _brain_state(an)
+            created = self._getDateStr(self.periodicity, _brain_created(an))
 
             if (len(outevo) > 0 and outevo[-1]['date'] == created):
                 key = state if _(state) in outevo[-1] else 'other_status'
@@ -9,12 +9,14 @@ from bika.lims import logger
 from bika.lims.permissions import ViewRetractedAnalyses
 from bika.lims.utils import t, dicts_to_dict
 from bika.lims.utils.analysis import create_analysis
+from bika.lims.utils.analysis import invalidate_dependency_graph
 from decimal import Decimal
 from Products.Archetypes.public import *
 from Products.Archetypes.Registry import registerField
 from Products.Archetypes.utils import shasattr
 from Products.CMFCore.utils import getToolByName
 from types import ListType, TupleType, DictType
+import copy
 
 
 class ARAnalysesField(ObjectField):
@@ -77,7 +79,8 @@ class ARAnalysesField(ObjectField):
 
     security.declarePrivate('set')
 
-    def set(self, instance, service_uids, prices=None, specs=None, **kwargs):
+    def set(self, instance, service_uids, prices=None, specs=None,
+            lookups=None, **kwargs):
         """Set the 'Analyses' field value, by creating and removing Analysis
         objects from the AR.
 
@@ -92,6 +95,10 @@ class ARAnalysesField(ObjectField):
         specs is a dictionary:
             key = AnalysisService UID
             value = dictionary: defined in ResultsRange field definition
+
+        lookups is a dictionary shared by the ARs created together (see
+        create_analysisrequests).  The services and their interim fields
+        are kept there, so they are looked up once for all the ARs.
         """
         if not service_uids:
             return
@@ -122,35 +129,29 @@ class ARAnalysesField(ObjectField):
                     s_in_rr = True
             if not s_in_rr:
                 rr.append(s)
-        instance.setResultsRange(rr)
+        instance.setResultsRange(rr, lookups=lookups)
+
+        services = lookups.setdefault('services', {}) \
+            if lookups is not None else {}
+        missing = [uid for uid in service_uids if uid not in services]
+        if missing:
+            for proxy in bsc(UID=missing):
+                service = proxy.getObject()
+                services[service.UID()] = \
+                    (service, self._interim_fields(service))
 
         new_analyses = []
-        proxies = bsc(UID=service_uids)
-        for proxy in proxies:
-            service = proxy.getObject()
-            service_uid = service.UID()
+        for service_uid in service_uids:
+            if service_uid not in services:
+                continue
+            service, interim_fields = services[service_uid]
+            # Each analysis gets its own copy of the interim fields
+            interim_fields = copy.deepcopy(interim_fields)
             keyword = service.getKeyword()
             price = prices[service_uid] if prices and service_uid in prices \
                 else service.getPrice()
             vat = Decimal(service.getVAT())
 
-            # analysis->InterimFields
-            calc = service.getCalculation()
-            interim_fields = calc and list(calc.getInterimFields()) or []
-
-            # override defaults from service->InterimFields
-            service_interims = service.getInterimFields()
-            sif = dict([(x['keyword'], x.get('value', ''))
-                        for x in service_interims])
-            for i, i_f in enumerate(interim_fields):
-                if i_f['keyword'] in sif:
-                    interim_fields[i]['value'] = sif[i_f['keyword']]
-                    service_interims = [x for x in service_interims
-                                        if x['keyword'] != i_f['keyword']]
-            # Add remaining service interims to the analysis
-            for v in service_interims:
-                interim_fields.append(v)
-
             # create the analysis if it doesn't exist
             if shasattr(instance, keyword):
                 analysis = instance._getOb(keyword)
@@ -170,7 +171,7 @@ class ARAnalysesField(ObjectField):
             # analysis.setPrice(price)
 
         # We add rr to the AR after we create all the analyses
-        instance.setResultsRange(rr)
+        instance.setResultsRange(rr, lookups=lookups)
 
         # delete analyses
         delete_ids = []
@@ -191,8 +192,33 @@ class ARAnalysesField(ObjectField):
         if delete_ids:
             # Note: subscriber might promote the AR
             instance.manage_delObjects(ids=delete_ids)
+        if new_analyses or delete_ids:
+            invalidate_dependency_graph(instance)
         return new_analyses
 
+    def _interim_fields(self, service):
+        """Returns the interim fields of the calculation of service, with
+        the defaults overriden by the service's InterimFields, which are
+        added to them
+        """
+        # analysis->InterimFields
+        calc = service.getCalculation()
+        interim_fields = calc and copy.deepcopy(calc.getInterimFields()) or []
+
+        # override defaults from service->InterimFields
+        service_interims = service.getInterimFields()
+        sif = dict([(x['keyword'], x.get('value', ''))
+                    for x in service_interims])
+        for i, i_f in enumerate(interim_fields):
+            if i_f['keyword'] in sif:
+                interim_fields[i]['value'] = sif[i_f['keyword']]
+                service_interims = [x for x in service_interims
+                                    if x['keyword'] != i_f['keyword']]
+        # Add remaining service interims to the analysis
+        for v in service_interims:
+            interim_fields.append(v)
+        return interim_fields
+
     security.declarePublic('Vocabulary')
 
     def Vocabulary(self, content_instance=None):
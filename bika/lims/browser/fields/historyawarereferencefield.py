@@ -9,7 +9,6 @@ from Products.ATExtensions.ateapi import RecordField, RecordsField
 from Products.Archetypes.Registry import registerField
 from Products.Archetypes.public import *
 from Products.CMFCore.utils import getToolByName
-from Products.CMFEditions.ArchivistTool import ArchivistRetrieveError
 from Products.validation import validation
 from Products.validation.validators.RegexValidator import RegexValidator
 import sys
@@ -20,6 +19,7 @@ from bika.lims import bikaMessageFactory as _
 from bika.lims.utils import t
 from bika.lims import logger
 from bika.lims.utils import to_utf8
+from bika.lims.utils.versions import get_version_snapshot
 
 
 class HistoryAwareReferenceField(ReferenceField):
@@ -154,13 +154,7 @@ class HistoryAwareReferenceField(ReferenceField):
                r.version_id is not None:
 
                 version_id = instance.reference_versions[uid]
-                try:
-                    o = pr._retrieve(r,
-                                     selector=version_id,
-                                     preserve=(),
-                                     countPurged=True).object
-                except ArchivistRetrieveError:
-                    o = r
+                o = get_version_snapshot(pr, r, version_id)
             else:
                 o = r
             rd[uid] = o
@@ -17,6 +17,7 @@ from zope.interface import implements
 from bika.lims.browser.bika_listing import BikaListingView
 from bika.lims.config import QCANALYSIS_TYPES
 from bika.lims.utils import to_utf8
+from bika.lims.utils.instruments import get_failed_instruments
 from bika.lims.permissions import *
 from operator import itemgetter
 from bika.lims.browser import BrowserView
@@ -663,44 +664,15 @@ class InstrumentQCFailuresViewlet(ViewletBase):
             Return a dictionary with all info about expired/invalid instruments
 
         """
-        bsc = getToolByName(self, 'bika_setup_catalog')
-        insts = bsc(portal_type='Instrument', inactive_state='active')
-        for i in insts:
-            i = i.getObject()
-            instr = {
-                'uid': i.UID(),
-                'title': i.Title(),
-            }
-            if i.isValidationInProgress():
-                instr['link'] = '<a href="%s/validations">%s</a>' % (
-                    i.absolute_url(), i.Title()
-                )
-                self.nr_failed += 1
-                self.failed['validation'].append(instr)
-            elif i.isCalibrationInProgress():
-                instr['link'] = '<a href="%s/calibrations">%s</a>' % (
-                    i.absolute_url(), i.Title()
-                )
-                self.nr_failed += 1
-                self.failed['calibration'].append(instr)
-            elif i.isOutOfDate():
-                instr['link'] = '<a href="%s/certifications">%s</a>' % (
-                    i.absolute_url(), i.Title()
-                )
-                self.nr_failed += 1
-                self.failed['out-of-date'].append(instr)
-            elif not i.isQCValid():
-                instr['link'] = '<a href="%s/referenceanalyses">%s</a>' % (
-                    i.absolute_url(), i.Title()
-                )
-                self.nr_failed += 1
-                self.failed['qc-fail'].append(instr)
-            elif i.getDisposeUntilNextCalibrationTest():
-                instr['link'] = '<a href="%s/referenceanalyses">%s</a>' % (
-                    i.absolute_url(), i.Title()
-                )
-                self.nr_failed += 1
-                self.failed['next-test'].append(instr)
+        summary = get_failed_instruments(self.context)
+        portal_url = getToolByName(self.context, 'portal_url')()
+        for key, items in summary['failed'].items():
+            self.failed[key] = [
+                dict(item, link='<a href="%s/%s">%s</a>' % (
+                    portal_url, item['path'], item['title']))
+                for item in items]
+        self.nr_failed = summary['nr_failed']
+        return self.failed
 
     def render(self):
 
@@ -708,10 +680,12 @@ class InstrumentQCFailuresViewlet(ViewletBase):
         member = mtool.getAuthenticatedMember()
         roles = member.getRoles()
         allowed = 'LabManager' in roles or 'Manager' in roles
+        if not allowed:
+            return ""
 
         self.get_failed_instruments()
 
-        if allowed and self.nr_failed:
+        if self.nr_failed:
             return self.index()
         else:
             return ""
@@ -15,6 +15,8 @@ from bika.lims.utils import createPdf
 from bika.lims.utils import getUsers, logged_in_client
 from bika.lims.utils import to_unicode as _u
 from bika.lims.utils import to_utf8 as _c
+from bika.lims.utils import to_utf8
+from bika.lims.utils.pdfqueue import DONE, get_job, get_job_status, queue_pdf
 from bika.lims.interfaces import IProductivityReport
 from bika.lims.interfaces import IQualityControlReport
 from bika.lims.interfaces import IAdministrationReport
@@ -28,6 +30,59 @@ import os
 import plone
 
 
+def metadata_columns(brains, columns):
+    """ Columnar pass over catalog results: returns a dict with the list of
+        the values of each column, read from the metadata of the brains.
+        The objects are never woken up.
+    """
+    values = dict([(column, []) for column in columns])
+    for brain in brains:
+        for column in columns:
+            values[column].append(getattr(brain, column, None))
+    return values
+
+
+def published_request_ids(context, request_ids):
+    """ Returns the set of the request ids, amongst the ones passed in, of
+        the published Analysis Requests
+    """
+    request_ids = list(set(request_ids))
+    if not request_ids:
+        return set()
+    bc = getToolByName(context, 'bika_catalog')
+    brains = bc(portal_type='AnalysisRequest',
+                review_state='published',
+                getRequestID=request_ids)
+    return set([brain.getRequestID for brain in brains])
+
+
+def sample_requests(context, sample_ids):
+    """ Returns a dict with the catalog brains of the Analysis Requests of
+        each of the samples whose ids are passed in, keyed by sample id
+    """
+    sample_ids = list(set(sample_ids))
+    if not sample_ids:
+        return {}
+    bc = getToolByName(context, 'bika_catalog')
+    brains = bc(portal_type='AnalysisRequest', getSampleID=sample_ids)
+    requests = {}
+    for brain in brains:
+        requests.setdefault(brain.getSampleID, []).append(brain)
+    return requests
+
+
+def department_titles(context, department_uids):
+    """ Returns a dict with the titles of the departments whose UIDs are
+        passed in
+    """
+    department_uids = [uid for uid in set(department_uids) if uid]
+    if not department_uids:
+        return {}
+    bsc = getToolByName(context, 'bika_setup_catalog')
+    brains = bsc(portal_type='Department', UID=department_uids)
+    return dict([(brain.UID, brain.Title) for brain in brains])
+
+
 class ProductivityView(BrowserView):
     """ Productivity View form
     """
@@ -181,6 +236,15 @@ class ReportHistoryView(BikaListingView):
                 continue
             obj = items[x]['obj']
             obj_url = obj.absolute_url()
+            job = get_job(obj, obj.UID())
+            if job is not None and job['status'] != DONE:
+                # The PDF is not rendered yet
+                items[x]['FileSize'] = self.context.translate(
+                    _(job['status'].capitalize()))
+                items[x]['Created'] = self.ulocalized_time(obj.created())
+                items[x]['By'] = self.user_fullname(obj.Creator())
+                items[x]['Client'] = ''
+                continue
             file = obj.getReportFile()
             icon = file.icon
 
@@ -299,6 +363,9 @@ class SubmitForm(BrowserView):
         self.reportout = output['report_data']
         framed_output = self.frame_template()
 
+        if self.context.bika_setup.getAsyncPDFGeneration():
+            return self.queue_report(framed_output, output, clientuid)
+
         # this is the good part
         result = createPdf(framed_output)
 
@@ -328,6 +395,44 @@ class SubmitForm(BrowserView):
 
         return
 
+    def queue_report(self, framed_output, output, clientuid):
+        """ Creates the Report object and queues the rendering of its PDF.
+            Redirects to the reports history, where the report is listed
+            with the status of the job until the PDF is ready.
+        """
+        # the temporary files are embedded in the html before the rendering
+        framed_output = to_utf8(framed_output)
+        for f in self.request['to_remove']:
+            framed_output = framed_output.replace(
+                f, 'data:image/png;base64,%s' % open(f, 'rb').read().encode(
+                    'base64').replace('\n', ''))
+            os.remove(f)
+
+        reportid = self.aq_parent.generateUniqueId('Report')
+        report = _createObjectByType("Report", self.aq_parent, reportid)
+        report.edit(Client=clientuid)
+        report.processForm()
+        report.edit(title=output['report_title'])
+        report.reindexObject()
+        queue_pdf(report, framed_output, 'ReportFile')
+
+        message = _("The report is being generated. It will be available "
+                    "in the reports history in a few moments")
+        self.context.plone_utils.addPortalMessage(message, 'info')
+        self.request.RESPONSE.redirect(
+            self.aq_parent.absolute_url() + '/history')
+
+
+class PDFJobStatus(BrowserView):
+    """ Returns the status of the PDF job of the object with the UID passed
+        in the request, in JSON, for polling
+    """
+
+    def __call__(self):
+        uid = self.request.get('uid', '')
+        self.request.RESPONSE.setHeader('Content-Type', 'application/json')
+        return json.dumps(get_job_status(self.context, uid))
+
 
 class ReferenceAnalysisQC_Samples(BrowserView):
     def __call__(self):
@@ -3,10 +3,12 @@
 # Copyright 2011-2016 by it's authors.
 # Some rights reserved. See LICENSE.txt, AUTHORS.txt.
 
-from Products.CMFCore.utils import getToolByName
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
 from bika.lims import bikaMessageFactory as _
 from bika.lims.browser import BrowserView
+from bika.lims.browser.reports import department_titles
+from bika.lims.browser.reports import metadata_columns
+from bika.lims.browser.reports import published_request_ids
 from bika.lims.browser.reports.selection_macros import SelectionMacrosView
 from plone.app.layout.globals.interfaces import IViewView
 from zope.interface import implements
@@ -63,12 +65,18 @@ class Report(BrowserView):
         totalcount = len(analyses)
         totalpublishedcount = 0
         totalperformedcount = 0
-        for analysis in analyses:
-            analysis = analysis.getObject()
-            analysisservice = analysis.getService()
-            department = analysisservice.getDepartment()
-            department = department.Title() if department else ''
-            daterequested = analysis.created()
+        columns = metadata_columns(analyses, ['getDepartmentUID',
+                                              'created',
+                                              'getRequestID',
+                                              'getResult'])
+        published = published_request_ids(self.context,
+                                           columns['getRequestID'])
+        departments = department_titles(self.context,
+                                         columns['getDepartmentUID'])
+        for department_uid, daterequested, request_id, result in zip(
+                columns['getDepartmentUID'], columns['created'],
+                columns['getRequestID'], columns['getResult']):
+            department = departments.get(department_uid, '')
 
             group = ''
             if groupby == 'Day':
@@ -101,14 +109,12 @@ class Report(BrowserView):
             deptperformedcount = deptline['Performed']
             deptpubishedcount = deptline['Published']
 
-            workflow = getToolByName(self.context, 'portal_workflow')
-            arstate = workflow.getInfoFor(analysis.aq_parent, 'review_state', '')
-            if (arstate == 'published'):
+            if (request_id in published):
                 deptpubishedcount += 1
                 grouppublishedcount += 1
                 totalpublishedcount += 1
 
-            if (analysis.getResult()):
+            if (result):
                 deptperformedcount += 1
                 groupperformedcount += 1
                 totalperformedcount += 1
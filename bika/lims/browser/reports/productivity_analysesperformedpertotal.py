@@ -3,10 +3,11 @@
 # Copyright 2011-2016 by it's authors.
 # Some rights reserved. See LICENSE.txt, AUTHORS.txt.
 
-from Products.CMFCore.utils import getToolByName
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
 from bika.lims import bikaMessageFactory as _
 from bika.lims.browser import BrowserView
+from bika.lims.browser.reports import metadata_columns
+from bika.lims.browser.reports import published_request_ids
 from bika.lims.browser.reports.selection_macros import SelectionMacrosView
 from plone.app.layout.globals.interfaces import IViewView
 from zope.interface import implements
@@ -54,11 +55,17 @@ class Report(BrowserView):
         totalcount = len(analyses)
         totalpublishedcount = 0
         totalperformedcount = 0
-        for analysis in analyses:
-            analysis = analysis.getObject()
-            ankeyword = analysis.getKeyword()
-            antitle = analysis.getServiceTitle()
-            daterequested = analysis.created()
+        columns = metadata_columns(analyses, ['getKeyword',
+                                              'getServiceTitle',
+                                              'created',
+                                              'getRequestID',
+                                              'getResult'])
+        published = published_request_ids(self.context,
+                                           columns['getRequestID'])
+        for ankeyword, antitle, daterequested, request_id, result in zip(
+                columns['getKeyword'], columns['getServiceTitle'],
+                columns['created'], columns['getRequestID'],
+                columns['getResult']):
 
             group = ''
             if groupby == 'Day':
@@ -91,14 +98,12 @@ class Report(BrowserView):
             anlperformedcount = anline['Performed']
             anlpublishedcount = anline['Published']
 
-            workflow = getToolByName(self.context, 'portal_workflow')
-            arstate = workflow.getInfoFor(analysis.aq_parent, 'review_state', '')
-            if (arstate == 'published'):
+            if (request_id in published):
                 anlpublishedcount += 1
                 grouppublishedcount += 1
                 totalpublishedcount += 1
 
-            if (analysis.getResult()):
+            if (result):
                 anlperformedcount += 1
                 groupperformedcount += 1
                 totalperformedcount += 1
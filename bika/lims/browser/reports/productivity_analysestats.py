@@ -5,6 +5,7 @@
 
 from Products.CMFCore.utils import getToolByName
 from bika.lims.browser import BrowserView
+from bika.lims.browser.reports import metadata_columns
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
 from bika.lims import bikaMessageFactory as _
 from bika.lims.utils import t
@@ -82,9 +83,9 @@ class Report(BrowserView):
         services = {}
 
         analyses = bc(query)
-        for a in analyses:
-            analysis = a.getObject()
-            service_uid = analysis.getServiceUID()
+        columns = metadata_columns(analyses, ['getServiceUID', 'getEarliness'])
+        for service_uid, earliness in zip(columns['getServiceUID'],
+                                          columns['getEarliness']):
             if service_uid not in services:
                 services[service_uid] = {'count_early': 0,
                                          'count_late': 0,
@@ -92,7 +93,6 @@ class Report(BrowserView):
                                          'mins_late': 0,
                                          'count_undefined': 0,
                 }
-            earliness = analysis.getEarliness()
             if earliness < 0:
                 count_late = services[service_uid]['count_late']
                 mins_late = services[service_uid]['mins_late']
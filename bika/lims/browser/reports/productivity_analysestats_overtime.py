@@ -5,6 +5,7 @@
 
 from Products.CMFCore.utils import getToolByName
 from bika.lims.browser import BrowserView
+from bika.lims.browser.reports import metadata_columns
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
 from bika.lims import bikaMessageFactory as _
 from bika.lims.utils import t
@@ -87,9 +88,9 @@ class Report(BrowserView):
         total_duration = 0
 
         analyses = bc(query)
-        for a in analyses:
-            analysis = a.getObject()
-            received = analysis.created()
+        columns = metadata_columns(analyses, ['created', 'getDuration'])
+        for received, analysis_duration in zip(columns['created'],
+                                               columns['getDuration']):
             if period == 'Day':
                 datekey = received.strftime('%d %b %Y')
             elif period == 'Week':
@@ -109,7 +110,7 @@ class Report(BrowserView):
             count = periods[datekey]['count']
             duration = periods[datekey]['duration']
             count += 1
-            duration += analysis.getDuration()
+            duration += analysis_duration
             periods[datekey]['duration'] = duration
             periods[datekey]['count'] = count
             total_count += 1
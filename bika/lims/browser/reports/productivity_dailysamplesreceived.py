@@ -6,7 +6,10 @@
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
 from bika.lims import bikaMessageFactory as _
 from bika.lims.browser import BrowserView
+from bika.lims.browser.reports import metadata_columns
+from bika.lims.browser.reports import sample_requests
 from bika.lims.browser.reports.selection_macros import SelectionMacrosView
+from bika.lims.permissions import ViewRetractedAnalyses
 from plone.app.layout.globals.interfaces import IViewView
 from zope.interface import implements
 
@@ -49,26 +52,43 @@ class Report(BrowserView):
 
         datalines = []
         analyses_count = 0
-        for sample in samples:
-            sample = sample.getObject()
-
+        columns = metadata_columns(samples, ['getSampleID',
+                                             'getSampleTypeTitle',
+                                             'getDateReceived',
+                                             'getSamplingDate'])
+        requests = sample_requests(self.context, columns['getSampleID'])
+        request_ids = [brain.getRequestID for brains in requests.values()
+                       for brain in brains]
+        # The analyses of all the samples, by request id, in one query
+        analyses = {}
+        if request_ids:
+            retracted = self.portal_membership.checkPermission(
+                ViewRetractedAnalyses, self.context)
+            for analysis in self.bika_analysis_catalog(
+                    portal_type='Analysis', getRequestID=request_ids,
+                    sort_on='sortable_title'):
+                if not retracted and analysis.review_state == 'retracted':
+                    continue
+                analyses.setdefault(analysis.getRequestID, []).append(
+                    analysis)
+        for sample_id, sampletype, datereceived, sd in zip(
+                columns['getSampleID'], columns['getSampleTypeTitle'],
+                columns['getDateReceived'], columns['getSamplingDate']):
             # For each sample, retrieve the analyses and generate
             # a data line for each one
-            analyses = sample.getAnalyses({})
-            for analysis in analyses:
-                analysis = analysis.getObject()
-                sd = sample.getSamplingDate()
-                dataline = {'AnalysisKeyword': analysis.getKeyword(),
-                            'AnalysisTitle': analysis.getServiceTitle(),
-                            'SampleID': sample.getSampleID(),
-                            'SampleType': sample.getSampleType().Title(),
-                            'SampleDateReceived': self.ulocalized_time(
-                                sample.getDateReceived(), long_format=1),
-                            'SampleSamplingDate': self.ulocalized_time(
-                                sd, long_format=1) if sd else ''
-                            }
-                datalines.append(dataline)
-                analyses_count += 1
+            for request in requests.get(sample_id, []):
+                for analysis in analyses.get(request.getRequestID, []):
+                    dataline = {'AnalysisKeyword': analysis.getKeyword,
+                                'AnalysisTitle': analysis.getServiceTitle,
+                                'SampleID': sample_id,
+                                'SampleType': sampletype,
+                                'SampleDateReceived': self.ulocalized_time(
+                                    datereceived, long_format=1),
+                                'SampleSamplingDate': self.ulocalized_time(
+                                    sd, long_format=1) if sd else ''
+                                }
+                    datalines.append(dataline)
+                    analyses_count += 1
 
         # Footer total data
         footlines = []
@@ -6,6 +6,8 @@
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
 from bika.lims import bikaMessageFactory as _
 from bika.lims.browser import BrowserView
+from bika.lims.browser.reports import metadata_columns
+from bika.lims.browser.reports import sample_requests
 from bika.lims.browser.reports.selection_macros import SelectionMacrosView
 from plone.app.layout.globals.interfaces import IViewView
 from zope.interface import implements
@@ -55,20 +57,19 @@ class Report(BrowserView):
         footlines = {}
         total_received_count = 0
         total_published_count = 0
-        for sample in samples:
-            sample = sample.getObject()
-
-            # For each sample, retrieve check is has results published
+        columns = metadata_columns(samples, ['getSampleID',
+                                             'getDateReceived'])
+        requests = sample_requests(self.context, columns['getSampleID'])
+        for sample_id, datereceived in zip(columns['getSampleID'],
+                                           columns['getDateReceived']):
+            # For each sample, check if any of its ARs has been published
             # and add it to datalines
             published = False
-            analyses = sample.getAnalyses({})
-            for analysis in analyses:
-                analysis = analysis.getObject()
-                if not (analysis.getDateAnalysisPublished() is None):
+            for request in requests.get(sample_id, []):
+                if request.getDatePublished:
                     published = True
                     break
 
-            datereceived = sample.getDateReceived()
             monthyear = datereceived.strftime("%B") + " " + datereceived.strftime(
                 "%Y")
             received = 1
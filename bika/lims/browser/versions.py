@@ -0,0 +1,19 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from bika.lims.browser import BrowserView
+from bika.lims.utils.versions import snapshot_cache_stats
+import json
+
+
+class SnapshotCacheStatsView(BrowserView):
+    """ Returns, in JSON, the stats of the caches of the historical versions
+    of objects (see bika.lims.utils.versions), summed up over all the ZODB
+    connections of this process
+    """
+
+    def __call__(self):
+        self.request.RESPONSE.setHeader('Content-Type', 'application/json')
+        return json.dumps(snapshot_cache_stats())
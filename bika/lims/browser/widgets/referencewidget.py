@@ -79,16 +79,18 @@ class ReferenceWidget(StringWidget):
 
     def process_form(self, instance, field, form, empty_marker=None,
                      emptyReturnsMarker=False):
-        """Return a UID so that ReferenceField understands.
+        """Return a UID so that ReferenceField understands.  The UIDs of
+        multiValued fields are comma separated in the form, or a list when
+        the values are passed in by code (e.g. create_analysisrequest).
         """
         fieldName = field.getName()
         if fieldName + "_uid" in form:
             uid = form.get(fieldName + "_uid", '')
-            if field.multiValued:
+            if field.multiValued and isinstance(uid, basestring):
                 uid = uid.split(",")
         elif fieldName in form:
             uid = form.get(fieldName, '')
-            if field.multiValued:
+            if field.multiValued and isinstance(uid, basestring):
                 uid = uid.split(",")
         else:
             uid = None
@@ -109,13 +109,15 @@ class WorksheetWorkflowAction(WorkflowAction):
             selected_analysis_uids = selected_analyses.keys()
 
             if selected_analyses:
+                analyses = []
                 for uid in selected_analysis_uids:
                     analysis = rc.lookupObject(uid)
                     # Double-check the state first
                     if (workflow.getInfoFor(analysis, 'worksheetanalysis_review_state') == 'unassigned'
                     and workflow.getInfoFor(analysis, 'review_state') == 'sample_received'
                     and workflow.getInfoFor(analysis, 'cancellation_state') == 'active'):
-                        self.context.addAnalysis(analysis)
+                        analyses.append(analysis)
+                self.context.addAnalyses(analyses)
 
             self.destination_url = self.context.absolute_url()
             self.request.response.redirect(self.destination_url)
@@ -41,16 +41,19 @@ from bika.lims.content.bikaschema import BikaSchema
 from bika.lims.interfaces import IAnalysis, IDuplicateAnalysis, IReferenceAnalysis, \
     IRoutineAnalysis, ISamplePrepWorkflow
 from bika.lims.interfaces import IReferenceSample
+from bika.lims.interfaces import IAnalysisRequest
 from bika.lims.utils import changeWorkflowState, formatDecimalMark
 from bika.lims.utils import drop_trailing_zeros_decimal
 from bika.lims.utils.analysis import get_significant_digits
+from bika.lims.utils.analysis import get_dependency_graph
+from bika.lims.utils.analysis import invalidate_dependency_graph
+from bika.lims.utils.formula import get_compiled_formula
 from bika.lims.workflow import skip
 from bika.lims.workflow import doActionFor
 from decimal import Decimal
 from zope.interface import implements
 import cgi
 import datetime
-import math
 
 @indexer(IAnalysis)
 def Priority(instance):
@@ -452,10 +455,22 @@ class Analysis(BaseContent):
         return self.isAboveUpperDetectionLimit() and \
                 self.getDetectionLimitOperand() == '>'
 
+    def _getDependencyGraph(self):
+        """ Returns the request-scoped dependency graph of the AR this
+            analysis belongs to, or None if not available
+        """
+        ar = self.aq_parent
+        if not IAnalysisRequest.providedBy(ar):
+            return None
+        return get_dependency_graph(ar)
+
     def getDependents(self):
         """ Return a list of analyses who depend on us
             to calculate their result
         """
+        graph = self._getDependencyGraph()
+        if graph is not None:
+            return graph.getDependents(self)
         rc = getToolByName(self, REFERENCE_CATALOG)
         dependents = []
         service = self.getService()
@@ -477,6 +492,9 @@ class Analysis(BaseContent):
         """ Return a list of analyses who we depend on
             to calculate our result.
         """
+        graph = self._getDependencyGraph()
+        if graph is not None:
+            return graph.getDependencies(self)
         siblings = self.aq_parent.getAnalyses(full_objects=True)
         calculation = self.getService().getCalculation()
         if not calculation:
@@ -709,15 +727,9 @@ class Analysis(BaseContent):
                     return False
 
         # Calculate
-        formula = calc.getMinifiedFormula()
-        formula = formula.replace('[', '%(').replace(']', ')f')
+        formula = get_compiled_formula(calc)
         try:
-            formula = eval("'%s'%%mapping" % formula,
-                               {"__builtins__": None,
-                                'math': math,
-                                'context': self},
-                               {'mapping': mapping})
-            result = eval(formula)
+            result = formula(mapping, context=self)
         except TypeError:
             self.setResult("NA")
             return True
@@ -1364,6 +1376,8 @@ class Analysis(BaseContent):
         # zope.event.notify(ObjectInitializedEvent(analysis))
         changeWorkflowState(analysis,
                             "bika_analysis_workflow", "sample_received")
+        # The AR has a new analysis, so its dependency graph is outdated
+        invalidate_dependency_graph(parent)
         if ws:
             ws.addAnalysis(analysis)
         analysis.reindexObject()
@@ -5,6 +5,7 @@
 
 """The request for analysis by a client. It contains analysis instances.
 """
+import copy
 import logging
 from operator import methodcaller
 
@@ -43,6 +44,8 @@ from zope.interface import implements
 from bika.lims import bikaMessageFactory as _
 from bika.lims.utils import getUsers, dicts_to_dict
 from bika.lims.utils.analysisrequest import notify_rejection
+from bika.lims.utils.resultshistory import index_request_results
+from bika.lims.utils.resultshistory import unindex_request_results
 
 from bika.lims.browser.fields import DateTimeField
 from bika.lims.browser.widgets import SelectionWidget as BikaSelectionWidget
@@ -1764,6 +1767,18 @@ class AnalysisRequest(BaseFolder):
         else:
             return self.Schema()['Batch'].get(self)
 
+    def setBatch(self, value=None, **kwargs):
+        """Sets the Batch of the AR, and moves the results of the AR from
+        the results history of the previous Batch to the one of the new
+        """
+        field = self.Schema()['Batch']
+        old = field.get(self)
+        field.set(self, value, **kwargs)
+        new = field.get(self)
+        if (old and old.UID()) != (new and new.UID()):
+            unindex_request_results(self, old)
+            index_request_results(self, new)
+
     def getDefaultMemberDiscount(self):
         """ compute default member discount if it applies """
         if hasattr(self, 'getMemberDiscountApplies'):
@@ -2345,7 +2360,7 @@ class AnalysisRequest(BaseFolder):
         else:
             return ''
 
-    def setResultsRange(self, value=None):
+    def setResultsRange(self, value=None, lookups=None):
         """Sets the spec values for this AR.
         1 - Client specs where (spec.Title) matches (ar.SampleType.Title)
         2 - Lab specs where (spec.Title) matches (ar.SampleType.Title)
@@ -2361,6 +2376,10 @@ class AnalysisRequest(BaseFolder):
         and "error" fields.
 
         Value will be stored in ResultsRange field as list of dictionaries
+
+        lookups is a dictionary shared by the ARs created together (see
+        create_analysisrequests), where the client and lab specs found are
+        kept, so they are searched for once per sample type.
         """
         rr = {}
         sample = self.getSample()
@@ -2368,17 +2387,22 @@ class AnalysisRequest(BaseFolder):
             # portal_factory
             return []
         stt = self.getSample().getSampleType().Title()
-        bsc = getToolByName(self, 'bika_setup_catalog')
-        # 1 or 2: rr = Client specs where (spec.Title) matches (
-        # ar.SampleType.Title)
-        for folder in self.aq_parent, self.bika_setup.bika_analysisspecs:
-            proxies = bsc(portal_type='AnalysisSpec',
-                          getSampleTypeTitle=stt,
-                          ClientUID=folder.UID())
-            if proxies:
-                rr = dicts_to_dict(proxies[0].getObject().getResultsRange(),
-                                   'keyword')
-                break
+        specs = lookups.setdefault('specs', {}) if lookups is not None else {}
+        key = (self.aq_parent.UID(), stt)
+        if key not in specs:
+            bsc = getToolByName(self, 'bika_setup_catalog')
+            # 1 or 2: rr = Client specs where (spec.Title) matches (
+            # ar.SampleType.Title)
+            specs[key] = []
+            for folder in self.aq_parent, self.bika_setup.bika_analysisspecs:
+                proxies = bsc(portal_type='AnalysisSpec',
+                              getSampleTypeTitle=stt,
+                              ClientUID=folder.UID())
+                if proxies:
+                    specs[key] = proxies[0].getObject().getResultsRange()
+                    break
+        # The ranges are modified in place when the analyses are set
+        rr = dicts_to_dict(copy.deepcopy(specs[key]), 'keyword')
         # 3: rr += override values from instance.Specification
         ar_spec = self.getSpecification()
         if ar_spec:
@@ -6,7 +6,6 @@
 from AccessControl import ClassSecurityInfo
 import csv
 from DateTime.DateTime import DateTime
-from Products.Archetypes.event import ObjectInitializedEvent
 from Products.CMFCore.WorkflowCore import WorkflowException
 from bika.lims import bikaMessageFactory as _
 from bika.lims.browser import ulocalized_time
@@ -17,6 +16,8 @@ from bika.lims.content.sample import schema as sample_schema
 from bika.lims.idserver import renameAfterCreation
 from bika.lims.interfaces import IARImport, IClient
 from bika.lims.utils import tmpID
+from bika.lims.utils.analysisrequest import create_analysisrequests
+from bika.lims.utils.arimportqueue import queue_arimport
 from bika.lims.vocabularies import CatalogVocabulary
 from collective.progressbar.events import InitialiseProgressBar
 from collective.progressbar.events import ProgressBar
@@ -35,7 +36,6 @@ from Products.DataGridField import DataGridWidget
 from Products.DataGridField import DateColumn
 from Products.DataGridField import LinesColumn
 from Products.DataGridField import SelectColumn
-from zope import event
 from zope.event import notify
 from zope.i18nmessageid import MessageFactory
 from zope.interface import implements
@@ -210,6 +210,25 @@ Errors = LinesField(
     )
 )
 
+ImportStatus = StringField(
+    'ImportStatus',
+    widget=StringWidget(
+        label=_('Import status'),
+        description=_('Status of the import running in the background'),
+        visible={'edit': 'invisible', 'view': 'visible'},
+    ),
+)
+
+ImportedRows = IntegerField(
+    'ImportedRows',
+    default=0,
+    widget=IntegerWidget(
+        label=_('Imported rows'),
+        description=_('Number of sample rows imported so far'),
+        visible={'edit': 'invisible', 'view': 'visible'},
+    ),
+)
+
 schema = BikaSchema.copy() + Schema((
     OriginalFile,
     Filename,
@@ -223,6 +242,8 @@ schema = BikaSchema.copy() + Schema((
     Batch,
     SampleData,
     Errors,
+    ImportStatus,
+    ImportedRows,
 ))
 
 schema['title'].validators = ()
@@ -281,99 +302,104 @@ class ARImport(BaseFolder):
             workflow.doActionFor(self, 'validate')
 
     def workflow_script_import(self):
-        """Create objects from valid ARImport
+        """Create objects from valid ARImport.  If ARImportBatchSize is set
+        in Bika Setup, the rows are imported in the background instead (see
+        bika.lims.utils.arimportqueue).
         """
-        bsc = getToolByName(self, 'bika_setup_catalog')
-        workflow = getToolByName(self, 'portal_workflow')
-        client = self.aq_parent
+        if self.bika_setup.getARImportBatchSize():
+            queue_arimport(self)
+            self.REQUEST.response.write(
+                '<script>document.location.href="%s"</script>' % (
+                    self.absolute_url()))
+            return
 
         title = _('Submitting AR Import')
         description = _('Creating and initialising objects')
         bar = ProgressBar(self, self.REQUEST, title, description)
         notify(InitialiseProgressBar(bar))
 
-        profiles = [x.getObject() for x in bsc(portal_type='AnalysisProfile')]
-
         gridrows = self.schema['SampleData'].get(self)
-        row_cnt = 0
-        for therow in gridrows:
-            row = therow.copy()
-            row_cnt += 1
-            # Create Sample
-            sample = _createObjectByType('Sample', client, tmpID())
-            sample.unmarkCreationFlag()
-            # First convert all row values into something the field can take
-            sample.edit(**row)
-            sample._renameAfterCreation()
-            event.notify(ObjectInitializedEvent(sample))
-            sample.at_post_create_script()
-            swe = self.bika_setup.getSamplingWorkflowEnabled()
-            if swe:
-                workflow.doActionFor(sample, 'sampling_workflow')
-            else:
-                workflow.doActionFor(sample, 'no_sampling_workflow')
-            part = _createObjectByType('SamplePartition', sample, 'part-1')
-            part.unmarkCreationFlag()
-            if swe:
-                workflow.doActionFor(part, 'sampling_workflow')
-            else:
-                workflow.doActionFor(part, 'no_sampling_workflow')
-            # Container is special... it could be a containertype.
-            container = self.get_row_container(row)
-            if container:
-                if container.portal_type == 'ContainerType':
-                    containers = container.getContainers()
-                # XXX And so we must calculate the best container for this partition
-                part.edit(Container=containers[0])
-
-            # Profiles are titles, profile keys, or UIDS: convert them to UIDs.
-            newprofiles = []
-            for title in row['Profiles']:
-                objects = [x for x in profiles
-                           if title in (x.getProfileKey(), x.UID(), x.Title())]
-                for obj in objects:
-                    newprofiles.append(obj.UID())
-            row['Profiles'] = newprofiles
-
-            # BBB in bika.lims < 3.1.9, only one profile is permitted
-            # on an AR.  The services are all added, but only first selected
-            # profile name is stored.
-            row['Profile'] = newprofiles[0] if newprofiles else None
-
-            # Same for analyses
-            newanalyses = set(self.get_row_services(row) +
-                              self.get_row_profile_services(row))
-            row['Analyses'] = []
-            # get batch
-            batch = self.schema['Batch'].get(self)
-            if batch:
-                row['Batch'] = batch
-            # Add AR fields from schema into this row's data
-            row['ClientReference'] = self.getClientReference()
-            row['ClientOrderNumber'] = self.getClientOrderNumber()
-            row['Contact'] = self.getContact()
-            # Create AR
-            ar = _createObjectByType("AnalysisRequest", client, tmpID())
-            ar.setSample(sample)
-            ar.unmarkCreationFlag()
-            ar.edit(**row)
-            ar._renameAfterCreation()
-            ar.setAnalyses(list(newanalyses))
-            for analysis in ar.getAnalyses(full_objects=True):
-                analysis.setSamplePartition(part)
-            ar.at_post_create_script()
-            if swe:
-                workflow.doActionFor(ar, 'sampling_workflow')
-            else:
-                workflow.doActionFor(ar, 'no_sampling_workflow')
+
+        def progress(row_cnt):
             progress_index = float(row_cnt) / len(gridrows) * 100
             progress = ProgressState(self.REQUEST, progress_index)
             notify(UpdateProgressEvent(progress))
+
+        self.import_rows(progress=progress)
+        self.setImportedRows(len(gridrows))
         # document has been written to, and redirect() fails here
         self.REQUEST.response.write(
             '<script>document.location.href="%s"</script>' % (
                 self.absolute_url()))
 
+    def import_rows(self, start=0, stop=None, progress=None):
+        """Creates the Samples and ARs of the rows of SampleData from start
+        to stop, in one batch (see create_analysisrequests).  progress is
+        called with the number of the row after each row is imported.
+        """
+        bsc = getToolByName(self, 'bika_setup_catalog')
+        profiles = [x.getObject() for x in bsc(portal_type='AnalysisProfile')]
+
+        gridrows = self.schema['SampleData'].get(self)[start:stop]
+        values_list = [self.get_row_values(row, profiles) for row in gridrows]
+
+        def ar_created(count):
+            if progress:
+                progress(start + count)
+
+        ars = create_analysisrequests(self.aq_parent, self.REQUEST,
+                                      values_list, progress=ar_created)
+
+        # Container is special... it could be a containertype.
+        containers = {}
+        for row, ar in zip(gridrows, ars):
+            uid = row.get('Container', False)
+            if not uid:
+                continue
+            if uid not in containers:
+                container = self.get_row_container(row)
+                if container and container.portal_type == 'ContainerType':
+                    # XXX And so we must calculate the best container for
+                    # this partition
+                    container = container.getContainers()
+                    container = container[0] if container else None
+                containers[uid] = container
+            if containers[uid]:
+                for part in ar.getSample().objectValues('SamplePartition'):
+                    part.edit(Container=containers[uid])
+
+    def get_row_values(self, therow, profiles):
+        """Returns the values of the Sample and the AR of a row of SampleData
+        """
+        row = therow.copy()
+        # Profiles are titles, profile keys, or UIDS: convert them to UIDs.
+        newprofiles = []
+        for title in row['Profiles']:
+            objects = [x for x in profiles
+                       if title in (x.getProfileKey(), x.UID(), x.Title())]
+            for obj in objects:
+                newprofiles.append(obj.UID())
+        row['Profiles'] = newprofiles
+
+        # BBB in bika.lims < 3.1.9, only one profile is permitted
+        # on an AR.  The services are all added, but only first selected
+        # profile name is stored.
+        row['Profile'] = newprofiles[0] if newprofiles else None
+
+        # Same for analyses
+        newanalyses = set(self.get_row_services(therow) +
+                          self.get_row_profile_services(therow))
+        row['Analyses'] = list(newanalyses)
+        # get batch
+        batch = self.schema['Batch'].get(self)
+        if batch:
+            row['Batch'] = batch
+        # Add AR fields from schema into this row's data
+        row['ClientReference'] = self.getClientReference()
+        row['ClientOrderNumber'] = self.getClientOrderNumber()
+        row['Contact'] = self.getContact()
+        return row
+
     def get_header_values(self):
         """Scrape the "Header" values from the original input file
         """
@@ -35,6 +35,16 @@ schema = BikaSchema.copy() + Schema((
         subfields=('UID', 'Username', 'Fullname', 'EmailAddress',
                    'PublicationModes'),
     ),
+    # Delivery status of the emails of the report, by recipient (see
+    # bika.lims.utils.mailqueue)
+    RecordsField('Delivery',
+        type='delivery',
+        subfields=('EmailAddress', 'Status', 'Attempts', 'Date', 'Error'),
+    ),
+    # Id of the publication job that created the report (see
+    # bika.lims.utils.publishqueue)
+    StringField('PublicationJob',
+    ),
 ))
 
 schema['id'].required = False
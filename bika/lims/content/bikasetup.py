@@ -247,6 +247,18 @@ schema = BikaFolderSchema.copy() + Schema((
                 "will be calculated and plotted"),
         )
     ),
+    BooleanField(
+        'AsyncPDFGeneration',
+        schemata="Results Reports",
+        default=False,
+        widget=BooleanWidget(
+            label=_("Generate PDF reports in the background"),
+            description=_(
+                "Select this to render the PDF of the reports in a separate "
+                "process. The reports are listed in the reports history "
+                "once generated, instead of being downloaded at once")
+        ),
+    ),
     BooleanField(
         'IncludePreviousFromBatch',
         schemata="Results Reports",
@@ -465,6 +477,18 @@ schema = BikaFolderSchema.copy() + Schema((
                 "are used to select multiple analysis services together"),
         )
     ),
+    IntegerField(
+        'ARImportBatchSize',
+        schemata="Analyses",
+        default=0,
+        widget=IntegerWidget(
+            label=_("AR Import batch size"),
+            description=_(
+                "Number of rows of an AR Import created per transaction, in "
+                "the background. Set to 0 to create all the rows at once, "
+                "while the user waits"),
+        )
+    ),
     StringField(
         'ARAttachmentOption',
         schemata="Analyses",
@@ -553,6 +577,18 @@ schema = BikaFolderSchema.copy() + Schema((
             description=_("Select this to activate the dashboard as a default front page.")
         ),
     ),
+    IntegerField(
+        'DashboardCacheInterval',
+        schemata="Analyses",
+        required=1,
+        default=60,
+        widget=IntegerWidget(
+            label=_("Dashboard cache interval"),
+            description=_(
+                "The number of seconds the figures of the dashboard are "
+                "cached for. 0 disables the cache"),
+        )
+    ),
     ReferenceField(
         'LandingPage',
         schemata="Analyses",
@@ -707,7 +743,9 @@ schema = BikaFolderSchema.copy() + Schema((
         schemata="ID Server",
         widget=StringWidget(
             label=_("ID Server URL"),
-            description=_("The full URL: http://URL/path:port")
+            description=_("The full URL: http://URL/path:port. Leave "
+                          "empty to allocate the IDs in blocks from the "
+                          "database shared by all the Zope clients")
         ),
     ),
     RecordsField(
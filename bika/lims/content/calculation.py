@@ -14,6 +14,7 @@ from bika.lims.config import PROJECTNAME
 from bika.lims.content.bikaschema import BikaSchema
 from bika.lims.interfaces import ICalculation
 from bika.lims.utils import to_utf8
+from bika.lims.utils.analysis import invalidate_dependency_caches
 from Products.Archetypes.public import *
 from Products.Archetypes.references import HoldingReference
 from Products.ATContentTypes.lib.historyaware import HistoryAwareMixin
@@ -127,6 +128,7 @@ class Calculation(BaseFolder, HistoryAwareMixin):
 
             self.getField('DependentServices').set(self, DependentServices)
             self.getField('Formula').set(self, Formula)
+        invalidate_dependency_caches(self)
 
     def getMinifiedFormula(self):
         """Return the current formula value as text.
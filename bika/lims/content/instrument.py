@@ -4,9 +4,11 @@
 # Some rights reserved. See LICENSE.txt, AUTHORS.txt.
 
 from AccessControl import ClassSecurityInfo
+from Acquisition import aq_base
 from Products.ATContentTypes.content import schemata
 from Products.ATExtensions.ateapi import RecordsField
 from Products.Archetypes.atapi import *
+from Products.Archetypes.config import REFERENCE_CATALOG
 from Products.Archetypes.references import HoldingReference
 from Products.CMFCore.permissions import View, ModifyPortalContent
 from Products.CMFCore.utils import getToolByName
@@ -19,6 +21,7 @@ from bika.lims.browser.widgets import RecordsWidget
 from bika.lims.config import PROJECTNAME
 from bika.lims.content.bikaschema import BikaSchema, BikaFolderSchema
 from bika.lims.interfaces import IInstrument
+from bika.lims.utils.instruments import invalidate_failed_instruments
 from bika.lims.utils import to_utf8
 from plone.app.folder.folder import ATFolder
 from zope.interface import implements
@@ -158,8 +161,8 @@ schema = BikaFolderSchema.copy() + BikaSchema.copy() + Schema((
         ),
     ),
 
-    # Private method. Use getLatestReferenceAnalyses() instead.
-    # See getLatestReferenceAnalyses() method for further info.
+    # BBB: no longer used.  The latest reference analyses are kept in the
+    # QC status of the instrument, see updateQCStatus()
     ReferenceField('_LatestReferenceAnalyses',
         required = 0,
         multiValued = 1,
@@ -398,6 +401,13 @@ class Instrument(ATFolder):
                 certs.append(c)
         return certs
 
+    def setDisposeUntilNextCalibrationTest(self, value, **kw):
+        field = self.getField('DisposeUntilNextCalibrationTest')
+        previous = field.get(self)
+        field.set(self, value, **kw)
+        if bool(field.get(self)) != bool(previous):
+            invalidate_failed_instruments(self)
+
     def isValid(self):
         """ Returns if the current instrument is not out for verification, calibration,
         out-of-date regards to its certificates and if the latest QC succeed
@@ -415,104 +425,177 @@ class Instrument(ATFolder):
             Duplicate Analyses and Regular Analyses are not included.
             Only contains the last ReferenceAnalysis done for this
             instrument, Analysis Service and Reference type (blank or control).
-            The list is created 'on-fly' if the method hasn't been already
-            called or a new ReferenceAnalysis has been added by using
-            addReferences() since its last call. Otherwise, uses the
-            private accessor _LatestReferenceAnalyses as a cache
-            (prevents overload).
+            The list is read from the QC status of the instrument (see
+            updateQCStatus).
             As an example:
             [0]: RefAnalysis for Ethanol, QC-001 (Blank)
             [1]: RefAnalysis for Ethanol, QC-002 (Control)
             [2]: RefAnalysis for Methanol, QC-001 (Blank)
         """
-        field = self.getField('_LatestReferenceAnalyses')
-        refs = field and field.get(self) or []
-        if len(refs) == 0:
-            latest = {}
-            # Since the results file importer uses Date from the results
-            # file as Analysis 'Capture Date', we cannot assume the last
-            # item from the list is the latest analysis done, so we must
-            # pick up the latest analyses using the Results Capture Date
-            for ref in self.getReferenceAnalyses():
-                antype = QCANALYSIS_TYPES.getValue(ref.getReferenceType())
-                key = '%s.%s' % (ref.getServiceUID(), antype)
-                last = latest.get(key, ref)
-                if ref.getResultCaptureDate() > last.getResultCaptureDate():
-                    latest[key] = ref
-                else:
-                    latest[key] = last
-            refs = [r for r in latest.itervalues()]
-            # Add to the cache
-            self.getField('_LatestReferenceAnalyses').set(self, refs)
-        return refs
+        rc = getToolByName(self, REFERENCE_CATALOG)
+        refs = [rc.lookupObject(entry['uid'])
+                for entry in self.getQCStatus().values()]
+        return [ref for ref in refs if ref]
+
+    def getQCStatus(self):
+        """ Returns the QC status of the instrument: a dict with an entry
+            for the latest Reference Analysis of each Analysis Service and
+            Reference type, with its UID, its Result Capture Date and
+            whether its result is within the reference values.
+            The status is stored when the instrument is created, and kept
+            up to date by updateQCStatus.  Reading it never writes.
+        """
+        status = getattr(aq_base(self), '_qc_status', None)
+        if status is None:
+            # Not stored yet (e.g. instruments not created through the
+            # forms): built on each read until a reference analysis is added
+            status = self._addQCEntries({}, self.getReferenceAnalyses())
+        return status
+
+    def updateQCStatus(self, analysis=None):
+        """ Updates the QC status of the instrument.  If a Reference
+            Analysis performed with this instrument is passed in, only the
+            entry of its Analysis Service and Reference type is updated.
+            Otherwise, the status is built again from all the Reference
+            Analyses of the instrument.
+        """
+        if analysis is None:
+            status = self._addQCEntries({}, self.getReferenceAnalyses())
+        else:
+            if analysis.portal_type != 'ReferenceAnalysis' \
+                    or analysis.UID() not in (self.getRawAnalyses() or []):
+                return self.getQCStatus()
+            status = self._addQCEntries(dict(self.getQCStatus()), [analysis])
+            if status is None:
+                # another analysis might be the latest now
+                return self.updateQCStatus()
+        previous = getattr(aq_base(self), '_qc_status', None) or {}
+        if self._isQCStatusValid(previous) != self._isQCStatusValid(status):
+            invalidate_failed_instruments(self)
+        self._qc_status = status
+        return status
+
+    def _addQCEntries(self, status, refs):
+        """ Sets the entries of the Reference Analyses passed in, in the QC
+            status passed in, if they are the latest of their Analysis
+            Service and Reference type.  Returns None if the analysis of an
+            entry went back in time, so the status must be built again.
+        """
+        # Since the results file importer uses Date from the results
+        # file as Analysis 'Capture Date', we cannot assume the last
+        # item from the list is the latest analysis done, so we must
+        # pick up the latest analyses using the Results Capture Date
+        for ref in refs:
+            antype = QCANALYSIS_TYPES.getValue(ref.getReferenceType())
+            key = '%s.%s' % (ref.getServiceUID(), antype)
+            entry = {'uid': ref.UID(),
+                     'date': ref.getResultCaptureDate(),
+                     'valid': self._isQCPassed(ref)}
+            last = status.get(key, None)
+            if last is not None and last['uid'] == entry['uid'] \
+                    and entry['date'] < last['date']:
+                return None
+            if last is None or last['uid'] == entry['uid'] \
+                    or entry['date'] > last['date']:
+                status[key] = entry
+        return status
+
+    def _isQCStatusValid(self, status):
+        for entry in status.values():
+            if not entry['valid']:
+                return False
+        return True
+
+    def _isQCPassed(self, ref):
+        """ Returns False if the result of the Reference Analysis is out of
+            the range of the reference values of its Reference Sample
+        """
+        rr = ref.aq_parent.getResultsRangeDict()
+        uid = ref.getServiceUID()
+        if uid not in rr:
+            # This should never happen.
+            # All QC Samples must have specs for its own AS
+            return True
+
+        specs = rr[uid];
+        try:
+            smin = float(specs.get('min', 0))
+            smax = float(specs.get('max', 0))
+            error = float(specs.get('error', 0))
+            target = float(specs.get('result', 0))
+            result = float(ref.getResult())
+            error_amount = ((target / 100) * error) if target > 0 else 0
+            upper  = smax + error_amount
+            lower = smin - error_amount
+            if result < lower or result > upper:
+                return False
+        except:
+            # This should never happen.
+            # All Reference Analysis Results and QC Samples specs
+            # must be floatable
+            pass
+        return True
 
     def isQCValid(self):
         """ Returns True if the instrument succeed for all the latest
             Analysis QCs performed (for diferent types of AS)
         """
-        for last in self.getLatestReferenceAnalyses():
-            rr = last.aq_parent.getResultsRangeDict()
-            uid = last.getServiceUID()
-            if uid not in rr:
-                # This should never happen.
-                # All QC Samples must have specs for its own AS
-                continue
-
-            specs = rr[uid];
-            try:
-                smin = float(specs.get('min', 0))
-                smax = float(specs.get('max', 0))
-                error = float(specs.get('error', 0))
-                target = float(specs.get('result', 0))
-                result = float(last.getResult())
-                error_amount = ((target / 100) * error) if target > 0 else 0
-                upper  = smax + error_amount
-                lower = smin - error_amount
-                if result < lower or result > upper:
-                    return False
-            except:
-                # This should never happen.
-                # All Reference Analysis Results and QC Samples specs
-                # must be floatable
-                continue
+        return self._isQCStatusValid(self.getQCStatus())
+
+    def getValidityStatus(self):
+        """ Returns the dates of the latest valid certification, validation
+            and calibration of the instrument: a dict with the expiry date
+            of the certification, and the (from, to) dates of the down time
+            of the validation and the calibration, or None.
+            Reading it never writes, see updateValidityStatus.
+        """
+        status = getattr(aq_base(self), '_validity_status', None)
+        if status is None:
+            status = self._buildValidityStatus()
+        return status
+
+    def updateValidityStatus(self):
+        """ Updates the validity status of the instrument.  Must be called
+            whenever a certification, validation or calibration of the
+            instrument is added, modified or removed.
+        """
+        self._validity_status = self._buildValidityStatus()
+        return self._validity_status
 
-        return True
+    def _buildValidityStatus(self):
+        status = {'certification': None,
+                  'validation': None,
+                  'calibration': None}
+        cert = self.getLatestValidCertification()
+        if cert and cert.getValidTo():
+            status['certification'] = cert.getValidTo().asdatetime().date()
+        for key, obj in (('validation', self.getLatestValidValidation()),
+                         ('calibration', self.getLatestValidCalibration())):
+            if obj and obj.getDownTo():
+                status[key] = (obj.getDownFrom().asdatetime().date(),
+                               obj.getDownTo().asdatetime().date())
+        return status
 
     def isOutOfDate(self):
         """ Returns if the current instrument is out-of-date regards to
             its certifications
         """
-        cert = self.getLatestValidCertification()
-        today = date.today()
-        if cert and cert.getValidTo():
-            validto = cert.getValidTo().asdatetime().date();
-            if validto > today:
-                return False
+        validto = self.getValidityStatus()['certification']
+        if validto and validto > date.today():
+            return False
         return True
 
     def isValidationInProgress(self):
         """ Returns if the current instrument is under validation progress
         """
-        validation = self.getLatestValidValidation()
-        today = date.today()
-        if validation and validation.getDownTo():
-            validfrom = validation.getDownFrom().asdatetime().date()
-            validto = validation.getDownTo().asdatetime().date()
-            if validfrom <= today <= validto:
-                return True
-        return False
+        down = self.getValidityStatus()['validation']
+        return bool(down and down[0] <= date.today() <= down[1])
 
     def isCalibrationInProgress(self):
         """ Returns if the current instrument is under calibration progress
         """
-        calibration = self.getLatestValidCalibration()
-        today = date.today()
-        if calibration and calibration.getDownTo():
-            validfrom = calibration.getDownFrom().asdatetime().date()
-            validto = calibration.getDownTo().asdatetime().date()
-            if validfrom <= today <= validto:
-                return True
-        return False
+        down = self.getValidityStatus()['calibration']
+        return bool(down and down[0] <= date.today() <= down[1])
 
     def getCertificateExpireDate(self):
         """ Returns the current instrument's data expiration certificate
@@ -641,7 +724,7 @@ class Instrument(ATFolder):
         ans = self.getRawAnalyses() if self.getRawAnalyses() else []
         ans.append(analysis.UID())
         self.setAnalyses(ans)
-        self.cleanReferenceAnalysesCache()
+        self.updateQCStatus(analysis)
 
     def removeAnalysis(self, analysis):
         """ Remove a regular analysis assigned to this instrument
@@ -654,10 +737,13 @@ class Instrument(ATFolder):
         uid = analysis.UID()
         ans = [a for a in self.getRawAnalyses() if a != uid]
         self.setAnalyses(ans)
-        self.cleanReferenceAnalysesCache()
+        if uid in [entry['uid'] for entry in self.getQCStatus().values()]:
+            # the previous analysis of the same service becomes the latest
+            self.updateQCStatus()
 
     def cleanReferenceAnalysesCache(self):
-        self.getField('_LatestReferenceAnalyses').set(self, [])
+        """ BBB: builds the QC status of the instrument again """
+        self.updateQCStatus()
 
     def addReferences(self, reference, service_uids):
         """ Add reference analyses to reference
@@ -709,12 +795,13 @@ class Instrument(ATFolder):
 
         self.setAnalyses(self.getAnalyses() + addedanalyses)
 
-        # Initialize LatestReferenceAnalyses cache
-        self.cleanReferenceAnalysesCache()
+        # Update the QC status with the new reference analyses
+        for ref_analysis in addedanalyses:
+            self.updateQCStatus(ref_analysis)
 
         # Set DisposeUntilNextCalibrationTest to False
         if (len(addedanalyses) > 0):
-            self.getField('DisposeUntilNextCalibrationTest').set(self, False)
+            self.setDisposeUntilNextCalibrationTest(False)
 
         return addedanalyses
 
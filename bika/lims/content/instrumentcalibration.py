@@ -13,6 +13,7 @@ from bika.lims.utils import t
 from bika.lims.browser.widgets import DateTimeWidget, ReferenceWidget
 from bika.lims.config import PROJECTNAME
 from bika.lims.content.bikaschema import BikaSchema
+from bika.lims.utils.instruments import update_validity_status
 
 schema = BikaSchema.copy() + Schema((
 
@@ -134,6 +135,16 @@ class InstrumentCalibration(BaseFolder):
         from bika.lims.idserver import renameAfterCreation
         renameAfterCreation(self)
 
+    def setDownFrom(self, value, **kw):
+        self.getField('DownFrom').set(self, value, **kw)
+        # The validity of the instrument depends on the dates
+        update_validity_status(self)
+
+    def setDownTo(self, value, **kw):
+        self.getField('DownTo').set(self, value, **kw)
+        # The validity of the instrument depends on the dates
+        update_validity_status(self)
+
     def getLabContacts(self):
         bsc = getToolByName(self, 'bika_setup_catalog')
         # fallback - all Lab Contacts
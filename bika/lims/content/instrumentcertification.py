@@ -15,6 +15,7 @@ from bika.lims.utils import t
 from bika.lims.browser.widgets import DateTimeWidget, ReferenceWidget
 from bika.lims.config import PROJECTNAME
 from bika.lims.content.bikaschema import BikaSchema
+from bika.lims.utils.instruments import update_validity_status
 from Products.CMFCore import permissions
 from bika.lims.interfaces import IInstrumentCertification
 
@@ -157,6 +158,16 @@ class InstrumentCertification(BaseFolder):
         from bika.lims.idserver import renameAfterCreation
         renameAfterCreation(self)
 
+    def setValidFrom(self, value, **kw):
+        self.getField('ValidFrom').set(self, value, **kw)
+        # The validity of the instrument depends on the dates
+        update_validity_status(self)
+
+    def setValidTo(self, value, **kw):
+        self.getField('ValidTo').set(self, value, **kw)
+        # The validity of the instrument depends on the dates
+        update_validity_status(self)
+
     def getLabContacts(self):
         bsc = getToolByName(self, 'bika_setup_catalog')
         # fallback - all Lab Contacts
@@ -225,8 +225,24 @@ class ReferenceAnalysis(BaseContent):
 
     def setResult(self, value, **kw):
         # Always update ResultCapture date when this field is modified
-        self.setResultCaptureDate(DateTime())
+        self.getField('ResultCaptureDate').set(self, DateTime())
         self.getField('Result').set(self, value, **kw)
+        self.updateInstrumentQCStatus()
+
+    security.declarePublic('setResultCaptureDate')
+
+    def setResultCaptureDate(self, value, **kw):
+        self.getField('ResultCaptureDate').set(self, value, **kw)
+        self.updateInstrumentQCStatus()
+
+    def updateInstrumentQCStatus(self):
+        """ Updates the QC status of the instruments the analysis was
+            performed with.  The QC status depends on the result, on the
+            capture date of the result and on the reference values of the
+            Reference Sample.
+        """
+        for instrument in self.getBackReferences('InstrumentAnalyses'):
+            instrument.updateQCStatus(self)
 
     security.declarePublic('current_date')
 
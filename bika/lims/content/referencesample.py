@@ -272,6 +272,14 @@ class ReferenceSample(BaseFolder):
 
         return sorted_specs
 
+    security.declarePublic('setReferenceResults')
+    def setReferenceResults(self, value, **kw):
+        self.getField('ReferenceResults').set(self, value, **kw)
+        # Whether the reference analyses pass or fail the QC of their
+        # instruments depends on the reference values
+        for analysis in self.getReferenceAnalyses():
+            analysis.updateInstrumentQCStatus()
+
     security.declarePublic('getReferenceAnalyses')
     def getReferenceAnalyses(self):
         """ return all analyses linked to this reference sample """
@@ -354,6 +362,11 @@ class ReferenceSample(BaseFolder):
             services.append(service)
         return services
 
+    security.declarePublic('getSupportedServiceUIDs')
+    def getSupportedServiceUIDs(self):
+        """ UIDs of the services with reference values in this Sample """
+        return [spec['uid'] for spec in self.getReferenceResults()]
+
     security.declarePublic('getReferenceResultStr')
     def getReferenceResultStr(self, service_uid):
         specstr = ''
@@ -10,6 +10,7 @@ from bika.lims.config import *
 from bika.lims.idserver import renameAfterCreation
 from bika.lims.utils import t, tmpID, changeWorkflowState
 from bika.lims.utils import to_utf8 as _c
+from bika.lims.utils.worksheet import WorksheetLayout
 from bika.lims.browser.fields import HistoryAwareReferenceField
 from bika.lims.config import PROJECTNAME
 from bika.lims.content.bikaschema import BikaSchema
@@ -19,6 +20,7 @@ from bika.lims.permissions import Verify as VerifyPermission
 from bika.lims.workflow import doActionFor
 from bika.lims.workflow import skip
 from DateTime import DateTime
+from Missing import Value
 from operator import itemgetter
 from plone.indexer import indexer
 from Products.Archetypes.config import REFERENCE_CATALOG
@@ -52,6 +54,26 @@ def getDepartmentUIDs(instance):
             an.getDepartment()]
     return deps
 
+def _reference_blank(brain):
+    """Whether the Reference Sample of the brain is a blank, read from the
+    catalog metadata if available
+    """
+    blank = getattr(brain, 'getBlank', None)
+    if blank is None or blank is Value:
+        return bool(brain.getObject().getBlank())
+    return bool(blank)
+
+
+def _reference_service_uids(brain):
+    """UIDs of the services with reference values in the Reference Sample
+    of the brain, read from the catalog metadata if available
+    """
+    uids = getattr(brain, 'getSupportedServiceUIDs', None)
+    if uids is None or uids is Value:
+        return brain.getObject().getSupportedServiceUIDs()
+    return uids
+
+
 schema = BikaSchema.copy() + Schema((
     HistoryAwareReferenceField('WorksheetTemplate',
         allowed_types=('WorksheetTemplate',),
@@ -130,6 +152,27 @@ class Worksheet(BaseFolder, HistoryAwareMixin):
         # contentsMethod methods.  We ignore it.
         return list(self.getAnalyses())
 
+    def getLayoutIndex(self):
+        """Returns the WorksheetLayout index of the slots of the Layout
+        """
+        layout = self.getLayout()
+        index = getattr(self, '_v_layout_index', None)
+        # slots added to the index, but never stored, are discarded
+        if index is None or len(index) != len(layout):
+            index = WorksheetLayout(layout)
+            self._v_layout_index = index
+        return index
+
+    def setLayout(self, value, **kwargs):
+        self.getField('Layout').set(self, value, **kwargs)
+        self._v_layout_index = None
+
+    def _storeLayout(self, index):
+        """Writes the slots of the WorksheetLayout index to the Layout
+        """
+        self.setLayout(index.layout())
+        self._v_layout_index = index
+
     security.declareProtected(EditWorksheet, 'addAnalysis')
 
     def addAnalysis(self, analysis, position=None):
@@ -137,45 +180,56 @@ class Worksheet(BaseFolder, HistoryAwareMixin):
            - position is overruled if a slot for this analysis' parent exists
            - if position is None, next available pos is used.
         """
-        workflow = getToolByName(self, 'portal_workflow')
+        self.addAnalyses([analysis, ], position=position)
 
-        analysis_uid = analysis.UID()
-        parent_uid = analysis.aq_parent.UID()
-        analyses = self.getAnalyses()
-        layout = self.getLayout()
+    security.declareProtected(EditWorksheet, 'addAnalyses')
 
-        # check if this analysis is already in the layout
-        if analysis_uid in [l['analysis_uid'] for l in layout]:
-            return
-
-        # If the ws has an instrument assigned for which the analysis
-        # is allowed, set it
+    def addAnalyses(self, analyses, position=None, container_positions=None):
+        """Adds the analyses to the worksheet, as addAnalysis does, but
+        writes the Layout and the Analyses of the worksheet once.
+        container_positions maps the UIDs of the parents of the analyses to
+        the positions to use for them, if they don't have a slot yet.
+        """
+        workflow = getToolByName(self, 'portal_workflow')
+        container_positions = container_positions or {}
+        index = self.getLayoutIndex()
         instr = self.getInstrument()
-        if instr and analysis.isInstrumentAllowed(instr):
-            # Set the method assigned to the selected instrument
-            analysis.setMethod(instr.getMethod())
-            analysis.setInstrument(instr)
 
-        self.setAnalyses(analyses + [analysis, ])
+        added = []
+        for analysis in analyses:
+            analysis_uid = analysis.UID()
+            # check if this analysis is already in the layout
+            if analysis_uid in index:
+                continue
 
-        # if our parent has a position, use that one.
-        if analysis.aq_parent.UID() in [slot['container_uid'] for slot in layout]:
-            position = [int(slot['position']) for slot in layout if
-                        slot['container_uid'] == analysis.aq_parent.UID()][0]
-        else:
-            # prefer supplied position parameter
-            if not position:
-                used_positions = [0, ] + [int(slot['position']) for slot in layout]
-                position = [pos for pos in range(1, max(used_positions) + 2)
-                            if pos not in used_positions][0]
-        self.setLayout(layout + [{'position': position,
-                                  'type': 'a',
-                                  'container_uid': parent_uid,
-                                  'analysis_uid': analysis.UID()}, ])
-
-        allowed_transitions = [t['id'] for t in workflow.getTransitionsFor(analysis)]
-        if 'assign' in allowed_transitions:
-            workflow.doActionFor(analysis, 'assign')
+            # If the ws has an instrument assigned for which the analysis
+            # is allowed, set it
+            if instr and analysis.isInstrumentAllowed(instr):
+                # Set the method assigned to the selected instrument
+                analysis.setMethod(instr.getMethod())
+                analysis.setInstrument(instr)
+
+            # if our parent has a position, use that one.
+            parent_uid = analysis.aq_parent.UID()
+            slot_position = index.container_position(parent_uid)
+            if slot_position is None:
+                # prefer supplied position parameter
+                slot_position = container_positions.get(parent_uid, position)
+            if not slot_position:
+                slot_position = index.free_position()
+            index.add(slot_position, 'a', parent_uid, analysis_uid)
+            added.append(analysis)
+
+        if not added:
+            return
+        self.setAnalyses(self.getAnalyses() + added)
+        self._storeLayout(index)
+
+        for analysis in added:
+            allowed_transitions = [t['id'] for t in
+                                   workflow.getTransitionsFor(analysis)]
+            if 'assign' in allowed_transitions:
+                workflow.doActionFor(analysis, 'assign')
 
         # If a dependency of DryMatter service is added here, we need to
         # make sure that the dry matter analysis itself is also
@@ -184,15 +238,19 @@ class Worksheet(BaseFolder, HistoryAwareMixin):
         dms = self.bika_setup.getDryMatterService()
         if dms:
             dmk = dms.getKeyword()
-            deps = analysis.getDependents()
-            # if dry matter service in my dependents:
-            if dmk in [a.getService().getKeyword() for a in deps]:
-                # get dry matter analysis from AR
-                dma = analysis.aq_parent.getAnalyses(getKeyword=dmk,
-                                                     full_objects=True)[0]
-                # add it.
-                if dma not in self.getAnalyses():
-                    self.addAnalysis(dma)
+            dmas = []
+            for analysis in added:
+                deps = analysis.getDependents()
+                # if dry matter service in my dependents:
+                if dmk in [a.getService().getKeyword() for a in deps]:
+                    # get dry matter analysis from AR
+                    dma = analysis.aq_parent.getAnalyses(getKeyword=dmk,
+                                                         full_objects=True)[0]
+                    if dma.UID() not in index and dma not in dmas:
+                        dmas.append(dma)
+            # add them.
+            if dmas:
+                self.addAnalyses(dmas)
 
     security.declareProtected(EditWorksheet, 'removeAnalysis')
 
@@ -212,8 +270,9 @@ class Worksheet(BaseFolder, HistoryAwareMixin):
         if analysis in Analyses:
             Analyses.remove(analysis)
             self.setAnalyses(Analyses)
-        layout = [slot for slot in self.getLayout() if slot['analysis_uid'] != analysis.UID()]
-        self.setLayout(layout)
+        index = self.getLayoutIndex()
+        index.remove(analysis.UID())
+        self._storeLayout(index)
 
         if analysis.portal_type == "DuplicateAnalysis":
             self._delObject(analysis.id)
@@ -223,22 +282,19 @@ class Worksheet(BaseFolder, HistoryAwareMixin):
         """
         workflow = getToolByName(self, 'portal_workflow')
         rc = getToolByName(self, REFERENCE_CATALOG)
-        layout = self.getLayout()
+        index = self.getLayoutIndex()
         wst = self.getWorksheetTemplate()
         wstlayout = wst and wst.getLayout() or []
         ref_type = reference.getBlank() and 'b' or 'c'
         ref_uid = reference.UID()
 
         if position == 'new':
-            highest_existing_position = len(wstlayout)
-            for pos in [int(slot['position']) for slot in layout]:
-                if pos > highest_existing_position:
-                    highest_existing_position = pos
-            position = highest_existing_position + 1
+            position = index.highest_position(len(wstlayout)) + 1
 
         # LIMS-2132 Reference Analyses got the same ID
         refgid = self.nextReferenceAnalysesGroupID(reference)
 
+        added = []
         for service_uid in service_uids:
             # services with dependents don't belong in references
             service = rc.lookupObject(service_uid)
@@ -261,13 +317,14 @@ class Worksheet(BaseFolder, HistoryAwareMixin):
             if calc:
                 ref_analysis.setInterimFields(calc.getInterimFields())
 
-            self.setLayout(
-                self.getLayout() + [{'position': position,
-                                     'type': ref_type,
-                                     'container_uid': reference.UID(),
-                                     'analysis_uid': ref_analysis.UID()}])
-            self.setAnalyses(
-                self.getAnalyses() + [ref_analysis, ])
+            index.add(position, ref_type, reference.UID(), ref_analysis.UID())
+            added.append(ref_analysis)
+
+        if not added:
+            return
+        self.setAnalyses(self.getAnalyses() + added)
+        self._storeLayout(index)
+        for ref_analysis in added:
             workflow.doActionFor(ref_analysis, 'assign')
 
     def nextReferenceAnalysesGroupID(self, reference):
@@ -293,31 +350,21 @@ class Worksheet(BaseFolder, HistoryAwareMixin):
         rc = getToolByName(self, REFERENCE_CATALOG)
         workflow = getToolByName(self, 'portal_workflow')
 
-        layout = self.getLayout()
+        index = self.getLayoutIndex()
         wst = self.getWorksheetTemplate()
         wstlayout = wst and wst.getLayout() or []
 
-        src_ar = [slot['container_uid'] for slot in layout if
-                  slot['position'] == src_slot]
-        if src_ar:
-            src_ar = src_ar[0]
-
         if not dest_slot or dest_slot == 'new':
-            highest_existing_position = len(wstlayout)
-            for pos in [int(slot['position']) for slot in layout]:
-                if pos > highest_existing_position:
-                    highest_existing_position = pos
-            dest_slot = highest_existing_position + 1
+            dest_slot = index.highest_position(len(wstlayout)) + 1
 
         src_analyses = [rc.lookupObject(slot['analysis_uid'])
-                        for slot in layout if
-                        int(slot['position']) == int(src_slot)]
+                        for slot in index.slots_at(src_slot)]
         dest_analyses = [rc.lookupObject(slot['analysis_uid']).getAnalysis().UID()
-                        for slot in layout if
-                        int(slot['position']) == int(dest_slot)]
+                        for slot in index.slots_at(dest_slot)]
 
         refgid = None
         processed = []
+        added = []
         for analysis in src_analyses:
             if analysis.UID() in dest_analyses:
                 continue
@@ -374,13 +421,15 @@ class Worksheet(BaseFolder, HistoryAwareMixin):
             duplicate.processForm()
             if calc:
                 duplicate.setInterimFields(calc.getInterimFields())
-            self.setLayout(
-                self.getLayout() + [{'position': dest_slot,
-                                     'type': 'd',
-                                     'container_uid': analysis.aq_parent.UID(),
-                                     'analysis_uid': duplicate.UID()}, ]
-            )
-            self.setAnalyses(self.getAnalyses() + [duplicate, ])
+            index.add(dest_slot, 'd', analysis.aq_parent.UID(),
+                      duplicate.UID())
+            added.append(duplicate)
+
+        if not added:
+            return
+        self.setAnalyses(self.getAnalyses() + added)
+        self._storeLayout(index)
+        for duplicate in added:
             workflow.doActionFor(duplicate, 'assign')
 
 
@@ -405,34 +454,59 @@ class Worksheet(BaseFolder, HistoryAwareMixin):
         nr_slots = len(wst_slots) - len(ws_slots)
         positions = [pos for pos in wst_slots if pos not in ws_slots]
 
-        analyses = bac(portal_type='Analysis',
-                       getServiceUID=wst_service_uids,
-                       review_state='sample_received',
-                       worksheetanalysis_review_state='unassigned',
-                       cancellation_state = 'active',
-                       sort_on='getDueDate')
+        query = dict(portal_type='Analysis',
+                     getServiceUID=wst_service_uids,
+                     review_state='sample_received',
+                     worksheetanalysis_review_state='unassigned',
+                     cancellation_state='active')
+        instr = self.getInstrument() if self.getInstrument() else wst.getInstrument()
+
+        # The instruments allowed for an analysis only depend on its
+        # service, so one analysis per service is enough to know whether
+        # the instrument can be used
+        eligible = {}
+
+        def instrument_allowed(brain):
+            if not instr:
+                return True
+            service_uid = brain.getServiceUID
+            if service_uid not in eligible:
+                eligible[service_uid] = \
+                    brain.getObject().isInstrumentAllowed(instr) is not False
+            return eligible[service_uid]
+
+        # Pick the ARs with the most urgent analyses, and stop as soon as
+        # there is one for each free slot
+        ar_ids = []
+        if nr_slots > 0:
+            for brain in bac(sort_on='getDueDate', **query):
+                if brain.getRequestID in ar_ids \
+                        or not instrument_allowed(brain):
+                    # Exclude those analyses for which the ws selected
+                    # instrument is not allowed
+                    continue
+                ar_ids.append(brain.getRequestID)
+                if len(ar_ids) >= nr_slots:
+                    break
 
         # ar_analyses is used to group analyses by AR.
         ar_analyses = {}
-        instr = self.getInstrument() if self.getInstrument() else wst.getInstrument()
-        for brain in analyses:
-            analysis = brain.getObject()
-            if instr and brain.getObject().isInstrumentAllowed(instr) is False:
-                # Exclude those analyses for which the ws selected
-                # instrument is not allowed
-                continue
-            ar_id = brain.getRequestID
-            if ar_id in ar_analyses:
-                ar_analyses[ar_id].append(analysis)
-            else:
-                if len(ar_analyses.keys()) < nr_slots:
-                    ar_analyses[ar_id] = [analysis, ]
+        if ar_ids:
+            for brain in bac(getRequestID=ar_ids, sort_on='getDueDate',
+                             **query):
+                if instrument_allowed(brain):
+                    ar_analyses.setdefault(brain.getRequestID, []).append(
+                        brain.getObject())
 
         # Add analyses, sorted by AR ID
         ars = sorted(ar_analyses.keys())
-        for ar in ars:
+        to_add = []
+        container_positions = {}
+        for position, ar in zip(positions, ars):
             for analysis in ar_analyses[ar]:
-                self.addAnalysis(analysis, position=positions[ars.index(ar)])
+                to_add.append(analysis)
+                container_positions[analysis.aq_parent.UID()] = position
+        self.addAnalyses(to_add, container_positions=container_positions)
 
         # find best maching reference samples for Blanks and Controls
         for t in ('b', 'c'):
@@ -449,19 +523,16 @@ class Worksheet(BaseFolder, HistoryAwareMixin):
                              getReferenceDefinitionUID=reference_definition_uid)
                 if not samples:
                     break
-                samples = [s.getObject() for s in samples]
-                if t == 'b':
-                    samples = [s for s in samples if s.getBlank()]
-                else:
-                    samples = [s for s in samples if not s.getBlank()]
+                samples = [s for s in samples
+                           if _reference_blank(s) == (t == 'b')]
                 complete_reference_found = False
                 references = {}
-                for reference in samples:
-                    reference_uid = reference.UID()
+                for sample in samples:
+                    reference_uid = sample.UID
                     references[reference_uid] = {}
                     references[reference_uid]['services'] = []
                     references[reference_uid]['count'] = 0
-                    specs = reference.getResultsRangeDict()
+                    specs = _reference_service_uids(sample)
                     for service_uid in wst_service_uids:
                         if service_uid in specs:
                             references[reference_uid]['services'].append(service_uid)
@@ -472,7 +543,7 @@ class Worksheet(BaseFolder, HistoryAwareMixin):
                 if complete_reference_found:
                     supported_uids = wst_service_uids
                     self.addReferences(int(row['pos']),
-                                     reference,
+                                     sample.getObject(),
                                      supported_uids)
                 else:
                     # find the most complete reference sample instead
@@ -484,9 +555,8 @@ class Worksheet(BaseFolder, HistoryAwareMixin):
                             no_of_services = references[key]['count']
                             reference = key
                     if reference:
+                        supported_uids = references[reference]['services']
                         reference = rc.lookupObject(reference)
-                        supported_uids = [s.UID() for s in reference.getServices()
-                                          if s.UID() in wst_service_uids]
                         self.addReferences(int(row['pos']),
                                          reference,
                                          supported_uids)
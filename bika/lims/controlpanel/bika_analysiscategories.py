@@ -16,6 +16,10 @@ from zope.interface import alsoProvides
 
 class AnalysisCategoriesView(BikaSetupItemsView):
 
+    # All the columns are read from the catalog, no object is woken up
+    render_from_metadata = True
+    metadata_columns = ['Title', 'Description', 'Department', 'SortKey']
+
     def __init__(self, context, request):
         super(AnalysisCategoriesView, self).__init__(
             context, request, 'AnalysisCategory', 'category_big.png')
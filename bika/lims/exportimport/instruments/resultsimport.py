@@ -12,11 +12,25 @@ from bika.lims.utils import t
 from bika.lims.exportimport.instruments.logger import Logger
 from bika.lims.idserver import renameAfterCreation
 from bika.lims.utils import tmpID
+from bika.lims.utils.calculation import calculate_ar_results
+from bika.lims.utils.services import get_service_keywords
 from Products.Archetypes.config import REFERENCE_CATALOG
+from Products.ZCatalog.interfaces import ICatalogBrain
 from datetime import datetime
 from DateTime import DateTime
 import os
 
+
+_marker = []
+
+
+def _keyword(analysis):
+    """ The keyword of the analysis or analysis brain passed in
+    """
+    keyword = analysis.getKeyword
+    return keyword() if callable(keyword) else keyword
+
+
 class InstrumentResultsFileParser(Logger):
 
     def __init__(self, infile, mimetype):
@@ -204,7 +218,8 @@ class InstrumentCSVResultsFileParser(InstrumentResultsFileParser):
             f = open(infile.name, 'rU')
         except AttributeError:
             f = infile
-        for line in f.readlines():
+        # read the file line by line, not all at once through readlines()
+        for line in iter(f.readline, ''):
             self._numline += 1
             if jump == -1:
                 # Something went wrong. Finish
@@ -351,11 +366,11 @@ class AnalysisResultsImporter(Logger):
         importedinsts = {}
         rawacodes = self._parser.getAnalysisKeywords()
         exclude = self.getKeywordsToBeExcluded()
+        rawacodes = [acode for acode in rawacodes
+                     if acode and acode not in exclude]
+        keywords = get_service_keywords(self.context)
         for acode in rawacodes:
-            if acode in exclude or not acode:
-                continue
-            service = self.bsc(getKeyword=acode)
-            if not service:
+            if acode not in keywords:
                 self.warn('Service keyword ${analysis_keyword} not found',
                             mapping={"analysis_keyword": acode})
             else:
@@ -365,7 +380,11 @@ class AnalysisResultsImporter(Logger):
 
         searchcriteria = self.getIdSearchCriteria();
         #self.log(_("Search criterias: %s") % (', '.join(searchcriteria)))
-        for objid, results in self._parser.getRawResults().iteritems():
+        rawresults = self._parser.getRawResults()
+        # Resolve the analyses of all the parsed ids at once
+        self._resolveAnalyses(rawresults.keys())
+        attuid = _marker
+        for objid, results in rawresults.iteritems():
             # Allowed more than one result for the same sample and analysis.
             # Needed for calibration tests
             for result in results:
@@ -413,9 +432,9 @@ class AnalysisResultsImporter(Logger):
                     # to the Reference Sample
                     service_uids = []
                     reference_type = 'b' if refsample.getBlank() == True else 'c'
-                    services = self.bsc(portal_type='AnalysisService')
-                    service_uids = [service.UID for service in services \
-                                    if service.getObject().getKeyword() in result.keys()]
+                    keywords = get_service_keywords(self.context)
+                    service_uids = [keywords.uid(keyword) for keyword
+                                    in result.keys() if keyword in keywords]
                     analyses = inst.addReferences(refsample, service_uids)
 
                 elif len(analyses) == 0:
@@ -437,7 +456,7 @@ class AnalysisResultsImporter(Logger):
                         continue
 
                     ans = [analysis for analysis in analyses \
-                           if analysis.getKeyword() == acode]
+                           if _keyword(analysis) == acode]
 
                     if len(ans) > 1:
                         self.err("More than one analysis found for ${object_id} and ${analysis_keyword}",
@@ -452,6 +471,8 @@ class AnalysisResultsImporter(Logger):
                         continue
 
                     analysis = ans[0]
+                    if ICatalogBrain.providedBy(analysis):
+                        analysis = analysis.getObject()
                     if capturedate:
                         values['DateTime'] = capturedate
                     processed = self._process_analysis(objid, analysis, values)
@@ -476,28 +497,8 @@ class AnalysisResultsImporter(Logger):
                                     importedar.append(acode)
                                 importedars[ar.getRequestID()] = importedar
 
-                        # Create the AttachmentType for mime type if not exists
-                        attuid = None
-                        attachmentType = self.bsc(portal_type="AttachmentType",
-                                                  title=self._parser.getAttachmentFileType())
-                        if len(attachmentType) == 0:
-                            try:
-                                folder = self.context.bika_setup.bika_attachmenttypes
-                                obj = _createObjectByType("AttachmentType", folder, tmpID())
-                                obj.edit(title=self._parser.getAttachmentFileType(),
-                                         description="Autogenerated file type")
-                                obj.unmarkCreationFlag()
-                                renameAfterCreation(obj)
-                                attuid = obj.UID()
-                            except:
-                                attuid = None
-                                self.err(
-                                    "Unable to create the Attachment Type ${mime_type}",
-                                    mapping={
-                                    "mime_type": self._parser.getFileMimeType()})
-                        else:
-                            attuid = attachmentType[0].UID
-
+                        if attuid is _marker:
+                            attuid = self._getAttachmentTypeUID()
                         if attuid is not None:
                             try:
                                 # Attach the file to the Analysis
@@ -525,21 +526,19 @@ class AnalysisResultsImporter(Logger):
     #                                                "request_id": ar.getRequestID()}))
                                 pass
 
-        # Calculate analysis dependencies
-        for aruid in arprocessed:
-            ar = self.bc(portal_type='AnalysisRequest',
-                         UID=aruid)
-            ar = ar[0].getObject()
-            analyses = ar.getAnalyses()
-            for analysis in analyses:
-                analysis = analysis.getObject()
-                if analysis.calculateResult(True, True):
-                    self.log(
-                        "${request_id} calculated result for '${analysis_keyword}': '${analysis_result}'",
-                        mapping={"request_id": ar.getRequestID(),
-                                 "analysis_keyword": analysis.getKeyword(),
-                                 "analysis_result": str(analysis.getResult())}
-                    )
+        # Calculate analysis dependencies, all the ARs in a single pass
+        ars = []
+        if arprocessed:
+            ars = [brain.getObject() for brain in
+                   self.bc(portal_type='AnalysisRequest',
+                           UID=list(set(arprocessed)))]
+        for analysis in calculate_ar_results(ars, override=True):
+            self.log(
+                "${request_id} calculated result for '${analysis_keyword}': '${analysis_result}'",
+                mapping={"request_id": analysis.aq_parent.getRequestID(),
+                         "analysis_keyword": analysis.getKeyword(),
+                         "analysis_result": str(analysis.getResult())}
+            )
 
         # Not sure if there's any reason why ReferenceAnalyses have not
         # defined the method calculateResult...
@@ -578,6 +577,103 @@ class AnalysisResultsImporter(Logger):
                 mapping={"nr_updated_ars": str(len(importedars)),
                          "nr_updated_results": str(ancount)})
 
+    def _getAttachmentTypeUID(self):
+        """ Returns the UID of the AttachmentType for the mime type of the
+            parsed file, created if it doesn't exist yet, or None
+        """
+        attachmentType = self.bsc(portal_type="AttachmentType",
+                                  title=self._parser.getAttachmentFileType())
+        if len(attachmentType) > 0:
+            return attachmentType[0].UID
+        try:
+            folder = self.context.bika_setup.bika_attachmenttypes
+            obj = _createObjectByType("AttachmentType", folder, tmpID())
+            obj.edit(title=self._parser.getAttachmentFileType(),
+                     description="Autogenerated file type")
+            obj.unmarkCreationFlag()
+            renameAfterCreation(obj)
+            return obj.UID()
+        except:
+            self.err(
+                "Unable to create the Attachment Type ${mime_type}",
+                mapping={
+                "mime_type": self._parser.getFileMimeType()})
+            return None
+
+    def _resolveAnalyses(self, objids):
+        """ Looks for the analyses of all the parsed ids at once, with a
+            single catalog query per search criteria, and keeps the brains
+            of the analyses found for each id, to be used by
+            _getZODBAnalyses.  The criteria are tried in the same order as
+            in _getZODBAnalysesFromAR and
+            _getZODBAnalysesFromReferenceAnalyses, and each id is resolved
+            by the first criteria that matches it.
+        """
+        self._resolved = {}
+        pending = set([objid for objid in objids if objid])
+        if not pending:
+            return
+
+        # Analysis Requests, by RequestID, SampleID, ClientSampleID and UID
+        arstates = self.getAllowedARStates()
+        ars = {}
+        for index in ('getRequestID', 'getSampleID', 'getClientSampleID',
+                      'UID'):
+            if not pending:
+                break
+            query = {'portal_type': 'AnalysisRequest',
+                     'review_state': arstates,
+                     index: list(pending)}
+            found = {}
+            for brain in self.bc(query):
+                found.setdefault(getattr(brain, index), []).append(brain)
+            for objid, brains in found.items():
+                if objid not in pending:
+                    continue
+                pending.discard(objid)
+                if len(brains) > 1:
+                    self.err("More than one Analysis Request found for "
+                             "${object_id}", mapping={"object_id": objid})
+                    self._resolved[objid] = []
+                else:
+                    ars[brains[0].getRequestID] = objid
+
+        if ars:
+            for objid in ars.values():
+                self._resolved[objid] = []
+            for brain in self.bac(portal_type='Analysis',
+                                  getRequestID=ars.keys()):
+                objid = ars.get(brain.getRequestID, None)
+                if objid is not None:
+                    self._resolved[objid].append(brain)
+
+        # Reference and duplicate analyses, by group ID, id and UID
+        reftypes = ['ReferenceAnalysis', 'DuplicateAnalysis']
+        for index, attr in (('getReferenceAnalysesGroupID',
+                             'getReferenceAnalysesGroupID'),
+                            ('id', 'id'), ('UID', 'UID')):
+            if not pending:
+                break
+            query = {'portal_type': reftypes, index: list(pending)}
+            found = {}
+            for brain in self.bac(query):
+                found.setdefault(getattr(brain, attr), []).append(brain)
+            for objid, brains in found.items():
+                if objid not in pending:
+                    continue
+                pending.discard(objid)
+                if index != 'getReferenceAnalysesGroupID':
+                    # resolved one by one, as they are not usual
+                    self._resolved[objid] = \
+                        self._getZODBAnalysesFromReferenceAnalyses(
+                            objid, index == 'id' and 'rid' or 'ruid')
+                else:
+                    self._resolved[objid] = brains
+
+        # Not found at all
+        for objid in pending:
+            self._resolved[objid] = []
+
     def _getObjects(self, objid, criteria, states):
         #self.log("Criteria: %s %s") % (criteria, obji))
         obj = []
@@ -630,12 +726,16 @@ class AnalysisResultsImporter(Logger):
         allowed_ar_states_msg = [_(s) for s in allowed_ar_states]
         allowed_an_states_msg = [_(s) for s in allowed_an_states]
 
+        resolved = getattr(self, '_resolved', {})
+        if objid in resolved:
+            # Already resolved by _resolveAnalyses
+            analyses = resolved[objid]
         # Acceleration of searches using priorization
-        if (self._priorizedsearchcriteria in ['rgid','rid','ruid']):
+        elif (self._priorizedsearchcriteria in ['rgid','rid','ruid']):
             # Look from reference analyses
             analyses = self._getZODBAnalysesFromReferenceAnalyses(objid,
                         self._priorizedsearchcriteria)
-        if (len(analyses) == 0):
+        if (len(analyses) == 0) and objid not in resolved:
             # Look from ar and derived
             analyses = self._getZODBAnalysesFromAR(objid,
                         '',
@@ -645,8 +745,7 @@ class AnalysisResultsImporter(Logger):
         # Discard analyses that don't match with allowed_an_states
         analyses = [analysis for analysis in analyses \
                     if analysis.portal_type != 'Analysis' \
-                        or self.wf.getInfoFor(analysis, 'review_state') \
-                        in allowed_an_states]
+                        or self._review_state(analysis) in allowed_an_states]
 
         if len(analyses) == 0:
             self.err(
@@ -656,6 +755,14 @@ class AnalysisResultsImporter(Logger):
 
         return analyses
 
+    def _review_state(self, analysis):
+        """ The review state of the analysis, from the catalog metadata if
+            analysis is a brain
+        """
+        if ICatalogBrain.providedBy(analysis):
+            return analysis.review_state
+        return self.wf.getInfoFor(analysis, 'review_state')
+
     def _getZODBAnalysesFromAR(self, objid, criteria, allowedsearches, arstates):
         ars = []
         analyses = []
@@ -810,6 +810,8 @@ class Instruments(WorksheetImporter):
                             'File': row.get('UserManualFile', None)
                             }
                 addDocument(self, row_dict, obj)
+            obj.updateQCStatus()
+            obj.updateValidityStatus()
             obj.unmarkCreationFlag()
             renameAfterCreation(obj)
 
@@ -4,6 +4,8 @@
 # Some rights reserved. See LICENSE.txt, AUTHORS.txt.
 
 from AccessControl import ModuleSecurityInfo, allow_module
+from ZODB.POSException import ConflictError, POSKeyError
+from BTrees.OOBTree import OOBTree
 from DateTime import DateTime
 from Products.Archetypes.public import DisplayList
 from Products.CMFCore.utils import getToolByName
@@ -13,34 +15,287 @@ from bika.lims import bikaMessageFactory as _
 from bika.lims.utils import t
 from bika.lims import interfaces
 from bika.lims import logger
+from persistent import Persistent
 from plone.i18n.normalizer.interfaces import IFileNameNormalizer
 from plone.i18n.normalizer.interfaces import IIDNormalizer
+from zope.annotation.interfaces import IAnnotations
 from zope.component import getUtility
 from zope.interface import providedBy
-import copy,re,urllib
+import copy,re,urllib,urllib2
+import threading
 import plone.protect
 import transaction
 
+SEQUENCES_KEY = 'bika.lims.idserver.sequences'
+
+# Numbers reserved at once by each client when no ID server URL is set
+ID_BLOCK_SIZE = 10
+ID_BLOCK_RETRIES = 5
+# Seconds to wait for the external ID server
+ID_SERVER_TIMEOUT = 10
+
 class IDServerUnavailable(Exception):
     pass
 
-def idserver_generate_id(context, prefix, batch_size = None):
-    """ Generate a new id using external ID server.
+class IDSequence(Persistent):
+    """ The last number handed out for a prefix.  A persistent object on its
+        own, so only the concurrent increments of the same sequence conflict.
+    """
+
+    def __init__(self, value=0):
+        self.value = value
+
+class IDSequences(object):
+    """ Persistent counters of the local ID server, stored in an OOBTree in
+        the portal annotations and keyed by prefix (year included).
+
+        Sequences created concurrently are merged by the BTree conflict
+        resolution.  Concurrent increments of the same sequence still raise
+        ConflictError, and the request is retried: merging them would hand
+        out the same number twice.
+    """
+
+    def __init__(self, context, portal=None):
+        if portal is None:
+            portal = getToolByName(context, 'portal_url').getPortalObject()
+        annotations = IAnnotations(portal)
+        if SEQUENCES_KEY not in annotations:
+            annotations[SEQUENCES_KEY] = OOBTree()
+        self.sequences = annotations[SEQUENCES_KEY]
+
+    def get(self, prefix):
+        """ Returns the last number handed out for prefix, or None if the
+            sequence does not exist yet
+        """
+        sequence = self.sequences.get(prefix, None)
+        return sequence.value if sequence is not None else None
+
+    def seed(self, prefix, value):
+        """ Makes sure the next number for prefix is greater than value
+        """
+        sequence = self.sequences.get(prefix, None)
+        if sequence is None:
+            self.sequences[prefix] = IDSequence(int(value))
+        elif int(value) > sequence.value:
+            sequence.value = int(value)
+
+    def next(self, prefix):
+        """ Returns the next number for prefix
+        """
+        return self.reserve(prefix, 1)[0]
+
+    def reserve(self, prefix, n):
+        """ Returns a list with the next n numbers for prefix, reserved with
+            a single increment
+        """
+        sequence = self.sequences.get(prefix, None)
+        if sequence is None:
+            sequence = IDSequence()
+            self.sequences[prefix] = sequence
+        start = sequence.value + 1
+        sequence.value += n
+        return range(start, start + n)
+
+    def release(self, prefix, first, last):
+        """ Hands out the numbers from first to last again, if last is still
+            the last number handed out for prefix
+        """
+        sequence = self.sequences.get(prefix, None)
+        if sequence is not None and sequence.value == last:
+            sequence.value = first - 1
+
+def last_catalog_id(catalog, prefix, separator):
+    """ Returns the greatest number amongst the ids of the catalog that are
+        made of prefix, separator and a number.  Walks through all the ids
+        of the catalog: only used to seed the sequences.
+    """
+    # this must specifically exclude AR IDs (two -'s)
+    rr = re.compile("^"+re.escape(prefix+separator)+"[\d+]+$")
+    ids = [int(i.split(prefix+separator)[1]) \
+           for i in catalog.Indexes['id'].uniqueValues() \
+           if rr.match(i)]
+    return ids and max(ids) or 0
+
+def seed_sequence(sequences, prefix, catalog, separator,
+                  sequence_start=None):
+    """ Seeds the sequence of prefix from the ids of the catalog the first
+        time it is used.  If sequence_start is greater than the next number,
+        the sequence starts at sequence_start (Jira LIMS-280).
+    """
+    if sequences.get(prefix) is None:
+        sequences.seed(prefix, last_catalog_id(catalog, prefix, separator))
+    if sequence_start:
+        sequences.seed(prefix, int(sequence_start) - 1)
+
+def reserve(context, prefix, n, catalog, separator='-', sequence_start=None):
+    """ Reserves n consecutive numbers of the local ID server for prefix, to
+        create objects in bulk.  prefix must be normalized, and include the
+        year if the ids include it.  The sequence is seeded like for
+        generateUniqueId (see seed_sequence).
+    """
+    sequences = IDSequences(context)
+    seed_sequence(sequences, prefix, catalog, separator, sequence_start)
+    return sequences.reserve(prefix, n)
+
+# Pools of the ids reserved for the objects created in bulk by this thread
+_bulk = threading.local()
+
+class reserved_ids(object):
+    """ Context manager for the creation of objects in bulk.  Within it, the
+        local ID server reserves the numbers of each sequence size at a time
+        (see reserve), and skips the ids already in the catalog with a single
+        query per block, instead of an increment and a query per object.
+        The numbers not used are given back on exit if nobody reserved
+        numbers after them.
+    """
+
+    def __init__(self, size):
+        self.size = max(int(size), 1)
+        self.nested = False
+
+    def __enter__(self):
+        if getattr(_bulk, 'pools', None) is not None:
+            self.nested = True
+        else:
+            _bulk.pools = {}
+            _bulk.size = self.size
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.nested:
+            return
+        pools = _bulk.pools
+        _bulk.pools = None
+        for (portal_path, prefix), pool in pools.items():
+            if pool['numbers']:
+                pool['sequences'].release(
+                    prefix, pool['numbers'][0][0], pool['last'])
+
+def _reserved_pool(context, prefix):
+    """ Returns the pool of reserved ids of prefix, or None if no objects
+        are being created in bulk
+    """
+    pools = getattr(_bulk, 'pools', None)
+    if pools is None:
+        return None
+    portal = getToolByName(context, 'portal_url').getPortalObject()
+    key = ('/'.join(portal.getPhysicalPath()), prefix)
+    if key not in pools:
+        pools[key] = {'numbers': [],
+                      'last': None,
+                      'size': _bulk.size,
+                      'sequences': IDSequences(context, portal)}
+    return pools[key]
+
+class IDBlockAllocator(object):
+    """ In-process ID allocation shared by all the ZEO clients.
+
+        Blocks of consecutive numbers are reserved from the persistent
+        sequences (see IDSequences) in a transaction of their own, through a
+        separate connection, and cached by each client until used up.  The
+        reservation is committed at once, so the numbers of a block are never
+        handed out twice, even if the request that reserved it is aborted.
+        Only one commit per block is needed, instead of one request to the
+        external ID server per object.
+    """
+
+    def __init__(self, block_size=ID_BLOCK_SIZE):
+        self.block_size = block_size
+        # (portal path, prefix) -> [next number, end of the block]
+        self.blocks = {}
+        self.lock = threading.Lock()
+
+    def allocate(self, context, prefix, n=1, seed=None):
+        """ Returns a list with the next n numbers for prefix.  seed is a
+            function that returns the last number already in use, called if
+            the sequence does not exist yet.
+        """
+        portal = getToolByName(context, 'portal_url').getPortalObject()
+        key = ('/'.join(portal.getPhysicalPath()), prefix)
+        numbers = []
+        with self.lock:
+            block = self.blocks.get(key, None)
+            while len(numbers) < n:
+                if block is None or block[0] >= block[1]:
+                    size = max(self.block_size, n - len(numbers))
+                    start = self.reserve_block(portal, prefix, size, seed)
+                    if start is None:
+                        # The site is not committed yet, reserve what is
+                        # needed in the current transaction, and don't cache
+                        sequences = IDSequences(context, portal)
+                        if seed and sequences.get(prefix) is None:
+                            sequences.seed(prefix, seed())
+                        return numbers + sequences.reserve(
+                            prefix, n - len(numbers))
+                    block = [start, start + size]
+                    self.blocks[key] = block
+                numbers.append(block[0])
+                block[0] += 1
+        return numbers
+
+    def reserve_block(self, portal, prefix, size, seed=None):
+        """ Reserves size numbers for prefix and commits at once.  Returns
+            the first number of the block, or None if the portal can't be
+            loaded from a separate connection.
+        """
+        jar = getattr(portal, '_p_jar', None)
+        if jar is None or portal._p_oid is None:
+            return None
+        tm = transaction.TransactionManager()
+        connection = jar.db().open(transaction_manager=tm)
+        try:
+            for attempt in range(ID_BLOCK_RETRIES):
+                try:
+                    site = connection.get(portal._p_oid)
+                    sequences = IDSequences(None, site)
+                    if seed and sequences.get(prefix) is None:
+                        sequences.seed(prefix, seed())
+                    start = sequences.reserve(prefix, size)[0]
+                    tm.commit()
+                    return start
+                except ConflictError:
+                    tm.abort()
+                except POSKeyError:
+                    tm.abort()
+                    return None
+            raise IDServerUnavailable(_('ID Server unavailable'))
+        finally:
+            connection.close()
+
+    def clear(self):
+        """ Discards the cached blocks.  The numbers left are never used.
+        """
+        with self.lock:
+            self.blocks = {}
+
+id_block_allocator = IDBlockAllocator()
+
+def idserver_generate_id(context, prefix, batch_size = None, seed = None):
+    """ Generate a new id using external ID server.  If no ID server URL is
+        set, ids are allocated in blocks from the database (see
+        IDBlockAllocator).  With batch_size, a list of ids is returned.
     """
     plone = context.portal_url.getPortalObject()
     url = context.bika_setup.getIDServerURL()
 
+    if not url:
+        numbers = id_block_allocator.allocate(
+            context, prefix, batch_size or 1, seed)
+        return batch_size and [str(n) for n in numbers] or str(numbers[0])
+
     try:
         if batch_size:
             # GET
-            f = urllib.urlopen('%s/%s/%s?%s' % (
+            f = urllib2.urlopen('%s/%s/%s?%s' % (
                     url,
                     plone.getId(),
                     prefix,
-                    urllib.urlencode({'batch_size': batch_size}))
+                    urllib.urlencode({'batch_size': batch_size})),
+                    timeout=ID_SERVER_TIMEOUT
                     )
         else:
-            f = urllib.urlopen('%s/%s/%s'%(url, plone.getId(), prefix))
+            f = urllib2.urlopen('%s/%s/%s'%(url, plone.getId(), prefix),
+                                timeout=ID_SERVER_TIMEOUT)
         new_id = f.read()
         f.close()
     except:
@@ -99,6 +354,21 @@ def generateUniqueId(context):
         # parent id is normalized already
         return ("%s" + separator + "P%s") % (context.aq_parent.id, partnr)
 
+    def id_catalog():
+        plone = context.portal_url.getPortalObject()
+        # grab the first catalog we are indexed in.
+        at = getToolByName(plone, 'archetype_tool')
+        if context.portal_type in at.catalog_map:
+            catalog_name = at.catalog_map[context.portal_type][0]
+        else:
+            catalog_name = 'portal_catalog'
+        return getToolByName(plone, catalog_name)
+
+    def catalog_seed(prefix):
+        # the in-process ID allocation starts after the existing ids
+        return lambda: last_catalog_id(
+            id_catalog(), fn_normalize(prefix), separator)
+
     if context.bika_setup.getExternalIDServer():
 
         # if using external server
@@ -108,14 +378,18 @@ def generateUniqueId(context):
             if context.portal_type == "Sample":
                 prefix = context.getSampleType().getPrefix()
                 padding = context.bika_setup.getSampleIDPadding()
-                new_id = str(idserver_generate_id(context, "%s%s-" % (prefix, year)))
+                new_id = str(idserver_generate_id(
+                    context, "%s%s-" % (prefix, year),
+                    seed=catalog_seed(prefix+year)))
                 if padding:
                     new_id = new_id.zfill(int(padding))
                 return ('%s%s' + separator + '%s') % (prefix, year, new_id)
             elif d['portal_type'] == context.portal_type:
                 prefix = d['prefix']
                 padding = d['padding']
-                new_id = str(idserver_generate_id(context, "%s%s-" % (prefix, year)))
+                new_id = str(idserver_generate_id(
+                    context, "%s%s-" % (prefix, year),
+                    seed=catalog_seed(prefix+year)))
                 if padding:
                     new_id = new_id.zfill(int(padding))
                 return ('%s%s' + separator + '%s') % (prefix, year, new_id)
@@ -123,38 +397,46 @@ def generateUniqueId(context):
         # year is not inserted here
         # portal_type is be normalized to lowercase
         npt = id_normalize(context.portal_type)
-        new_id = str(idserver_generate_id(context, npt + "-"))
+        new_id = str(idserver_generate_id(
+            context, npt + "-", seed=catalog_seed(npt)))
         return ('%s' + separator + '%s') % (npt, new_id)
 
     else:
 
         # No external id-server.
 
-        def next_id(prefix):
-            # normalize before anything
-            prefix = fn_normalize(prefix)
-            plone = context.portal_url.getPortalObject()
-            # grab the first catalog we are indexed in.
-            at = getToolByName(plone, 'archetype_tool')
-            if context.portal_type in at.catalog_map:
-                catalog_name = at.catalog_map[context.portal_type][0]
-            else:
-                catalog_name = 'portal_catalog'
-            catalog = getToolByName(plone, catalog_name)
-
-            # get all IDS that start with prefix
-            # this must specifically exclude AR IDs (two -'s)
-            rr = re.compile("^"+prefix+separator+"[\d+]+$")
-            ids = [int(i.split(prefix+separator)[1]) \
-                   for i in catalog.Indexes['id'].uniqueValues() \
-                   if rr.match(i)]
-
-            #plone_tool = getToolByName(context, 'plone_utils')
-            #if not plone_tool.isIDAutoGenerated(l.id):
-            ids.sort()
-            _id = ids and ids[-1] or 0
-            new_id = _id + 1
-            return str(new_id)
+        def next_id(prefix, padding=None, sequence_start=None):
+            # the sequence is keyed by the normalized prefix, year included
+            key = fn_normalize(prefix)
+            catalog = id_catalog()
+
+            def format_id(number):
+                new_id = str(number)
+                if padding:
+                    new_id = new_id.zfill(int(padding))
+                return ('%s' + separator + '%s') % (prefix, new_id)
+
+            pool = _reserved_pool(context, key)
+            if pool is not None:
+                # Objects created in bulk (see reserved_ids)
+                while not pool['numbers']:
+                    numbers = reserve(context, key, pool['size'], catalog,
+                                      separator, sequence_start)
+                    ids = [(number, format_id(number)) for number in numbers]
+                    existing = set([brain.id for brain in
+                                    catalog(id=[i for n, i in ids])])
+                    pool['numbers'] = [(n, i) for n, i in ids
+                                       if i not in existing]
+                    pool['last'] = numbers[-1]
+                return pool['numbers'].pop(0)[1]
+
+            sequences = IDSequences(context)
+            seed_sequence(sequences, key, catalog, separator, sequence_start)
+            while True:
+                new_id = format_id(sequences.next(key))
+                # skip the ids of objects not created through the sequence
+                if not catalog(id=new_id):
+                    return new_id
 
         for d in prefixes:
             if context.portal_type == "Sample":
@@ -162,32 +444,18 @@ def generateUniqueId(context):
                 prefix = fn_normalize(context.getSampleType().getPrefix())
                 padding = context.bika_setup.getSampleIDPadding()
                 sequence_start = context.bika_setup.getSampleIDSequenceStart()
-                new_id = next_id(prefix+year)
-                # If sequence_start is greater than new_id. Set
-                # sequence_start as new_id. (Jira LIMS-280)
-                if sequence_start > int(new_id):
-                    new_id = str(sequence_start)
-                if padding:
-                    new_id = new_id.zfill(int(padding))
-                return ('%s%s' + separator + '%s') % (prefix, year, new_id)
+                return next_id(prefix+year, padding, sequence_start)
             elif d['portal_type'] == context.portal_type:
                 prefix = d['prefix']
                 padding = d['padding']
                 sequence_start = d.get("sequence_start", None)
-                new_id = next_id(prefix+year)
-                # Jira-tracker LIMS-280
-                if sequence_start and int(sequence_start) > int(new_id):
-                    new_id = str(sequence_start)
-                if padding:
-                    new_id = new_id.zfill(int(padding))
-                return ('%s%s' + separator + '%s') % (prefix, year, new_id)
+                return next_id(prefix+year, padding, sequence_start)
 
         # no prefix; use portal_type
         # no year inserted here
         # use "IID" normalizer, because we want portal_type to be lowercased.
         prefix = id_normalize(context.portal_type);
-        new_id = next_id(prefix)
-        return ('%s' + separator + '%s') % (prefix, new_id)
+        return next_id(prefix)
 
 def renameAfterCreation(obj):
     # Can't rename without a subtransaction commit when using portal_factory
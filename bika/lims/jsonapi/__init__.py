@@ -141,14 +141,12 @@ def resolve_request_lookup(context, request, fieldname):
     return brains
 
 
-def set_fields_from_request(obj, request):
-    """Search request for keys that match field names in obj,
-    and call field mutator with request value.
+def get_fields_from_request(context, schema, request):
+    """Search request for keys that match field names in schema, and
+    convert their values to what the fields take.
 
-    The list of fields for which schema mutators were found
-    is returned.
+    A dictionary with the converted values is returned.
     """
-    schema = obj.Schema()
     # fields contains all schema-valid field values from the request.
     fields = {}
     for fieldname, value in request.items():
@@ -157,18 +155,14 @@ def set_fields_from_request(obj, request):
         if schema[fieldname].type in ('reference'):
             brains = []
             if value:
-                brains = resolve_request_lookup(obj, request, fieldname)
+                brains = resolve_request_lookup(context, request, fieldname)
                 if not brains:
                     raise BadRequest("Can't resolve reference: %s" % fieldname)
             if schema[fieldname].multiValued:
                 value = [b.UID for b in brains] if brains else []
             else:
                 value = brains[0].UID if brains else None
-        fields[fieldname] = value
-    # Write fields.
-    for fieldname, value in fields.items():
-        field = schema[fieldname]
-        fieldtype = field.getType()
+        fieldtype = schema[fieldname].getType()
         if fieldtype == 'Products.Archetypes.Field.BooleanField':
             if value.lower() in ('0', 'false', 'no') or not value:
                 value = False
@@ -180,6 +174,22 @@ def set_fields_from_request(obj, request):
                 value = eval(value)
             except:
                 raise BadRequest(fieldname + ": Invalid JSON/Python variable")
+        fields[fieldname] = value
+    return fields
+
+
+def set_fields_from_request(obj, request):
+    """Search request for keys that match field names in obj,
+    and call field mutator with request value.
+
+    The list of fields for which schema mutators were found
+    is returned.
+    """
+    schema = obj.Schema()
+    fields = get_fields_from_request(obj, schema, request)
+    # Write fields.
+    for fieldname, value in fields.items():
+        field = schema[fieldname]
         mutator = field.getMutator(obj)
         if mutator:
             mutator(value)
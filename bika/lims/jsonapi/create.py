@@ -6,11 +6,14 @@
 from AccessControl import getSecurityManager
 from AccessControl import Unauthorized
 from bika.lims.idserver import renameAfterCreation
+from bika.lims.content.analysisrequest import schema as ar_schema
+from bika.lims.content.sample import schema as sample_schema
+from bika.lims.jsonapi import get_fields_from_request
 from bika.lims.jsonapi import set_fields_from_request
 from bika.lims.jsonapi import resolve_request_lookup
 from bika.lims.permissions import AccessJSONAPI
 from bika.lims.utils import tmpID, dicts_to_dict
-from bika.lims.workflow import doActionFor
+from bika.lims.utils.analysisrequest import create_analysisrequests
 from plone.jsonapi.core import router
 from plone.jsonapi.core.interfaces import IRouteProvider
 from Products.Archetypes.event import ObjectInitializedEvent
@@ -288,9 +291,12 @@ class Create(object):
 
         - CCEmails: A list of email addresses to include as above.
 
-        - Sample_id: Create a secondary AR with an existing sample.  If
+        - Sample: Create a secondary AR with an existing sample.  If
           unspecified, a new sample is created.
 
+        - Sample_id: The id of the existing sample of a secondary AR, as an
+          alternative to Sample.
+
         - Specification: a lookup to set Analysis specs default values
           for all analyses
 
@@ -302,16 +308,11 @@ class Create(object):
 
         """
 
-        wftool = getToolByName(context, 'portal_workflow')
-        bc = getToolByName(context, 'bika_catalog')
-        bsc = getToolByName(context, 'bika_setup_catalog')
-        pc = getToolByName(context, 'portal_catalog')
         ret = {
             "url": router.url_for("create", force_external=True),
             "success": True,
             "error": False,
         }
-        SamplingWorkflowEnabled = context.bika_setup.getSamplingWorkflowEnabled()
         for field in [
             'Client',
             'SampleType',
@@ -326,131 +327,29 @@ class Create(object):
         except IndexError:
             raise Exception("Client not found")
 
-        # Sample_id
-        if 'Sample' in request:
-            try:
-                sample = resolve_request_lookup(context, request, 'Sample')[0].getObject()
-            except IndexError:
-                raise Exception("Sample not found")
-        else:
-            # Primary AR
-            sample = _createObjectByType("Sample", client, tmpID())
-            sample.unmarkCreationFlag()
-            fields = set_fields_from_request(sample, request)
-            for field in fields:
-                self.used(field)
-            sample._renameAfterCreation()
-            sample.setSampleID(sample.getId())
-            event.notify(ObjectInitializedEvent(sample))
-            sample.at_post_create_script()
-
-            if SamplingWorkflowEnabled:
-                wftool.doActionFor(sample, 'sampling_workflow')
-            else:
-                wftool.doActionFor(sample, 'no_sampling_workflow')
-
-        ret['sample_id'] = sample.getId()
-
-        parts = [{'services': [],
-                  'container': [],
-                  'preservation': '',
-                  'separate': False}]
-
+        # Sample and AR field values.  With Sample, a secondary AR is
+        # created for an existing sample.
+        values = get_fields_from_request(context, sample_schema, request)
+        values.update(get_fields_from_request(context, ar_schema, request))
+        for fieldname in values.keys():
+            self.used(fieldname)
+        # BBB: the id of the Sample of a secondary AR
+        if request.get('Sample_id', '') and 'Sample' not in values:
+            bc = getToolByName(context, 'bika_catalog')
+            brains = bc(portal_type='Sample', id=request['Sample_id'])
+            if not brains:
+                raise BadRequest("Sample not found: %s" %
+                                 request['Sample_id'])
+            values['Sample'] = brains[0].UID
+        self.used('Sample_id')
         specs = self.get_specs_from_request()
-        ar = _createObjectByType("AnalysisRequest", client, tmpID())
-        ar.unmarkCreationFlag()
-        fields = set_fields_from_request(ar, request)
-        for field in fields:
-            self.used(field)
-        ar.setSample(sample.UID())
-        ar._renameAfterCreation()
-        ret['ar_id'] = ar.getId()
         brains = resolve_request_lookup(context, request, 'Services')
         service_uids = [p.UID for p in brains]
-        new_analyses = ar.setAnalyses(service_uids, specs=specs)
-        ar.setRequestID(ar.getId())
-        ar.reindexObject()
-        event.notify(ObjectInitializedEvent(ar))
-        ar.at_post_create_script()
-
-        # Create sample partitions
-        parts_and_services = {}
-        for _i in range(len(parts)):
-            p = parts[_i]
-            part_prefix = sample.getId() + "-P"
-            if '%s%s' % (part_prefix, _i + 1) in sample.objectIds():
-                parts[_i]['object'] = sample['%s%s' % (part_prefix, _i + 1)]
-                parts_and_services['%s%s' % (part_prefix, _i + 1)] = p['services']
-                part = parts[_i]['object']
-            else:
-                part = _createObjectByType("SamplePartition", sample, tmpID())
-                parts[_i]['object'] = part
-                container = None
-                preservation = p['preservation']
-                parts[_i]['prepreserved'] = False
-                part.edit(
-                    Container=container,
-                    Preservation=preservation,
-                )
-                part.processForm()
-                if SamplingWorkflowEnabled:
-                    wftool.doActionFor(part, 'sampling_workflow')
-                else:
-                    wftool.doActionFor(part, 'no_sampling_workflow')
-                parts_and_services[part.id] = p['services']
-
-        if SamplingWorkflowEnabled:
-            wftool.doActionFor(ar, 'sampling_workflow')
-        else:
-            wftool.doActionFor(ar, 'no_sampling_workflow')
-
-        # Add analyses to sample partitions
-        # XXX jsonapi create AR: right now, all new analyses are linked to the first samplepartition
-        if new_analyses:
-            analyses = list(part.getAnalyses())
-            analyses.extend(new_analyses)
-            part.edit(
-                Analyses=analyses,
-            )
-            for analysis in new_analyses:
-                analysis.setSamplePartition(part)
-
-        # If Preservation is required for some partitions,
-        # and the SamplingWorkflow is disabled, we need
-        # to transition to to_be_preserved manually.
-        if not SamplingWorkflowEnabled:
-            to_be_preserved = []
-            sample_due = []
-            lowest_state = 'sample_due'
-            for p in sample.objectValues('SamplePartition'):
-                if p.getPreservation():
-                    lowest_state = 'to_be_preserved'
-                    to_be_preserved.append(p)
-                else:
-                    sample_due.append(p)
-            for p in to_be_preserved:
-                doActionFor(p, 'to_be_preserved')
-            for p in sample_due:
-                doActionFor(p, 'sample_due')
-            doActionFor(sample, lowest_state)
-            for analysis in ar.objectValues('Analysis'):
-                doActionFor(analysis, lowest_state)
-            doActionFor(ar, lowest_state)
-
-        # receive secondary AR
-        if request.get('Sample_id', ''):
-            doActionFor(ar, 'sampled')
-            doActionFor(ar, 'sample_due')
-            not_receive = ['to_be_sampled', 'sample_due', 'sampled',
-                           'to_be_preserved']
-            sample_state = wftool.getInfoFor(sample, 'review_state')
-            if sample_state not in not_receive:
-                doActionFor(ar, 'receive')
-            for analysis in ar.getAnalyses(full_objects=1):
-                doActionFor(analysis, 'sampled')
-                doActionFor(analysis, 'sample_due')
-                if sample_state not in not_receive:
-                    doActionFor(analysis, 'receive')
+        ar = create_analysisrequests(client, request, [values],
+                                     analyses=service_uids,
+                                     specifications=specs)[0]
+        ret['sample_id'] = ar.getSample().getId()
+        ret['ar_id'] = ar.getId()
 
         if self.unused:
             raise BadRequest("The following request fields were not used: %s.  Request aborted." % self.unused)
@@ -4,6 +4,7 @@
 # Some rights reserved. See LICENSE.txt, AUTHORS.txt.
 
 from bika.lims.jsonapi.read import read
+from bika.lims.utils.reindex import deferred_reindexing
 from plone.jsonapi.core import router
 from plone.jsonapi.core.interfaces import IRouteProvider
 from Products.CMFCore.utils import getToolByName
@@ -14,6 +15,44 @@ import json
 import transaction
 
 
+def transition_objects(context, objects, action):
+    """Performs the workflow transition action on every object in objects.
+
+    Each object is transitioned in a savepoint of its own: if the
+    transition fails, only the changes made for that object are rolled
+    back, and the rest of the objects are transitioned anyway.  Reindexing
+    is deferred until commit, so the objects reindexed by the cascades of
+    many transitions (e.g. ARs and worksheets) are reindexed only once.
+
+    Returns a list with a dict for each object, with its UID and path, and
+    the success and error keys.
+    """
+    workflow = getToolByName(context, 'portal_workflow')
+    results = []
+    with deferred_reindexing() as queue:
+        for obj in objects:
+            result = {
+                "UID": obj.UID(),
+                "path": "/".join(obj.getPhysicalPath()),
+                "success": True,
+                "error": False,
+            }
+            savepoint = transaction.savepoint()
+            queued = queue.savepoint()
+            try:
+                workflow.doActionFor(obj, action)
+                obj.reindexObject()
+            except Exception as e:
+                savepoint.rollback()
+                queue.rollback(queued)
+                msg = "Cannot execute '{0}' on {1} ({2})".format(
+                    action, obj, e.message)
+                result["success"] = False
+                result["error"] = msg.replace("${action_id}", action)
+            results.append(result)
+    return results
+
+
 class doActionFor(object):
     interface.implements(IRouteProvider)
 
@@ -38,9 +77,11 @@ class doActionFor(object):
         Parameters used to locate objects are the same as used for the "read"
         method.
 
+        The result of each transition is returned in "results" (see
+        transition_objects): objects that cannot be transitioned don't
+        prevent the transition of the rest.
+
         """
-        savepoint = transaction.savepoint()
-        workflow = getToolByName(context, 'portal_workflow')
         uc = getToolByName(context, 'uid_catalog')
 
         action = request.get('action', '')
@@ -57,17 +98,11 @@ class doActionFor(object):
         objects = data.get('objects', [])
         if len(objects) == 0:
             raise BadRequest("No matching objects found")
-        for obj_dict in objects:
-            try:
-                obj = uc(UID=obj_dict['UID'])[0].getObject()
-                workflow.doActionFor(obj, action)
-                obj.reindexObject()
-            except Exception as e:
-                savepoint.rollback()
-                msg = "Cannot execute '{0}' on {1} ({2})".format(
-                    action, obj, e.message)
-                msg = msg.replace("${action_id}", action)
-                raise BadRequest(msg)
+        objects = [uc(UID=obj_dict['UID'])[0].getObject()
+                   for obj_dict in objects]
+        ret["results"] = transition_objects(context, objects, action)
+        ret["success"] = all([r["success"] for r in ret["results"]])
+        ret["error"] = not ret["success"]
         return ret
 
 
@@ -79,9 +114,10 @@ class doActionFor(object):
             - obj_paths: a json encoded list of objects to transition.
             - action: the id of the transition
 
+        The result of each transition is returned in "results" (see
+        transition_objects).
+
         """
-        savepoint = transaction.savepoint()
-        workflow = getToolByName(context, 'portal_workflow')
         site_path = request['PATH_INFO'].replace("/@@API/doActionFor_many", "")
 
         obj_paths = json.loads(request.get('f', '[]'))
@@ -95,19 +131,13 @@ class doActionFor(object):
             "error": False,
         }
 
+        objects = []
         for obj_path in obj_paths:
             if not obj_path.startswith("/"):
                 obj_path = "/" + obj_path
             obj = context.restrictedTraverse(str(site_path + obj_path))
-            if obj_path.startswith(site_path):
-                obj_path = obj_path[len(site_path):]
-            try:
-                workflow.doActionFor(obj, action)
-                obj.reindexObject()
-            except Exception as e:
-                savepoint.rollback()
-                msg = "Cannot execute '{0}' on {1} ({2})".format(
-                    action, obj, e.message)
-                msg = msg.replace("${action_id}", action)
-                raise BadRequest(msg)
+            objects.append(obj)
+        ret["results"] = transition_objects(context, objects, action)
+        ret["success"] = all([r["success"] for r in ret["results"]])
+        ret["error"] = not ret["success"]
         return ret
@@ -0,0 +1,63 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from AccessControl import getSecurityManager
+from AccessControl import Unauthorized
+from bika.lims.permissions import ManageBika
+from bika.lims.utils.instruments import get_failed_instruments
+from plone.jsonapi.core import router
+from plone.jsonapi.core.interfaces import IRouteProvider
+from Products.CMFCore.utils import getToolByName
+from zope import interface
+
+
+class failedInstruments(object):
+    interface.implements(IRouteProvider)
+
+    def initialize(self, context, request):
+        pass
+
+    @property
+    def routes(self):
+        return (
+            ("/failed_instruments", "failed_instruments",
+             self.failed_instruments, dict(methods=['GET', 'POST'])),
+        )
+
+    def failed_instruments(self, context, request):
+        """/@@API/failed_instruments: Return the active instruments that
+        cannot be used, as shown by the failed instruments viewlet
+
+        {
+            runtime: Function running time.
+            error: true or string(message) if error. false if no error.
+            success: true or string(message) if success. false if no success.
+            nr_failed: number of instruments that cannot be used.
+            failed: dictionary with a list of instruments for each reason
+                (out-of-date, qc-fail, next-test, validation, calibration).
+                Each instrument is a dictionary:
+                {uid: uid, title: title, url: url of the failure details}
+        }
+        """
+        portal = getToolByName(context, 'portal_url').getPortalObject()
+        if not getSecurityManager().checkPermission(ManageBika, portal):
+            raise Unauthorized("You don't have permission to view the "
+                               "failed instruments")
+        portal_url = portal.absolute_url()
+        summary = get_failed_instruments(portal)
+        failed = {}
+        for key, items in summary['failed'].items():
+            failed[key] = [{'uid': item['uid'],
+                            'title': item['title'],
+                            'url': '%s/%s' % (portal_url, item['path'])}
+                           for item in items]
+        ret = {
+            "url": router.url_for("failed_instruments", force_external=True),
+            "success": True,
+            "error": False,
+            "nr_failed": summary['nr_failed'],
+            "failed": failed,
+        }
+        return ret
@@ -12,6 +12,7 @@ from plone.jsonapi.core.interfaces import IRouteProvider
 from plone.protect.authenticator import AuthenticatorView
 from bika.lims.jsonapi import load_brain_metadata
 from bika.lims.jsonapi import load_field_values
+from bika.lims.utils.paging import CatalogPager
 from Products.CMFCore.utils import getToolByName
 from zope import interface
 from zope.component import getAdapters
@@ -70,9 +71,6 @@ def read(context, request):
     if debug_mode:
         logger.info("contentFilter: " + str(contentFilter))
 
-    # Get matching objects from catalog
-    proxies = catalog(**contentFilter)
-
     # batching items
     page_nr = int(request.get("page_nr", 0))
     try:
@@ -80,12 +78,19 @@ def read(context, request):
     except ValueError:
         page_size = 10
     # page_size == 0: show all
-    if page_size == 0:
-        page_size = len(proxies)
     first_item_nr = page_size * page_nr
-    if first_item_nr > len(proxies):
+    cursor = request.get("cursor", None)
+
+    # Get matching brains from catalog. Only the objects of the requested
+    # page are woken up; the total is counted from the catalog results
+    pager = CatalogPager(catalog, contentFilter, page_size=page_size,
+                         limit_from=first_item_nr, cursor=cursor)
+    page_proxies = pager.search()
+    if first_item_nr > pager.total and not cursor:
+        # keep the previous behaviour: out of range pages show the first one
         first_item_nr = 0
-    page_proxies = proxies[first_item_nr:first_item_nr + page_size]
+        pager = CatalogPager(catalog, contentFilter, page_size=page_size)
+        page_proxies = pager.search()
     for proxy in page_proxies:
         obj_data = {}
 
@@ -105,12 +110,13 @@ def read(context, request):
 
         ret['objects'].append(obj_data)
 
-    ret['total_objects'] = len(proxies)
+    ret['total_objects'] = pager.total
     ret['first_object_nr'] = first_item_nr
     last_object_nr = first_item_nr + len(page_proxies)
     if last_object_nr > ret['total_objects']:
         last_object_nr = ret['total_objects']
     ret['last_object_nr'] = last_object_nr
+    ret['next_cursor'] = pager.next_cursor
 
     if debug_mode:
         logger.info("{0} objects returned".format(len(ret['objects'])))
@@ -136,6 +142,10 @@ class Read(object):
 
             - catalog_name: uses portal_catalog if unspecified
             - limit  default=1
+            - page_size, page_nr: batching of the results (page_size=0 returns
+              all the results).
+            - cursor: the next_cursor returned by the previous page.  Deep
+              pages are much cheaper when requested with a cursor.
             - All catalog indexes are searched for in the request.
 
         {
@@ -143,6 +153,8 @@ class Read(object):
             error: true or string(message) if error. false if no error.
             success: true or string(message) if success. false if no success.
             objects: list of dictionaries, containing catalog metadata
+            total_objects: number of objects matching the query
+            next_cursor: cursor for the next page, or null
         }
         """
 
@@ -0,0 +1,19 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from bika.lims.utils.reindex import get_reindex_queue
+
+
+def reindexObject(self, idxs=[]):
+    """Queues the object to be reindexed at commit when deferred reindexing
+    is active (see bika.lims.utils.reindex), and reindexes it at once
+    otherwise.
+    """
+    queue = get_reindex_queue()
+    if queue is None:
+        return self._old_reindexObject(idxs=idxs)
+    immediate = queue.add(self, idxs)
+    if immediate:
+        self._old_reindexObject(idxs=immediate)
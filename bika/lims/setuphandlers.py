@@ -569,6 +569,15 @@ class BikaGenerator:
         addColumn(bac, 'getReferenceAnalysesGroupID')
         addColumn(bac, 'getResultCaptureDate')
         addColumn(bac, 'Priority')
+        addColumn(bac, 'getKeyword')
+        addColumn(bac, 'getServiceUID')
+        addColumn(bac, 'created')
+        addColumn(bac, 'getEarliness')
+        addColumn(bac, 'getDuration')
+        addColumn(bac, 'getServiceTitle')
+        addColumn(bac, 'getDepartmentUID')
+        addColumn(bac, 'getResult')
+        addColumn(bac, 'getFormattedResult')
 
         # bika_catalog
 
@@ -660,6 +669,7 @@ class BikaGenerator:
         addColumn(bc, 'portal_type')
         addColumn(bc, 'creator')
         addColumn(bc, 'Created')
+        addColumn(bc, 'created')
         addColumn(bc, 'Title')
         addColumn(bc, 'Description')
         addColumn(bc, 'sortable_title')
@@ -682,6 +692,9 @@ class BikaGenerator:
         addColumn(bc, 'getDatePublished')
         addColumn(bc, 'getDateReceived')
         addColumn(bc, 'getDateSampled')
+        addColumn(bc, 'getSamplingDate')
+        addColumn(bc, 'getBlank')
+        addColumn(bc, 'getSupportedServiceUIDs')
         addColumn(bc, 'review_state')
 
         # bika_setup_catalog
@@ -847,6 +860,7 @@ class BikaGenerator:
         addColumn(bsc, 'getSampleTypeUID')
         addColumn(bsc, 'getServiceTitle')
         addColumn(bsc, 'getServiceUID')
+        addColumn(bsc, 'getSortKey')
         addColumn(bsc, 'getTotalPrice')
         addColumn(bsc, 'getUnit')
         addColumn(bsc, 'getVATAmount')
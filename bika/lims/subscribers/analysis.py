@@ -10,6 +10,8 @@ from bika.lims.interfaces import IRoutineAnalysis
 from bika.lims.subscribers import doActionFor
 from bika.lims.subscribers import skip
 from bika.lims.utils import changeWorkflowState
+from bika.lims.utils.resultshistory import HISTORY_STATES
+from bika.lims.utils.resultshistory import index_analysis_result
 from DateTime import DateTime
 from Products.Archetypes.config import REFERENCE_CATALOG
 from Products.Archetypes.event import ObjectInitializedEvent
@@ -135,3 +137,12 @@ def ObjectRemovedEventHandler(instance, event):
                 skip(ar, 'assign', unskip=True)
 
     return
+
+
+def AfterTransitionEventHandler(instance, event):
+    """ Keeps the results history of the Batch of the AR up to date with
+        the verified and published results
+    """
+    if event.new_state.id in HISTORY_STATES \
+            or (event.old_state and event.old_state.id in HISTORY_STATES):
+        index_analysis_result(instance)
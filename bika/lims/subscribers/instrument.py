@@ -0,0 +1,27 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from bika.lims.utils.instruments import invalidate_failed_instruments
+
+
+def ObjectInitializedEventHandler(instrument, event):
+    """ The QC and validity statuses of new instruments are stored on
+        creation, so reading them never writes
+    """
+    instrument.updateQCStatus()
+    instrument.updateValidityStatus()
+
+
+def AfterTransitionEventHandler(instrument, event):
+    """ Instruments deactivated or activated are removed from (or added to)
+        the failed instruments summary
+    """
+    invalidate_failed_instruments(instrument)
+
+
+def ObjectRemovedEventHandler(instrument, event):
+    """ Removed instruments are removed from the failed instruments summary
+    """
+    invalidate_failed_instruments(instrument)
@@ -0,0 +1,13 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from bika.lims.utils.mailqueue import outbox_worker
+
+
+def DatabaseOpenedEventHandler(event):
+    """ Starts the outbox worker when Zope starts, to deliver the messages
+        left in the outboxes by the previous run
+    """
+    outbox_worker.start(event.database)
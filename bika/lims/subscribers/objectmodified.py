@@ -3,9 +3,16 @@
 # Copyright 2011-2016 by it's authors.
 # Some rights reserved. See LICENSE.txt, AUTHORS.txt.
 
+from Acquisition import aq_inner
+from Acquisition import aq_parent
 from Products.CMFCore.utils import getToolByName
 from Products.CMFCore import permissions
 from bika.lims.permissions import ManageSupplyOrders, ManageLoginDetails
+from bika.lims.utils.analysis import invalidate_dependency_caches
+from bika.lims.utils.formula import invalidate_compiled_formulas
+from bika.lims.utils.instruments import invalidate_failed_instruments
+from bika.lims.utils.services import invalidate_service_keywords
+from bika.lims.utils.typeahead import update_typeahead_indexes
 
 
 def ObjectModifiedEventHandler(obj, event):
@@ -14,7 +21,31 @@ def ObjectModifiedEventHandler(obj, event):
     if not hasattr(obj, 'portal_type'):
         return
 
+    # Titles searched by the reference widgets might have changed
+    update_typeahead_indexes(obj)
+
+    if obj.portal_type in ('Calculation', 'AnalysisService'):
+        # The dependencies amongst analyses might have changed
+        invalidate_dependency_caches(obj)
+
+    if obj.portal_type == 'AnalysisService':
+        # The keyword of the service might have changed
+        invalidate_service_keywords(obj)
+
+    if obj.portal_type in ('InstrumentCertification', 'InstrumentValidation',
+                           'InstrumentCalibration'):
+        # The validity of the instrument might have changed
+        aq_parent(aq_inner(obj)).updateValidityStatus()
+        invalidate_failed_instruments(obj)
+    elif obj.portal_type == 'Instrument':
+        # Also notified when a certification, validation or calibration
+        # is removed from the instrument
+        obj.updateValidityStatus()
+        invalidate_failed_instruments(obj)
+
     if obj.portal_type == 'Calculation':
+        # The formula is compiled again on next use
+        invalidate_compiled_formulas(obj.UID())
         pr = getToolByName(obj, 'portal_repository')
         uc = getToolByName(obj, 'uid_catalog')
         obj = uc(UID=obj.UID())[0].getObject()
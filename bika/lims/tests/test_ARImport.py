@@ -5,12 +5,18 @@
 
 from Products.CMFPlone.utils import _createObjectByType
 from bika.lims import logger
+from bika.lims.browser.arimports import ARImportResumeView
+from bika.lims.content.arimport import ARImport
 from bika.lims.content.analysis import Analysis
 from bika.lims.testing import BIKA_SIMPLE_FIXTURE
 from bika.lims.tests.base import BikaSimpleTestCase
 from bika.lims.utils import tmpID
+from bika.lims.utils.arimportqueue import DONE, FAILED, QUEUED, RUNNING
+from bika.lims.utils.arimportqueue import arimport_workers
+from bika.lims.utils.arimportqueue import can_resume
 from bika.lims.workflow import doActionFor
 from plone.app.testing import login, logout
+from plone.app.testing import TEST_USER_ID
 from plone.app.testing import TEST_USER_NAME
 from Products.CMFCore.utils import getToolByName
 
@@ -23,6 +29,21 @@ try:
 except ImportError:  # Python 2.7
     import unittest
 
+VALID_CSV = """
+Header,      File name,  Client name,  Client ID, Contact,     CC Names - Report, CC Emails - Report, CC Names - Invoice, CC Emails - Invoice, No of Samples, Client Order Number, Client Reference,,
+Header Data, test1.csv,  Happy Hills,  HH,        Rita Mohale,                  ,                   ,                    ,                    , 10,            HHPO-001,                            ,,
+Batch Header, id,       title,     description,    ClientBatchID, ClientBatchComment, BatchLabels, ReturnSampleToClient,,,
+Batch Data,   B15-0123, New Batch, Optional descr, CC 201506,     Just a batch,                  , TRUE                ,,,
+Samples,    ClientSampleID,    SamplingDate,DateSampled,SamplePoint,SampleMatrix,SampleType,ContainerType,ReportDryMatter,Priority,Total number of Analyses or Profiles,Price excl Tax,ECO,SAL,COL,TAS,MicroBio,Properties
+Analysis price,,,,,,,,,,,,,,
+"Total Analyses or Profiles",,,,,,,,,,,,,9,,,
+Total price excl Tax,,,,,,,,,,,,,,
+"Sample 1", HHS14001,          3/9/2014,    3/9/2014,   Toilet,     Liquids,     Water,     Cup,          0,              Normal,  1,                                   0,             0,0,0,0,0,1
+"Sample 2", HHS14002,          3/9/2014,    3/9/2014,   Toilet,     Liquids,     Water,     Cup,          0,              Normal,  2,                                   0,             0,0,0,0,1,1
+"Sample 3", HHS14002,          3/9/2014,    3/9/2014,   Toilet,     Liquids,     Water,     Cup,          0,              Normal,  4,                                   0,             1,1,1,1,0,0
+"Sample 4", HHS14002,          3/9/2014,    3/9/2014,   Toilet,     Liquids,     Water,     Cup,          0,              Normal,  2,                                   0,             1,0,0,0,1,0
+"""
+
 
 class TestARImports(BikaSimpleTestCase):
 
@@ -75,20 +96,7 @@ class TestARImports(BikaSimpleTestCase):
         arimport = self.addthing(self.client, 'ARImport')
         arimport.unmarkCreationFlag()
         arimport.setFilename("test1.csv")
-        arimport.setOriginalFile("""
-Header,      File name,  Client name,  Client ID, Contact,     CC Names - Report, CC Emails - Report, CC Names - Invoice, CC Emails - Invoice, No of Samples, Client Order Number, Client Reference,,
-Header Data, test1.csv,  Happy Hills,  HH,        Rita Mohale,                  ,                   ,                    ,                    , 10,            HHPO-001,                            ,,
-Batch Header, id,       title,     description,    ClientBatchID, ClientBatchComment, BatchLabels, ReturnSampleToClient,,,
-Batch Data,   B15-0123, New Batch, Optional descr, CC 201506,     Just a batch,                  , TRUE                ,,,
-Samples,    ClientSampleID,    SamplingDate,DateSampled,SamplePoint,SampleMatrix,SampleType,ContainerType,ReportDryMatter,Priority,Total number of Analyses or Profiles,Price excl Tax,ECO,SAL,COL,TAS,MicroBio,Properties
-Analysis price,,,,,,,,,,,,,,
-"Total Analyses or Profiles",,,,,,,,,,,,,9,,,
-Total price excl Tax,,,,,,,,,,,,,,
-"Sample 1", HHS14001,          3/9/2014,    3/9/2014,   Toilet,     Liquids,     Water,     Cup,          0,              Normal,  1,                                   0,             0,0,0,0,0,1
-"Sample 2", HHS14002,          3/9/2014,    3/9/2014,   Toilet,     Liquids,     Water,     Cup,          0,              Normal,  2,                                   0,             0,0,0,0,1,1
-"Sample 3", HHS14002,          3/9/2014,    3/9/2014,   Toilet,     Liquids,     Water,     Cup,          0,              Normal,  4,                                   0,             1,1,1,1,0,0
-"Sample 4", HHS14002,          3/9/2014,    3/9/2014,   Toilet,     Liquids,     Water,     Cup,          0,              Normal,  2,                                   0,             1,0,0,0,1,0
-        """)
+        arimport.setOriginalFile(VALID_CSV)
 
         # check that values are saved without errors
         arimport.setErrors([])
@@ -142,6 +150,105 @@ Total price excl Tax,,,,,,,,,,,,,,
                   for a in analyses]
         if states != ['sample_due'] * 12:
             self.fail('Analysis states should all be sample_due, but are not!')
+        # the profiles of each row are stored in the ARs
+        profiles = sorted([tuple(sorted([p.Title() for p in
+                                         ar.getObject().getProfiles()]))
+                           for ar in ars])
+        self.assertEqual(profiles, [(), ('MicroBio',),
+                                    ('MicroBio', 'Properties'),
+                                    ('Properties',)])
+
+    def validated_arimport(self):
+        workflow = getToolByName(self.portal, 'portal_workflow')
+        arimport = self.addthing(self.client, 'ARImport')
+        arimport.unmarkCreationFlag()
+        arimport.setFilename("test1.csv")
+        arimport.setOriginalFile(VALID_CSV)
+        arimport.setErrors([])
+        arimport.save_header_data()
+        arimport.save_sample_data()
+        arimport.create_or_reference_batch()
+        # the workflow scripts use response.write(); silence them
+        arimport.REQUEST.response.write = lambda x: x
+        workflow.doActionFor(arimport, 'validate')
+        self.assertEqual(workflow.getInfoFor(arimport, 'review_state'),
+                         'valid')
+        return arimport
+
+    def run_import(self, arimport):
+        transaction.commit()
+        db = self.portal._p_jar.db()
+        portal_path = '/'.join(self.portal.getPhysicalPath())
+        path = '/'.join(arimport.getPhysicalPath())
+        arimport_workers.process(db, portal_path, path, TEST_USER_ID)
+        transaction.begin()
+
+    def test_background_import(self):
+        bc = getToolByName(self.portal, 'bika_catalog')
+        workflow = getToolByName(self.portal, 'portal_workflow')
+        self.portal.bika_setup.setARImportBatchSize(3)
+        arimport = self.validated_arimport()
+        dispatched = []
+        arimport_workers.dispatch = lambda *args: dispatched.append(args)
+        try:
+            workflow.doActionFor(arimport, 'import')
+            self.assertEqual(arimport.getImportStatus(), QUEUED)
+            # nothing is created until the transaction is committed
+            self.assertEqual(len(bc(portal_type='AnalysisRequest')), 0)
+            self.run_import(arimport)
+        finally:
+            del arimport_workers.dispatch
+        path = '/'.join(arimport.getPhysicalPath())
+        self.assertEqual([args[2:] for args in dispatched],
+                         [(path, TEST_USER_ID)])
+        self.assertEqual(arimport.getImportStatus(), DONE)
+        self.assertEqual(arimport.getImportedRows(), 4)
+        self.assertFalse(can_resume(arimport))
+        # the ARs created by the worker are indexed
+        self.assertEqual(len(bc(portal_type='AnalysisRequest')), 4)
+
+    def test_resume_failed_import(self):
+        bc = getToolByName(self.portal, 'bika_catalog')
+        workflow = getToolByName(self.portal, 'portal_workflow')
+        self.portal.bika_setup.setARImportBatchSize(3)
+        arimport = self.validated_arimport()
+        import_rows = ARImport.import_rows
+
+        def failing_import_rows(self, start=0, stop=None, progress=None):
+            if start >= 3:
+                raise ValueError("Broken row")
+            return import_rows(self, start, stop, progress)
+
+        arimport_workers.dispatch = lambda *args: None
+        ARImport.import_rows = failing_import_rows
+        try:
+            workflow.doActionFor(arimport, 'import')
+            self.run_import(arimport)
+        finally:
+            ARImport.import_rows = import_rows
+        try:
+            # the first batch is committed, the second one is not
+            self.assertEqual(arimport.getImportStatus(), FAILED)
+            self.assertEqual(arimport.getImportedRows(), 3)
+            self.assertEqual(len(bc(portal_type='AnalysisRequest')), 3)
+            self.assertTrue('Row 4: Broken row' in arimport.getErrors())
+            self.assertTrue(can_resume(arimport))
+            # not resumed while the worker runs it
+            path = '/'.join(arimport.getPhysicalPath())
+            arimport_workers.pending.add(path)
+            arimport.setImportStatus(RUNNING)
+            self.assertFalse(can_resume(arimport))
+            arimport_workers.pending.discard(path)
+            self.assertTrue(can_resume(arimport))
+            # resumed from the last committed row
+            ARImportResumeView(arimport, self.portal.REQUEST)()
+            self.assertEqual(arimport.getImportStatus(), QUEUED)
+            self.run_import(arimport)
+        finally:
+            del arimport_workers.dispatch
+        self.assertEqual(arimport.getImportStatus(), DONE)
+        self.assertEqual(arimport.getImportedRows(), 4)
+        self.assertEqual(len(bc(portal_type='AnalysisRequest')), 4)
 
     def test_LIMS_2080_correctly_interpret_false_and_blank_values(self):
         pc = getToolByName(self.portal, 'portal_catalog')
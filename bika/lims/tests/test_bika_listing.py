@@ -0,0 +1,60 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from bika.lims.controlpanel.bika_analysiscategories import \
+    AnalysisCategoriesView
+from bika.lims.testing import BIKA_FUNCTIONAL_TESTING
+from bika.lims.tests.base import BikaFunctionalTestCase
+from plone.app.testing import login, logout
+from plone.app.testing import TEST_USER_NAME
+
+try:
+    import unittest2 as unittest
+except ImportError: # Python 2.7
+    import unittest
+
+
+class TestRenderFromMetadata(BikaFunctionalTestCase):
+    layer = BIKA_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        super(TestRenderFromMetadata, self).setUp()
+        login(self.portal, TEST_USER_NAME)
+        self.folder = self.portal.bika_setup.bika_analysiscategories
+
+    def tearDown(self):
+        logout()
+        super(TestRenderFromMetadata, self).tearDown()
+
+    def folderitems(self, render_from_metadata):
+        view = AnalysisCategoriesView(self.folder, self.request)
+        view.render_from_metadata = render_from_metadata
+        view._process_request()
+        view.show_all = True
+        items = view.folderitems()
+        return view, dict([(item['uid'], item) for item in items])
+
+    def test_same_rows_as_objects(self):
+        view, items = self.folderitems(True)
+        self.assertTrue(items)
+        self.assertEqual(view.counters['objects'], 0)
+        self.assertEqual(view.counters['brains'], len(items))
+        full_view, full_items = self.folderitems(False)
+        self.assertEqual(sorted(items.keys()), sorted(full_items.keys()))
+        for uid, item in items.items():
+            full_item = full_items[uid]
+            for key in ('Title', 'Description', 'Department', 'SortKey'):
+                self.assertEqual(item[key], full_item[key])
+            # the title links to the category
+            self.assertEqual(item['replace']['Title'],
+                             full_item['replace']['Title'])
+            self.assertTrue(item['replace']['Title'].startswith('<a href='))
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestRenderFromMetadata))
+    suite.layer = BIKA_FUNCTIONAL_TESTING
+    return suite
@@ -7,7 +7,9 @@ from bika.lims import logger
 from bika.lims.content.analysis import Analysis
 from bika.lims.testing import BIKA_FUNCTIONAL_TESTING
 from bika.lims.tests.base import BikaFunctionalTestCase
+from bika.lims.utils.analysis import get_dependency_graph
 from bika.lims.utils.analysisrequest import create_analysisrequest
+from bika.lims.utils.calculation import calculate_ar_results
 from bika.lims.workflow import doActionFor
 from plone.app.testing import login, logout
 from plone.app.testing import TEST_USER_NAME
@@ -356,6 +358,59 @@ class TestCalculations(BikaFunctionalTestCase):
             calcanalysis.calculateResult(True, True)
             self.assertEqual(float(calcanalysis.getResult()), float(f['exresult']))
 
+    def test_dependency_graph(self):
+        # The dependencies amongst the analyses of an AR are resolved once
+        # per request, from catalog metadata
+        self.calculation.setFormula('[Ca]+[Mg]')
+        client = self.portal.clients['client-1']
+        sampletype = self.portal.bika_setup.bika_sampletypes['sampletype-1']
+        values = {'Client': client.UID(),
+                  'Contact': client.getContacts()[0].UID(),
+                  'SamplingDate': '2015-01-01',
+                  'SampleType': sampletype.UID()}
+        services = [s.UID() for s in self.services] + [self.calcservice.UID()]
+        ar = create_analysisrequest(client, {}, values, services)
+
+        graph = get_dependency_graph(ar)
+        self.assertTrue(graph is get_dependency_graph(ar))
+        analyses = dict([(a.getKeyword(), a)
+                         for a in ar.getAnalyses(full_objects=True)])
+        calckw = self.calcservice.getKeyword()
+        deps = analyses[calckw].getDependencies()
+        self.assertEqual(sorted([d.getKeyword() for d in deps]),
+                         ['Ca', 'Mg'])
+        self.assertEqual(analyses['Ca'].getDependents(), [analyses[calckw]])
+        self.assertEqual(analyses['Ca'].getDependencies(), [])
+        self.assertEqual(graph.dependent_keywords['Mg'], set([calckw]))
+
+        # Changing the formula discards the cached dependencies
+        self.calculation.setFormula('[Ca]')
+        self.assertFalse(graph is get_dependency_graph(ar))
+        deps = analyses[calckw].getDependencies()
+        self.assertEqual([d.getKeyword() for d in deps], ['Ca'])
+
+    def test_calculate_ar_results(self):
+        # All the results of the ARs are calculated once, in dependency order
+        self.calculation.setFormula('[Ca]+[Mg]')
+        self.calculation.setInterimFields([])
+        client = self.portal.clients['client-1']
+        sampletype = self.portal.bika_setup.bika_sampletypes['sampletype-1']
+        values = {'Client': client.UID(),
+                  'Contact': client.getContacts()[0].UID(),
+                  'SamplingDate': '2015-01-01',
+                  'SampleType': sampletype.UID()}
+        services = [s.UID() for s in self.services] + [self.calcservice.UID()]
+        ar = create_analysisrequest(client, {}, values, services)
+        analyses = dict([(a.getKeyword(), a)
+                         for a in ar.getAnalyses(full_objects=True)])
+        analyses['Ca'].setResult('2')
+        analyses['Mg'].setResult('3')
+
+        calculated = calculate_ar_results([ar])
+        calckw = self.calcservice.getKeyword()
+        self.assertEqual(calculated, [analyses[calckw]])
+        self.assertEqual(float(analyses[calckw].getResult()), 5.0)
+
     def test_calculation_fixed_precision(self):
         # Input results
         # Client:       Happy Hills
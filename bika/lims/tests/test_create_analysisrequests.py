@@ -0,0 +1,118 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from bika.lims.idserver import IDSequences
+from bika.lims.testing import BIKA_FUNCTIONAL_TESTING
+from bika.lims.tests.base import BikaFunctionalTestCase
+from bika.lims.utils.analysisrequest import create_analysisrequest
+from bika.lims.utils.analysisrequest import create_analysisrequests
+from plone.app.testing import login, logout
+from plone.app.testing import TEST_USER_NAME
+from Products.CMFCore.utils import getToolByName
+import re
+
+try:
+    import unittest2 as unittest
+except ImportError: # Python 2.7
+    import unittest
+
+
+def id_number(obj_id):
+    return int(re.search(r'(\d+)$', obj_id).group(1))
+
+
+class TestCreateAnalysisRequests(BikaFunctionalTestCase):
+    layer = BIKA_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        super(TestCreateAnalysisRequests, self).setUp()
+        login(self.portal, TEST_USER_NAME)
+        self.portal.bika_setup.setExternalIDServer(False)
+        self.client = self.portal.clients['client-1']
+        sampletype = self.portal.bika_setup.bika_sampletypes['sampletype-1']
+        self.values = {'Client': self.client.UID(),
+                       'Contact': self.client.getContacts()[0].UID(),
+                       'SamplingDate': '2015-01-01',
+                       'SampleType': sampletype.UID()}
+        services = self.portal.bika_setup.bika_analysisservices
+        self.services = [services[s].UID() for s in
+                         ('analysisservice-1', 'analysisservice-3',
+                          'analysisservice-6')]
+
+    def tearDown(self):
+        logout()
+        super(TestCreateAnalysisRequests, self).tearDown()
+
+    def workflow_state(self, obj):
+        """Returns the review state of obj, and the transitions it went
+        through
+        """
+        workflow = getToolByName(self.portal, 'portal_workflow')
+        history = workflow.getInfoFor(obj, 'review_history', [])
+        return (workflow.getInfoFor(obj, 'review_state'),
+                [h['action'] for h in history])
+
+    def state(self, ar):
+        sample = ar.getSample()
+        analyses = [(a.getKeyword(),
+                     self.workflow_state(a),
+                     a.getNumberOfRequiredVerifications(),
+                     a.getSamplePartition().getId()[len(sample.getId()):])
+                    for a in ar.getAnalyses(full_objects=True)]
+        return {'ar': self.workflow_state(ar),
+                'sample': self.workflow_state(sample),
+                'partitions': [self.workflow_state(p) for p in
+                               sample.objectValues('SamplePartition')],
+                'analyses': sorted(analyses)}
+
+    def test_same_as_single_creation(self):
+        single = create_analysisrequest(
+            self.client, {}, self.values, self.services)
+        ars = create_analysisrequests(
+            self.client, {}, [self.values, self.values], self.services)
+        self.assertEqual(len(ars), 2)
+        for ar in ars:
+            self.assertEqual(self.state(ar), self.state(single))
+            self.assertEqual(len(ar.getAnalyses()), 3)
+
+    def test_shared_lookups(self):
+        lookups = {}
+        created = []
+        ars = create_analysisrequests(
+            self.client, {}, [self.values] * 3, self.services,
+            lookups=lookups, progress=created.append)
+        self.assertEqual(created, [1, 2, 3])
+        self.assertEqual(sorted(lookups['services'].keys()),
+                         sorted(self.services))
+        # each AR gets its own analyses and interim fields
+        analyses = [a for ar in ars for a in ar.getAnalyses(full_objects=True)]
+        self.assertEqual(len(set([a.UID() for a in analyses])), 9)
+        for ar in ars:
+            for analysis in ar.getAnalyses(full_objects=True):
+                self.assertEqual(analysis.aq_parent, ar)
+        interims = [id(a.getInterimFields()[0]) for a in analyses
+                    if a.getInterimFields()]
+        self.assertEqual(len(interims), len(set(interims)))
+
+    def test_reserved_ids(self):
+        first = create_analysisrequest(
+            self.client, {}, self.values, self.services)
+        ars = create_analysisrequests(
+            self.client, {}, [self.values] * 3, self.services)
+        numbers = [id_number(ar.getSample().getId()) for ar in ars]
+        start = id_number(first.getSample().getId()) + 1
+        self.assertEqual(numbers, range(start, start + 3))
+        # the sequence was advanced as far as the ids used
+        sequences = IDSequences(self.portal)
+        keys = [k for k in sequences.sequences.keys()
+                if ars[-1].getSample().getId().startswith(k)]
+        self.assertEqual([sequences.get(k) for k in keys], [numbers[-1]])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestCreateAnalysisRequests))
+    suite.layer = BIKA_FUNCTIONAL_TESTING
+    return suite
@@ -0,0 +1,93 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from bika.lims.utils import formula
+from bika.lims.utils.formula import CompiledFormula
+from bika.lims.utils.formula import get_compiled_formula
+from bika.lims.utils.formula import invalidate_compiled_formulas
+from bika.lims.utils.versions import LRUCache
+from decimal import Decimal
+
+try:
+    import unittest2 as unittest
+except ImportError: # Python 2.7
+    import unittest
+
+
+class Calculation(object):
+    """Stands in for a Calculation
+    """
+
+    def __init__(self, uid, formula, version_id=None):
+        self.uid = uid
+        self.formula = formula
+        self.version_id = version_id
+
+    def UID(self):
+        return self.uid
+
+    def getMinifiedFormula(self):
+        return self.formula
+
+
+class TestCompiledFormula(unittest.TestCase):
+
+    def test_keywords(self):
+        compiled = CompiledFormula("([Ca] + [Mg]) / [Ca]")
+        self.assertEqual(compiled.keywords, ['Ca', 'Mg'])
+        self.assertEqual(compiled({'Ca': 2, 'Mg': 6}), 4.0)
+
+    def test_numbers(self):
+        compiled = CompiledFormula("[Ca] * 2")
+        for value in (3, 3L, 3.0, Decimal('3')):
+            self.assertEqual(compiled({'Ca': value}), 6.0)
+        # rounded as the '%f' interpolation did
+        self.assertEqual(compiled({'Ca': Decimal('0.0000001')}), 0.0)
+
+    def test_errors(self):
+        compiled = CompiledFormula("[Ca] / [Mg]")
+        for value in ('3', None, True, 1j):
+            self.assertRaises(TypeError, compiled, {'Ca': value, 'Mg': 1})
+        self.assertRaises(KeyError, compiled, {'Ca': 1})
+        self.assertRaises(ZeroDivisionError, compiled, {'Ca': 1, 'Mg': 0})
+
+
+class TestFormulaCache(unittest.TestCase):
+
+    def setUp(self):
+        self._formulas = formula._formulas
+        formula._formulas = LRUCache(2)
+
+    def tearDown(self):
+        formula._formulas = self._formulas
+
+    def test_cached_by_uid_and_version(self):
+        calculation = Calculation('uid-1', "[Ca] + 1")
+        compiled = get_compiled_formula(calculation)
+        self.assertTrue(get_compiled_formula(calculation) is compiled)
+        # another version
+        version = Calculation('uid-1', "[Ca] + 2", version_id=1)
+        self.assertEqual(get_compiled_formula(version)({'Ca': 1}), 3.0)
+        # the formula has changed
+        calculation.formula = "[Ca] + 3"
+        self.assertEqual(get_compiled_formula(calculation)({'Ca': 1}), 4.0)
+
+    def test_bounded(self):
+        for i in range(5):
+            get_compiled_formula(Calculation('uid-%s' % i, "[Ca]"))
+        self.assertEqual(len(formula._formulas), 2)
+
+    def test_invalidate(self):
+        get_compiled_formula(Calculation('uid-1', "[Ca]"))
+        get_compiled_formula(Calculation('uid-1', "[Ca]", version_id=1))
+        invalidate_compiled_formulas('uid-1')
+        self.assertEqual(len(formula._formulas), 0)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestCompiledFormula))
+    suite.addTest(unittest.makeSuite(TestFormulaCache))
+    return suite
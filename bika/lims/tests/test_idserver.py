@@ -0,0 +1,194 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from bika.lims.idserver import IDBlockAllocator
+from bika.lims.idserver import IDSequences
+from bika.lims.idserver import SEQUENCES_KEY
+from bika.lims.idserver import reserve
+from bika.lims.idserver import reserved_ids
+from bika.lims.testing import BIKA_FUNCTIONAL_TESTING
+from bika.lims.tests.base import BikaFunctionalTestCase
+from bika.lims.utils.analysisrequest import create_analysisrequest
+from plone.app.testing import login, logout
+from plone.app.testing import TEST_USER_NAME
+from Products.CMFCore.utils import getToolByName
+from zope.annotation.interfaces import IAnnotations
+import re
+import transaction
+
+try:
+    import unittest2 as unittest
+except ImportError: # Python 2.7
+    import unittest
+
+
+def id_number(obj_id):
+    return int(re.search(r'(\d+)$', obj_id).group(1))
+
+
+class TestIDServer(BikaFunctionalTestCase):
+    layer = BIKA_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        super(TestIDServer, self).setUp()
+        login(self.portal, TEST_USER_NAME)
+        self.portal.bika_setup.setExternalIDServer(False)
+        self.client = self.portal.clients['client-1']
+        self.sampletype = \
+            self.portal.bika_setup.bika_sampletypes['sampletype-1']
+        services = self.portal.bika_setup.bika_analysisservices
+        self.services = [services['analysisservice-3'].UID()]
+
+    def tearDown(self):
+        logout()
+        super(TestIDServer, self).tearDown()
+
+    def create_sample(self):
+        values = {'Client': self.client.UID(),
+                  'Contact': self.client.getContacts()[0].UID(),
+                  'SamplingDate': '2015-01-01',
+                  'SampleType': self.sampletype.UID()}
+        ar = create_analysisrequest(self.client, {}, values, self.services)
+        return ar.getSample()
+
+    def sequence_key(self, sample):
+        sequences = IDSequences(self.portal)
+        keys = [k for k in sequences.sequences.keys()
+                if sample.getId().startswith(k)]
+        self.assertEqual(len(keys), 1)
+        return sequences, keys[0]
+
+    def test_seeding(self):
+        first = self.create_sample()
+        sequences, key = self.sequence_key(first)
+        # a sequence that does not exist yet is seeded from the catalog
+        del sequences.sequences[key]
+        second = self.create_sample()
+        self.assertEqual(id_number(second.getId()),
+                         id_number(first.getId()) + 1)
+        self.assertEqual(sequences.get(key), id_number(second.getId()))
+
+    def test_sequence_start(self):
+        first = self.create_sample()
+        self.portal.bika_setup.setSampleIDSequenceStart(
+            id_number(first.getId()) + 50)
+        second = self.create_sample()
+        self.assertEqual(id_number(second.getId()),
+                         id_number(first.getId()) + 50)
+        # the sequence goes on from there
+        self.portal.bika_setup.setSampleIDSequenceStart(0)
+        third = self.create_sample()
+        self.assertEqual(id_number(third.getId()),
+                         id_number(second.getId()) + 1)
+
+    def test_skip_existing_ids(self):
+        first = self.create_sample()
+        second = self.create_sample()
+        sequences, key = self.sequence_key(second)
+        # the next two ids already exist
+        sequences.sequences[key].value = id_number(first.getId()) - 1
+        third = self.create_sample()
+        self.assertEqual(id_number(third.getId()),
+                         id_number(second.getId()) + 1)
+
+    def test_reserve_seeds_the_sequence(self):
+        first = self.create_sample()
+        sequences, key = self.sequence_key(first)
+        del sequences.sequences[key]
+        bc = getToolByName(self.portal, 'bika_catalog')
+        separator = first.getId()[len(key):].rstrip('0123456789')
+        numbers = reserve(self.portal, key, 3, bc, separator)
+        start = id_number(first.getId()) + 1
+        self.assertEqual(numbers, range(start, start + 3))
+        self.assertEqual(sequences.get(key), start + 2)
+
+    def test_reserved_ids(self):
+        first = self.create_sample()
+        with reserved_ids(10):
+            second = self.create_sample()
+            third = self.create_sample()
+        self.assertEqual(id_number(second.getId()),
+                         id_number(first.getId()) + 1)
+        self.assertEqual(id_number(third.getId()),
+                         id_number(first.getId()) + 2)
+        # the numbers not used are given back
+        sequences, key = self.sequence_key(third)
+        self.assertEqual(sequences.get(key), id_number(third.getId()))
+
+
+class TestIDBlockAllocator(BikaFunctionalTestCase):
+    layer = BIKA_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        super(TestIDBlockAllocator, self).setUp()
+        # the blocks are reserved from a separate connection
+        transaction.commit()
+
+    def committed_value(self, prefix):
+        """Returns the last number of the sequence, as committed
+        """
+        db = self.portal._p_jar.db()
+        tm = transaction.TransactionManager()
+        connection = db.open(transaction_manager=tm)
+        try:
+            site = connection.get(self.portal._p_oid)
+            sequences = IAnnotations(site).get(SEQUENCES_KEY, {})
+            sequence = sequences.get(prefix, None)
+            return sequence.value if sequence is not None else None
+        finally:
+            tm.abort()
+            connection.close()
+
+    def test_block_exhaustion(self):
+        allocator = IDBlockAllocator(block_size=3)
+        numbers = [allocator.allocate(self.portal, 'exhaust-')[0]
+                   for i in range(7)]
+        self.assertEqual(numbers, range(1, 8))
+        # three blocks of three numbers committed
+        self.assertEqual(self.committed_value('exhaust-'), 9)
+        # more numbers than a block: the rest of the current block, and
+        # a block as large as needed
+        numbers = allocator.allocate(self.portal, 'exhaust-', 5)
+        self.assertEqual(numbers, range(8, 13))
+        self.assertEqual(self.committed_value('exhaust-'), 12)
+
+    def test_allocators_sharing_a_database(self):
+        first = IDBlockAllocator(block_size=3)
+        second = IDBlockAllocator(block_size=3)
+        numbers = []
+        for i in range(5):
+            numbers += first.allocate(self.portal, 'shared-')
+            numbers += second.allocate(self.portal, 'shared-')
+        self.assertEqual(len(numbers), len(set(numbers)))
+        self.assertEqual(numbers[:4], [1, 4, 2, 5])
+        # the first block of each allocator is used up, then a new one
+        self.assertEqual(numbers[6:], [7, 10, 8, 11])
+        self.assertEqual(self.committed_value('shared-'), 12)
+
+    def test_seed(self):
+        calls = []
+
+        def seed(value):
+            def last_id():
+                calls.append(value)
+                return value
+            return last_id
+
+        first = IDBlockAllocator(block_size=3)
+        self.assertEqual(
+            first.allocate(self.portal, 'seeded-', seed=seed(100)), [101])
+        # the sequence exists, so it is not seeded again
+        second = IDBlockAllocator(block_size=3)
+        self.assertEqual(
+            second.allocate(self.portal, 'seeded-', seed=seed(500)), [104])
+        self.assertEqual(calls, [100])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestIDServer))
+    suite.addTest(unittest.makeSuite(TestIDBlockAllocator))
+    suite.layer = BIKA_FUNCTIONAL_TESTING
+    return suite
@@ -10,7 +10,9 @@ from bika.lims.tests.base import BikaFunctionalTestCase
 from bika.lims.idserver import renameAfterCreation
 from plone.app.testing import login, logout
 from plone.app.testing import TEST_USER_NAME
+from Products.CMFCore.utils import getToolByName
 from datetime import date
+import transaction
 import unittest
 
 try:
@@ -110,8 +112,63 @@ class TestInstrumentAlerts(BikaFunctionalTestCase):
         super(TestInstrumentAlerts, self).tearDown()
 
 
+class TestInstrumentQCStatus(BikaFunctionalTestCase):
+    layer = BIKA_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        super(TestInstrumentQCStatus, self).setUp()
+        login(self.portal, TEST_USER_NAME)
+        instruments = self.portal.bika_setup.bika_instruments
+        self.instrument = instruments.objectValues()[0]
+        bsc = getToolByName(self.portal, 'bika_setup_catalog')
+        # services with dependents don't belong in references
+        for brain in bsc(portal_type='AnalysisService'):
+            calc = brain.getObject().getCalculation()
+            if not calc or not calc.getDependentServices():
+                self.service_uid = brain.UID
+                break
+
+    def tearDown(self):
+        logout()
+        super(TestInstrumentQCStatus, self).tearDown()
+
+    def reference_results(self, result, low, high):
+        return [{'uid': self.service_uid, 'result': result,
+                 'min': low, 'max': high, 'error': '0'}]
+
+    def test_reads_do_not_write(self):
+        instrument = self.instrument
+        for attr in ('_qc_status', '_validity_status'):
+            if attr in instrument.__dict__:
+                delattr(instrument, attr)
+        transaction.commit()
+        instrument.getQCStatus()
+        instrument.getValidityStatus()
+        instrument.isValid()
+        self.assertFalse(instrument._p_changed)
+        self.assertFalse('_qc_status' in instrument.__dict__)
+
+    def test_reference_results_changed(self):
+        supplier = self.portal.bika_setup.bika_suppliers.objectValues()[0]
+        reference = _createObjectByType('ReferenceSample', supplier, tmpID())
+        reference.edit(title='QC', Blank=False,
+                       ReferenceResults=self.reference_results('5', '4', '6'))
+        reference.unmarkCreationFlag()
+        renameAfterCreation(reference)
+        analysis = self.instrument.addReferences(
+            reference, [self.service_uid])[0]
+        analysis.setResult('5')
+        self.assertTrue(self.instrument.isQCValid())
+        # the result is out of the new reference values
+        reference.setReferenceResults(self.reference_results('7', '6', '8'))
+        self.assertFalse(self.instrument.isQCValid())
+        reference.setReferenceResults(self.reference_results('5', '4', '6'))
+        self.assertTrue(self.instrument.isQCValid())
+
+
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(TestInstrumentAlerts))
+    suite.addTest(unittest.makeSuite(TestInstrumentQCStatus))
     suite.layer = BIKA_FUNCTIONAL_TESTING
     return suite
\ No newline at end of file
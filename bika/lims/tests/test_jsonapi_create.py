@@ -0,0 +1,92 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from bika.lims.testing import BIKA_FUNCTIONAL_TESTING
+from bika.lims.tests.base import BikaFunctionalTestCase
+from plone.app.testing import SITE_OWNER_NAME
+from plone.app.testing import SITE_OWNER_PASSWORD
+from Products.CMFCore.utils import getToolByName
+import json
+import transaction
+
+try:
+    import unittest2 as unittest
+except ImportError: # Python 2.7
+    import unittest
+
+AR_PARAMETERS = [
+    "obj_type=AnalysisRequest",
+    "Client=portal_type:Client|id:client-1",
+    "SampleType=portal_type:SampleType|title:Apple Pulp",
+    "Contact=portal_type:Contact|getFullname:Rita Mohale",
+    "Services:list=portal_type:AnalysisService|title:Calcium",
+    "Services:list=portal_type:AnalysisService|title:Copper",
+    "SamplingDate=2013-09-29",
+]
+
+
+class TestJSONAPICreate(BikaFunctionalTestCase):
+    layer = BIKA_FUNCTIONAL_TESTING
+
+    def create(self, parameters):
+        browser = self.layer['getBrowser'](
+            self.portal, loggedIn=True, username=SITE_OWNER_NAME,
+            password=SITE_OWNER_PASSWORD)
+        browser.open(self.portal.absolute_url() + "/@@API/create",
+                     "&".join(parameters))
+        transaction.begin()
+        return json.loads(browser.contents)
+
+    def test_create_ar(self):
+        ret = self.create(AR_PARAMETERS)
+        self.assertTrue(ret['success'], ret)
+        client = self.portal.clients['client-1']
+        ar = client[ret['ar_id']]
+        self.assertEqual(ar.getSample().getId(), ret['sample_id'])
+        self.assertEqual(ar.getRequestID(), ar.getId())
+        self.assertEqual(ar.getContact().getFullname(), 'Rita Mohale')
+        self.assertEqual(ar.getSampleType().Title(), 'Apple Pulp')
+        self.assertEqual(
+            sorted([a.getService().Title() for a in
+                    ar.getAnalyses(full_objects=True)]),
+            ['Calcium', 'Copper'])
+        workflow = getToolByName(self.portal, 'portal_workflow')
+        self.assertEqual(workflow.getInfoFor(ar, 'review_state'),
+                         'sample_due')
+        # the AR and its sample are indexed once the request is committed
+        bc = getToolByName(self.portal, 'bika_catalog')
+        self.assertEqual(len(bc(UID=ar.UID())), 1)
+        self.assertEqual(len(bc(UID=ar.getSample().UID())), 1)
+        # and all the analyses are in the partition of the sample
+        part = ar.getSample().objectValues('SamplePartition')[0]
+        self.assertEqual(
+            set([a.getSamplePartition().UID() for a in
+                 ar.getAnalyses(full_objects=True)]),
+            set([part.UID()]))
+
+    def test_create_secondary_ar(self):
+        primary = self.create(AR_PARAMETERS)
+        # by Sample lookup, or by Sample_id
+        for parameter in (
+                "Sample=portal_type:Sample|id:%s" % primary['sample_id'],
+                "Sample_id=%s" % primary['sample_id']):
+            ret = self.create(AR_PARAMETERS + [parameter])
+            self.assertTrue(ret['success'], ret)
+            self.assertEqual(ret['sample_id'], primary['sample_id'])
+            self.assertNotEqual(ret['ar_id'], primary['ar_id'])
+            ar = self.portal.clients['client-1'][ret['ar_id']]
+            self.assertEqual(ar.getSample().getId(), primary['sample_id'])
+
+    def test_unknown_sample_id(self):
+        ret = self.create(AR_PARAMETERS + ["Sample_id=missing"])
+        self.assertFalse(ret['success'])
+        self.assertTrue('Sample not found' in ret['error'], ret)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestJSONAPICreate))
+    suite.layer = BIKA_FUNCTIONAL_TESTING
+    return suite
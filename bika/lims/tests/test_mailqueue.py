@@ -0,0 +1,210 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from bika.lims.testing import BIKA_FUNCTIONAL_TESTING
+from bika.lims.tests.base import BikaFunctionalTestCase
+from bika.lims.utils import mailqueue
+from bika.lims.utils.mailqueue import get_outbox
+from bika.lims.utils.mailqueue import outbox_worker
+from bika.lims.utils.mailqueue import pipelined_sendmail
+from bika.lims.utils.mailqueue import queue_mail
+from plone.app.testing import login
+from plone.app.testing import TEST_USER_NAME
+import SocketServer
+import smtplib
+import threading
+import transaction
+
+try:
+    import unittest2 as unittest
+except ImportError: # Python 2.7
+    import unittest
+
+MESSAGE = "From: Lab <lab@example.com>\nSubject: Results\n\nResults\n"
+
+
+class SMTPHandler(SocketServer.StreamRequestHandler):
+    """Local SMTP stand-in with PIPELINING.  Refuses the recipients with
+    'refused' in their address, and defers the ones with 'later'.
+    """
+
+    def handle(self):
+        write = self.wfile.write
+        write('220 localhost\r\n')
+        data = None
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            if data is not None:
+                if line == '.\r\n':
+                    self.server.received.append((recipients, ''.join(data)))
+                    data = None
+                    recipients = []
+                    write('250 Ok\r\n')
+                else:
+                    data.append(line)
+                continue
+            command = line.strip().lower()
+            if command.startswith('ehlo'):
+                write('250-localhost\r\n250-AUTH PLAIN\r\n'
+                      '250 PIPELINING\r\n')
+            elif command.startswith('auth'):
+                self.server.logins += 1
+                write('235 Authenticated\r\n')
+            elif command.startswith('rcpt'):
+                if 'refused' in command:
+                    write('550 No such user\r\n')
+                elif 'later' in command:
+                    write('450 Mailbox busy\r\n')
+                else:
+                    recipients.append(command[8:].strip('<>'))
+                    write('250 Ok\r\n')
+            elif command == 'data':
+                write(recipients and '354 Go\r\n' or '554 No recipients\r\n')
+                data = [] if recipients else None
+            elif command == 'quit':
+                write('221 Bye\r\n')
+                return
+            else:
+                write('250 Ok\r\n')
+
+
+class SMTPStandIn(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        SocketServer.ThreadingTCPServer.__init__(
+            self, ('127.0.0.1', 0), SMTPHandler)
+        self.received = []
+        self.logins = 0
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+
+class TestMailQueue(BikaFunctionalTestCase):
+    layer = BIKA_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        super(TestMailQueue, self).setUp()
+        login(self.portal, TEST_USER_NAME)
+        self.smtp = SMTPStandIn()
+        self.port = self.smtp.server_address[1]
+        # the outboxes are delivered by the tests, not in the background
+        outbox_worker.dispatch = lambda db, portal_path: None
+
+    def tearDown(self):
+        del outbox_worker.dispatch
+        self.smtp.shutdown()
+        self.smtp.server_close()
+        super(TestMailQueue, self).tearDown()
+
+    def test_pipelined_sendmail(self):
+        smtp = smtplib.SMTP('127.0.0.1', self.port)
+        refused = pipelined_sendmail(
+            smtp, 'lab@example.com',
+            ['client@example.com', 'refused@example.com'], MESSAGE)
+        self.assertEqual(refused.keys(), ['refused@example.com'])
+        self.assertRaises(smtplib.SMTPRecipientsRefused, pipelined_sendmail,
+                          smtp, 'lab@example.com', ['refused@example.com'],
+                          MESSAGE)
+        smtp.quit()
+        self.assertEqual(len(self.smtp.received), 1)
+        self.assertEqual(self.smtp.received[0][0], ['client@example.com'])
+
+    def test_outbox(self):
+        self.portal.MailHost.smtp_host = '127.0.0.1'
+        self.portal.MailHost.smtp_port = self.port
+        key = queue_mail(self.portal, MESSAGE,
+                         ['Client <client@example.com>',
+                          'refused@example.com',
+                          'later@example.com'])
+        transaction.commit()
+        db = self.portal._p_jar.db()
+        path = '/'.join(self.portal.getPhysicalPath())
+        retry = outbox_worker.deliver(db, path)
+        self.assertEqual(retry, mailqueue.OUTBOX_RETRY_DELAY)
+        self.assertEqual(len(self.smtp.received), 1)
+        recipients, data = self.smtp.received[0]
+        self.assertEqual(recipients, ['client@example.com'])
+        self.assertTrue(data.startswith('To: Client <client@example.com>'))
+        # the deferred recipient stays in the outbox, for a retry
+        transaction.begin()
+        entry = get_outbox(self.portal)[key]
+        statuses = dict([(r, s['status'])
+                         for r, s in entry['recipients'].items()])
+        self.assertEqual(statuses, {
+            'Client <client@example.com>': mailqueue.SENT,
+            'refused@example.com': mailqueue.FAILED,
+            'later@example.com': mailqueue.QUEUED})
+        self.assertEqual(entry['attempts'], 1)
+        self.assertEqual(entry['lease'], None)
+
+    def test_lease(self):
+        key = queue_mail(self.portal, MESSAGE, ['client@example.com'])
+        transaction.commit()
+        db = self.portal._p_jar.db()
+        path = '/'.join(self.portal.getPhysicalPath())
+        # another client claims the message first
+        other = mailqueue.OutboxWorker()
+        due, next_run = other.run(db, path, other.due)
+        self.assertEqual([d[0] for d in due], [key])
+        due, next_run = outbox_worker.run(db, path, outbox_worker.due)
+        self.assertEqual(due, [])
+        # tried again when the lease expires
+        self.assertTrue(0 < next_run <= mailqueue.OUTBOX_LEASE_TIME)
+        # the lease is committed before the message is sent
+        transaction.begin()
+        entry = get_outbox(self.portal)[key]
+        self.assertEqual(entry['lease']['owner'], other.owner)
+        # once expired, the message is taken over
+        entry['lease'] = dict(entry['lease'],
+                              expires=entry['lease']['expires'] - 1)
+        transaction.commit()
+        due, next_run = outbox_worker.run(db, path, outbox_worker.due)
+        self.assertEqual([d[0] for d in due], [key])
+
+    def connect(self):
+        transaction.commit()
+        db = self.portal._p_jar.db()
+        path = '/'.join(self.portal.getPhysicalPath())
+        return outbox_worker.connect(db, path)
+
+    def test_connect_without_starttls(self):
+        host = self.portal.MailHost
+        host.smtp_host = '127.0.0.1'
+        host.smtp_port = self.port
+        outbox_worker.close(self.connect())
+        # TLS forced by the MailHost, but not supported by the server
+        host.force_tls = True
+        self.assertRaises(smtplib.SMTPException, self.connect)
+        # no login over an unencrypted connection
+        host.force_tls = False
+        host.smtp_uid = 'lab'
+        host.smtp_pwd = 'secret'
+        self.assertRaises(smtplib.SMTPException, self.connect)
+        self.assertEqual(self.smtp.logins, 0)
+        # unless allowed in the registry
+        registry = self.portal.portal_registry
+        registry['bika.lims.mailqueue.allow_plain_login'] = True
+        outbox_worker.close(self.connect())
+        self.assertEqual(self.smtp.logins, 1)
+
+    def test_outboxes(self):
+        queue_mail(self.portal, MESSAGE, ['client@example.com'])
+        transaction.commit()
+        db = self.portal._p_jar.db()
+        self.assertEqual(outbox_worker.outboxes(db),
+                         ['/'.join(self.portal.getPhysicalPath())])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestMailQueue))
+    suite.layer = BIKA_FUNCTIONAL_TESTING
+    return suite
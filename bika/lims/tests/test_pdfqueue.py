@@ -0,0 +1,97 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from DateTime import DateTime
+from bika.lims.testing import BIKA_FUNCTIONAL_TESTING
+from bika.lims.tests.base import BikaFunctionalTestCase
+from bika.lims.utils import pdfqueue
+from bika.lims.utils.pdfqueue import PDF_JOBS_KEY
+from bika.lims.utils.pdfqueue import PDFWorkers
+from bika.lims.utils.pdfqueue import get_job
+from bika.lims.utils.pdfqueue import get_job_status
+from bika.lims.utils.pdfqueue import get_jobs
+from bika.lims.utils.pdfqueue import queue_pdf
+from plone.app.testing import login
+from plone.app.testing import TEST_USER_NAME
+from zope.annotation.interfaces import IAnnotations
+import transaction
+
+try:
+    import unittest2 as unittest
+except ImportError: # Python 2.7
+    import unittest
+
+
+class TestPDFQueue(BikaFunctionalTestCase):
+    layer = BIKA_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        super(TestPDFQueue, self).setUp()
+        login(self.portal, TEST_USER_NAME)
+        # no worker threads: the dispatched jobs stay in the queue
+        self.workers = pdfqueue.pdf_workers
+        pdfqueue.pdf_workers = PDFWorkers(size=0)
+
+    def tearDown(self):
+        pdfqueue.pdf_workers = self.workers
+        super(TestPDFQueue, self).tearDown()
+
+    def test_read_without_jobs(self):
+        annotations = IAnnotations(self.portal)
+        if PDF_JOBS_KEY in annotations:
+            del annotations[PDF_JOBS_KEY]
+        self.assertEqual(len(get_jobs(self.portal)), 0)
+        self.assertEqual(get_job(self.portal, 'missing'), None)
+        self.assertEqual(get_job_status(self.portal, 'missing'),
+                         {'uid': 'missing', 'status': None})
+        self.assertFalse(PDF_JOBS_KEY in annotations)
+
+    def test_status_of_a_stale_job(self):
+        client = self.portal.clients['client-1']
+        job = queue_pdf(client, '<html></html>', 'ReportFile')
+        created = DateTime() - 1
+        job['created'] = created
+        transaction.commit()
+        workers = pdfqueue.pdf_workers
+        # dispatched once the job was committed
+        self.assertEqual(workers.queue.qsize(), 1)
+        workers.queue.get()
+        workers.dispatched.clear()
+        status = get_job_status(self.portal, client.UID())
+        self.assertEqual(status['status'], pdfqueue.QUEUED)
+        # the stale job is dispatched again, but not modified
+        self.assertEqual(workers.queue.qsize(), 1)
+        self.assertEqual(job['created'], created)
+        self.assertFalse(job._p_changed)
+        # and not dispatched again while pending
+        get_job_status(self.portal, client.UID())
+        self.assertEqual(workers.queue.qsize(), 1)
+
+    def test_finished_jobs_are_pruned(self):
+        services = self.portal.bika_setup.bika_analysisservices
+        targets = services.objectValues()[:5]
+        old, recent, failed, running = [
+            queue_pdf(target, '<html></html>', 'ReportFile')
+            for target in targets[:4]]
+        old['status'] = pdfqueue.DONE
+        old['finished'] = DateTime() - pdfqueue.PDF_JOB_RETENTION - 1
+        recent['status'] = pdfqueue.DONE
+        recent['finished'] = DateTime() - 1
+        failed['status'] = pdfqueue.FAILED
+        failed['finished'] = DateTime() - pdfqueue.PDF_JOB_RETENTION - 1
+        running['status'] = pdfqueue.RUNNING
+        running['started'] = DateTime() - pdfqueue.PDF_JOB_RETENTION - 1
+        # pruned when the next job is queued
+        queue_pdf(targets[4], '<html></html>', 'ReportFile')
+        self.assertEqual(
+            sorted(get_jobs(self.portal).keys()),
+            sorted([targets[i].UID() for i in (1, 3, 4)]))
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestPDFQueue))
+    suite.layer = BIKA_FUNCTIONAL_TESTING
+    return suite
@@ -0,0 +1,254 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from bika.lims.browser.analysisrequest.publish import \
+    AnalysisRequestPublishView
+from bika.lims.tests.test_mailqueue import SMTPStandIn
+from bika.lims.testing import BIKA_FUNCTIONAL_TESTING
+from bika.lims.tests.base import BikaFunctionalTestCase
+from bika.lims.utils import changeWorkflowState
+from bika.lims.utils import mailqueue
+from bika.lims.utils import pdfqueue
+from bika.lims.utils import publishqueue
+from bika.lims.utils.analysisrequest import create_analysisrequest
+from bika.lims.utils.mailqueue import outbox_worker
+from bika.lims.utils.publishqueue import get_publication_jobs
+from bika.lims.utils.publishqueue import publication_worker
+from plone.app.testing import login, logout, setRoles
+from plone.app.testing import TEST_USER_ID
+from plone.app.testing import TEST_USER_NAME
+import transaction
+
+try:
+    import unittest2 as unittest
+except ImportError: # Python 2.7
+    import unittest
+
+HTML = "<html><body><div id='report'>Results</div></body></html>"
+PDF = "%PDF-1.4 report"
+
+
+class TestPublish(BikaFunctionalTestCase):
+    layer = BIKA_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        super(TestPublish, self).setUp()
+        setRoles(self.portal, TEST_USER_ID, ['LabManager', 'Manager'])
+        login(self.portal, TEST_USER_NAME)
+        self.portal.bika_setup.laboratory.setEmailAddress('lab@example.com')
+        self.client = self.portal.clients['client-1']
+        sampletype = self.portal.bika_setup.bika_sampletypes['sampletype-1']
+        self.values = {'Client': self.client.UID(),
+                       'Contact': self.client.getContacts()[0].UID(),
+                       'SamplingDate': '2015-01-01',
+                       'SampleType': sampletype.UID()}
+        services = self.portal.bika_setup.bika_analysisservices
+        self.service = services['analysisservice-3']
+        # the jobs and outboxes are run by the tests, not in the background
+        publication_worker.dispatch = lambda *args: None
+        outbox_worker.dispatch = lambda db, portal_path: None
+        # and the PDFs are not rendered
+        self.render_pdfs = pdfqueue.render_pdfs
+        pdfqueue.render_pdfs = lambda htmls: [PDF for html in htmls]
+
+    def tearDown(self):
+        pdfqueue.render_pdfs = self.render_pdfs
+        del outbox_worker.dispatch
+        del publication_worker.dispatch
+        logout()
+        super(TestPublish, self).tearDown()
+
+    def create_verified_ar(self):
+        ar = create_analysisrequest(
+            self.client, {}, self.values, [self.service.UID()])
+        analysis = ar[self.service.getKeyword()]
+        analysis.setResult('10')
+        changeWorkflowState(analysis, 'bika_analysis_workflow', 'verified')
+        changeWorkflowState(ar, 'bika_ar_workflow', 'verified')
+        return ar
+
+    def view(self, context):
+        return AnalysisRequestPublishView(context, self.portal.REQUEST)
+
+    def reports(self, ar):
+        return ar.objectValues('ARReport')
+
+    def run_job(self, job_id):
+        transaction.commit()
+        db = self.portal._p_jar.db()
+        path = '/'.join(self.portal.getPhysicalPath())
+        publication_worker.process(db, path, job_id, TEST_USER_ID)
+        transaction.begin()
+
+    def test_publish_reports_queues_a_job(self):
+        ar = self.create_verified_ar()
+        due = create_analysisrequest(
+            self.client, {}, self.values, [self.service.UID()])
+        queued = self.view(ar).publishReports([(ar, HTML), (due, HTML)])
+        # the ARs without verified results are discarded
+        self.assertEqual(queued, [ar])
+        jobs = get_publication_jobs(self.portal)
+        self.assertEqual(len(jobs), 1)
+        job = jobs.values()[0]
+        self.assertEqual(job['status'], publishqueue.QUEUED)
+        self.assertEqual(job['userid'], TEST_USER_ID)
+        self.assertEqual([item['ar'] for item in job['items']], [ar.UID()])
+        self.assertEqual(job['items'][0]['html'], HTML)
+        # nothing is published until the job runs
+        self.assertEqual(self.reports(ar), [])
+
+    def test_publication_job(self):
+        ars = [self.create_verified_ar() for i in range(3)]
+        publishqueue.PUBLISH_BATCH_SIZE = 2
+        try:
+            self.view(ars[0]).publishReports([(ar, HTML) for ar in ars])
+            job_id = get_publication_jobs(self.portal).keys()[0]
+            self.run_job(job_id)
+        finally:
+            publishqueue.PUBLISH_BATCH_SIZE = 10
+        wf = self.portal.portal_workflow
+        for ar in ars:
+            reports = self.reports(ar)
+            self.assertEqual(len(reports), 1)
+            self.assertEqual(reports[0].getPublicationJob(), job_id)
+            self.assertEqual(reports[0].getPdf().data, PDF)
+            self.assertEqual(wf.getInfoFor(ar, 'review_state'), 'published')
+        job = get_publication_jobs(self.portal)[job_id]
+        self.assertEqual(job['status'], publishqueue.DONE)
+        self.assertEqual(list(job['published']), [ar.UID() for ar in ars])
+        # the html is dropped once published
+        self.assertEqual(len(job['items']), 0)
+
+    def test_retried_batch_is_idempotent(self):
+        ar = self.create_verified_ar()
+        self.view(ar).publishReports([(ar, HTML)])
+        job_id = get_publication_jobs(self.portal).keys()[0]
+        transaction.commit()
+        db = self.portal._p_jar.db()
+        path = '/'.join(self.portal.getPhysicalPath())
+        worker = publication_worker
+        batch = worker.run(db, path, job_id, TEST_USER_ID, worker.start)
+        for attempt in range(2):
+            worker.run(db, path, job_id, TEST_USER_ID, worker.store,
+                       batch, [PDF])
+        transaction.begin()
+        self.assertEqual(len(self.reports(ar)), 1)
+
+    def test_failed_pdf_is_not_published(self):
+        ar = self.create_verified_ar()
+        pdfqueue.render_pdfs = lambda htmls: [None for html in htmls]
+        self.view(ar).publishReports([(ar, HTML)])
+        job_id = get_publication_jobs(self.portal).keys()[0]
+        self.run_job(job_id)
+        self.assertEqual(self.reports(ar), [])
+        job = get_publication_jobs(self.portal)[job_id]
+        self.assertEqual(list(job['failed']), [ar.UID()])
+        self.assertEqual(job['status'], publishqueue.DONE)
+
+    def test_report_messages(self):
+        ar = self.create_verified_ar()
+        job = {'ar': ar,
+               'html': HTML,
+               'subject': 'Results',
+               'managers': ['Manager <manager@example.com>'],
+               'notified': [
+                   {'title': 'Pdf', 'email': 'pdf@example.com',
+                    'pubpref': ['email', 'pdf']},
+                   {'title': 'Html', 'email': 'html@example.com',
+                    'pubpref': ['email']},
+                   {'title': 'No email', 'email': '',
+                    'pubpref': ['email']},
+                   {'title': 'Print', 'email': 'print@example.com',
+                    'pubpref': ['print']}]}
+        messages = self.view(ar)._report_messages(job, PDF)
+        self.assertEqual([recipients for message, recipients in messages],
+                         [['Manager <manager@example.com>',
+                           'Pdf <pdf@example.com>'],
+                          ['Html <html@example.com>']])
+        with_pdf, without_pdf = [message for message, r in messages]
+        self.assertTrue('application/pdf' in with_pdf)
+        self.assertFalse('application/pdf' in without_pdf)
+        self.assertTrue('Subject: Results' in with_pdf)
+        # no recipients, no emails
+        job = dict(job, managers=[], notified=[])
+        self.assertEqual(self.view(ar)._report_messages(job, PDF), [])
+
+    def test_refused_recipients(self):
+        """ The refused recipients used to raise a WorkflowException, and
+            fail the whole publication.  They are now recorded as failed
+            in the Delivery of the report, and the AR is published.
+        """
+        smtp = SMTPStandIn()
+        try:
+            self.portal.MailHost.smtp_host = '127.0.0.1'
+            self.portal.MailHost.smtp_port = smtp.server_address[1]
+            ar = self.create_verified_ar()
+            job = self.view(ar)._publication_data(ar, HTML)
+            job['managers'] = ['refused@example.com']
+            job['notified'] = [{'title': 'Client',
+                                'email': 'client@example.com',
+                                'pubpref': ['email', 'pdf']}]
+            report = self.view(ar).publishReport(job, PDF)
+            transaction.commit()
+            db = self.portal._p_jar.db()
+            path = '/'.join(self.portal.getPhysicalPath())
+            outbox_worker.deliver(db, path)
+            transaction.begin()
+            self.assertEqual(
+                self.portal.portal_workflow.getInfoFor(ar, 'review_state'),
+                'published')
+            statuses = dict([(d['EmailAddress'], d['Status'])
+                             for d in report.getDelivery()])
+            self.assertEqual(statuses, {
+                'refused@example.com': mailqueue.FAILED,
+                'Client <client@example.com>': mailqueue.SENT})
+            self.assertEqual([r for r, data in smtp.received],
+                             [['client@example.com']])
+        finally:
+            smtp.shutdown()
+            smtp.server_close()
+
+    def matrix_rows(self, ars):
+        matrix = self.view(ars[0]).getTransposedMatrix(ars)
+        self.assertEqual(matrix['ars'], [ar.id for ar in ars])
+        return [row for category in matrix['categories']
+                for row in category['services']]
+
+    def test_transposed_matrix(self):
+        ars = [self.create_verified_ar() for i in range(2)]
+        keyword = self.service.getKeyword()
+        for ar in ars:
+            ar[keyword].reindexObject()
+        result = ars[0][keyword].getFormattedResult()
+        title = self.service.Title()
+        rows = self.matrix_rows(ars)
+        self.assertEqual([(r['uid'], r['title'], r['keyword'], r['results'])
+                          for r in rows],
+                         [(self.service.UID(), title, keyword,
+                           [result, result])])
+        # the title of the service the analyses were created with
+        self.service.setTitle('Renamed')
+        self.service.reindexObject()
+        self.assertEqual([r['title'] for r in self.matrix_rows(ars)],
+                         [title])
+
+    def test_transposed_matrix_hidden_service(self):
+        ars = [self.create_verified_ar()]
+        self.service.manage_permission('View', ['Manager'], acquire=0)
+        self.service.reindexObjectSecurity()
+        setRoles(self.portal, TEST_USER_ID, ['LabManager'])
+        bsc = self.portal.bika_setup_catalog
+        self.assertEqual(len(bsc(UID=self.service.UID())), 0)
+        rows = self.matrix_rows(ars)
+        self.assertEqual([(r['uid'], r['category']) for r in rows],
+                         [(self.service.UID(),
+                           self.service.getCategoryTitle())])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestPublish))
+    suite.layer = BIKA_FUNCTIONAL_TESTING
+    return suite
@@ -0,0 +1,143 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from bika.lims.jsonapi.doactionfor import transition_objects
+from bika.lims.testing import BIKA_FUNCTIONAL_TESTING
+from bika.lims.tests.base import BikaFunctionalTestCase
+from bika.lims.utils import tmpID
+from bika.lims.utils.reindex import ALL
+from bika.lims.utils.reindex import deferred_reindexing
+from bika.lims.utils.reindex import get_reindex_queue
+from plone.app.testing import login, logout, setRoles
+from plone.app.testing import TEST_USER_ID
+from plone.app.testing import TEST_USER_NAME
+from Products.CMFPlone.utils import _createObjectByType
+import transaction
+
+try:
+    import unittest2 as unittest
+except ImportError: # Python 2.7
+    import unittest
+
+
+class TestDeferredReindexing(BikaFunctionalTestCase):
+    layer = BIKA_FUNCTIONAL_TESTING
+
+    def addthing(self, folder, portal_type, **kwargs):
+        thing = _createObjectByType(portal_type, folder, tmpID())
+        thing.unmarkCreationFlag()
+        thing.edit(**kwargs)
+        thing._renameAfterCreation()
+        return thing
+
+    def setUp(self):
+        super(TestDeferredReindexing, self).setUp()
+        setRoles(self.portal, TEST_USER_ID, ['LabManager', 'Manager'])
+        login(self.portal, TEST_USER_NAME)
+        self.bsc = self.portal.bika_setup_catalog
+        sampletypes = self.portal.bika_setup.bika_sampletypes
+        self.sampletypes = [
+            self.addthing(sampletypes, 'SampleType', title=title)
+            for title in ('Soil', 'Sand')]
+        transaction.commit()
+
+    def tearDown(self):
+        logout()
+        super(TestDeferredReindexing, self).tearDown()
+
+    def path(self, obj):
+        return '/'.join(obj.getPhysicalPath())
+
+    def titled(self, title):
+        return [b.UID for b in self.bsc(portal_type='SampleType',
+                                        title=title)]
+
+    def test_not_deferred_by_default(self):
+        sampletype = self.sampletypes[0]
+        self.assertEqual(get_reindex_queue(), None)
+        sampletype.setTitle('Clay')
+        sampletype.reindexObject()
+        self.assertEqual(self.titled('Clay'), [sampletype.UID()])
+
+    def test_flush_on_commit(self):
+        sampletype = self.sampletypes[0]
+        with deferred_reindexing() as queue:
+            sampletype.setTitle('Clay')
+            sampletype.reindexObject(idxs=['title'])
+            sampletype.reindexObject()
+            # queued once, with all the indexes
+            self.assertEqual(queue.objects.keys(), [self.path(sampletype)])
+            self.assertEqual(queue.objects.values()[0][1], ALL)
+            self.assertEqual(self.titled('Clay'), [])
+        # still deferred after the block, until commit
+        self.assertEqual(self.titled('Clay'), [])
+        transaction.commit()
+        self.assertEqual(self.titled('Clay'), [sampletype.UID()])
+        self.assertEqual(queue.objects.keys(), [])
+
+    def test_immediate_indexes(self):
+        sampletype = self.sampletypes[0]
+        with deferred_reindexing() as queue:
+            sampletype.setTitle('Clay')
+            sampletype.reindexObject(idxs=['title', 'inactive_state'])
+            # the metadata is updated along with the immediate indexes
+            brain = self.bsc(UID=sampletype.UID())[0]
+            self.assertEqual(brain.Title, 'Clay')
+            self.assertEqual(self.titled('Clay'), [])
+            self.assertEqual(queue.objects[self.path(sampletype)][1],
+                             set(['title']))
+            # only immediate indexes: nothing is queued
+            other = self.sampletypes[1]
+            other.reindexObject(idxs=['review_state'])
+            self.assertFalse(self.path(other) in queue.objects)
+        transaction.commit()
+        self.assertEqual(self.titled('Clay'), [sampletype.UID()])
+
+    def test_removed_before_commit(self):
+        sampletype = self.sampletypes[0]
+        with deferred_reindexing():
+            sampletype.setTitle('Clay')
+            sampletype.reindexObject()
+        sampletypes = self.portal.bika_setup.bika_sampletypes
+        sampletypes.manage_delObjects([sampletype.getId()])
+        transaction.commit()
+        self.assertEqual(self.titled('Clay'), [])
+
+    def test_transition_objects_rolls_back_failed_object(self):
+        good, bad = self.sampletypes
+        bad_uid = bad.UID()
+        cls = type(bad)
+        original = cls.reindexObject
+
+        def reindexObject(self, idxs=[]):
+            original(self, idxs)
+            if self.UID() == bad_uid:
+                raise ValueError("Reindex failed")
+
+        cls.reindexObject = reindexObject
+        try:
+            results = transition_objects(
+                self.portal, [good, bad], 'deactivate')
+        finally:
+            del cls.reindexObject
+        self.assertEqual([r['success'] for r in results], [True, False])
+        wf = self.portal.portal_workflow
+        self.assertEqual(wf.getInfoFor(good, 'inactive_state'), 'inactive')
+        self.assertEqual(wf.getInfoFor(bad, 'inactive_state'), 'active')
+        # the failed object was discarded from the queue with its changes
+        with deferred_reindexing() as queue:
+            self.assertEqual(queue.objects.keys(), [self.path(good)])
+        transaction.commit()
+        self.assertEqual(
+            [b.UID for b in self.bsc(portal_type='SampleType',
+                                     inactive_state='inactive')],
+            [good.UID()])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestDeferredReindexing))
+    suite.layer = BIKA_FUNCTIONAL_TESTING
+    return suite
@@ -0,0 +1,98 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from bika.lims.testing import BIKA_FUNCTIONAL_TESTING
+from bika.lims.tests.base import BikaFunctionalTestCase
+from bika.lims.utils import changeWorkflowState
+from bika.lims.utils import tmpID
+from bika.lims.utils.analysisrequest import create_analysisrequest
+from bika.lims.utils.resultshistory import get_previous_results
+from bika.lims.utils.resultshistory import index_analysis_result
+from plone.app.testing import login, logout, setRoles
+from plone.app.testing import TEST_USER_ID
+from plone.app.testing import TEST_USER_NAME
+from Products.CMFPlone.utils import _createObjectByType
+
+try:
+    import unittest2 as unittest
+except ImportError: # Python 2.7
+    import unittest
+
+
+class TestResultsHistory(BikaFunctionalTestCase):
+    layer = BIKA_FUNCTIONAL_TESTING
+
+    def addthing(self, folder, portal_type, **kwargs):
+        thing = _createObjectByType(portal_type, folder, tmpID())
+        thing.unmarkCreationFlag()
+        thing.edit(**kwargs)
+        thing._renameAfterCreation()
+        return thing
+
+    def setUp(self):
+        super(TestResultsHistory, self).setUp()
+        setRoles(self.portal, TEST_USER_ID, ['LabManager', 'Manager'])
+        login(self.portal, TEST_USER_NAME)
+        self.client = self.portal.clients['client-1']
+        self.batches = [self.addthing(self.portal.batches, 'Batch',
+                                      title='Batch %s' % n) for n in (1, 2)]
+        sampletype = self.portal.bika_setup.bika_sampletypes['sampletype-1']
+        self.values = {'Client': self.client.UID(),
+                       'Contact': self.client.getContacts()[0].UID(),
+                       'SamplingDate': '2015-01-01',
+                       'SampleType': sampletype.UID(),
+                       'Batch': self.batches[0].UID()}
+        services = self.portal.bika_setup.bika_analysisservices
+        self.service = services['analysisservice-3']
+        self.keyword = self.service.getKeyword()
+
+    def tearDown(self):
+        logout()
+        super(TestResultsHistory, self).tearDown()
+
+    def create_verified_ar(self, result):
+        ar = create_analysisrequest(
+            self.client, {}, self.values, [self.service.UID()])
+        analysis = ar[self.keyword]
+        analysis.setResult(result)
+        changeWorkflowState(analysis, 'bika_analysis_workflow', 'verified')
+        analysis.reindexObject()
+        index_analysis_result(analysis)
+        return ar
+
+    def previous(self, batch, exclude=None):
+        return [(r['request_uid'], r['result']) for r in
+                get_previous_results(batch, self.keyword, exclude)]
+
+    def test_previous_results(self):
+        ar1 = self.create_verified_ar('10')
+        ar2 = self.create_verified_ar('20')
+        self.assertEqual(self.previous(self.batches[0], ar2.UID()),
+                         [(ar1.UID(), '10')])
+        self.assertEqual(len(self.previous(self.batches[0])), 2)
+        self.assertEqual(self.previous(self.batches[1]), [])
+
+    def test_request_moved_to_another_batch(self):
+        ar1 = self.create_verified_ar('10')
+        ar2 = self.create_verified_ar('20')
+        # the history of the second batch exists already
+        self.assertEqual(self.previous(self.batches[1]), [])
+        ar1.setBatch(self.batches[1].UID())
+        ar1.reindexObject()
+        self.assertEqual(self.previous(self.batches[0]), [(ar2.UID(), '20')])
+        self.assertEqual(self.previous(self.batches[1]), [(ar1.UID(), '10')])
+
+    def test_removed_request(self):
+        ar1 = self.create_verified_ar('10')
+        ar2 = self.create_verified_ar('20')
+        self.client.manage_delObjects([ar1.getId()])
+        self.assertEqual(self.previous(self.batches[0]), [(ar2.UID(), '20')])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestResultsHistory))
+    suite.layer = BIKA_FUNCTIONAL_TESTING
+    return suite
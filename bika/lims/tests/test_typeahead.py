@@ -0,0 +1,86 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from bika.lims.testing import BIKA_FUNCTIONAL_TESTING
+from bika.lims.tests.base import BikaFunctionalTestCase
+from bika.lims.utils import typeahead
+from bika.lims.utils.typeahead import get_typeahead_index
+from bika.lims.utils.typeahead import typeahead_search
+from plone.app.testing import login, logout, setRoles
+from plone.app.testing import TEST_USER_ID
+from plone.app.testing import TEST_USER_NAME
+from Products.CMFCore.utils import getToolByName
+import time
+
+try:
+    import unittest2 as unittest
+except ImportError: # Python 2.7
+    import unittest
+
+
+class TestTypeAhead(BikaFunctionalTestCase):
+    layer = BIKA_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        super(TestTypeAhead, self).setUp()
+        typeahead._indexes.clear()
+        self.bsc = getToolByName(self.portal, 'bika_setup_catalog')
+        self.query = {'portal_type': 'SampleType'}
+        self.sampletypes = \
+            self.bsc.unrestrictedSearchResults(portal_type='SampleType')
+
+    def tearDown(self):
+        typeahead._indexes.clear()
+        logout()
+        super(TestTypeAhead, self).tearDown()
+
+    def test_index_shared_by_all_users(self):
+        # a sample type only the managers can see
+        hidden = self.sampletypes[0]._unrestrictedGetObject()
+        hidden.manage_permission('View', ['Manager'], acquire=0)
+        hidden.reindexObjectSecurity()
+        uid = hidden.UID()
+        title = hidden.Title()
+        login(self.portal, TEST_USER_NAME)
+        setRoles(self.portal, TEST_USER_ID, ['LabManager'])
+        self.assertFalse(uid in [b.UID for b in self.bsc(UID=uid)])
+        # the index built for this user has it anyway
+        index = get_typeahead_index(self.bsc, 'SampleType', ('Title',))
+        self.assertEqual(len(index), len(self.sampletypes))
+        self.assertTrue(uid in index.search(title))
+        # but the searches are restricted to what each user can see
+        brains = typeahead_search(self.bsc, self.query, title)
+        self.assertFalse(uid in [b.UID for b in brains])
+        setRoles(self.portal, TEST_USER_ID, ['LabManager', 'Manager'])
+        brains = typeahead_search(self.bsc, self.query, title)
+        self.assertTrue(uid in [b.UID for b in brains])
+
+    def test_fields_not_in_metadata(self):
+        self.assertEqual(typeahead_search(self.bsc, self.query, 'wa',
+                                          ('getRetentionPeriod',)), None)
+
+    def test_stale_index_built_in_background(self):
+        login(self.portal, TEST_USER_NAME)
+        index = get_typeahead_index(self.bsc, 'SampleType', ('Title',))
+        index.created = 0
+        # the stale index is still used meanwhile
+        self.assertTrue(
+            get_typeahead_index(self.bsc, 'SampleType', ('Title',)) is index)
+        self.assertTrue(index.rebuilding)
+        key = typeahead._indexes.keys()[0]
+        for i in range(50):
+            if typeahead._indexes[key] is not index:
+                break
+            time.sleep(0.1)
+        rebuilt = typeahead._indexes[key]
+        self.assertFalse(rebuilt is index)
+        self.assertEqual(len(rebuilt), len(self.sampletypes))
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestTypeAhead))
+    suite.layer = BIKA_FUNCTIONAL_TESTING
+    return suite
@@ -0,0 +1,111 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from bika.lims.utils.versions import LRUCache
+from bika.lims.utils.versions import get_snapshot_cache
+from bika.lims.utils.versions import snapshot_cache_stats
+import threading
+
+try:
+    import unittest2 as unittest
+except ImportError: # Python 2.7
+    import unittest
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_get_and_set(self):
+        cache = LRUCache(3)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('a', 'default'), 'default')
+        cache.set('a', 1)
+        cache.set('a', 2)
+        self.assertEqual(cache.get('a'), 2)
+        self.assertEqual(len(cache), 1)
+
+    def test_least_recently_used_discarded(self):
+        cache = LRUCache(3)
+        for key in 'abc':
+            cache.set(key, key.upper())
+        # 'a' is used, so 'b' is the least recently used
+        cache.get('a')
+        cache.set('d', 'D')
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual([cache.get(k) for k in 'acd'], ['A', 'C', 'D'])
+        # setting a key again makes it the most recently used
+        cache.set('a', 'A')
+        cache.set('e', 'E')
+        self.assertEqual(cache.get('c'), None)
+        self.assertEqual(cache.get('a'), 'A')
+
+    def test_stats(self):
+        cache = LRUCache(2)
+        self.assertEqual(cache.stats()['hit_rate'], 0.0)
+        cache.set('a', 1)
+        cache.get('a')
+        cache.get('a')
+        cache.get('b')
+        cache.get('a')
+        self.assertEqual(cache.stats(), {'size': 1,
+                                         'maxsize': 2,
+                                         'hits': 3,
+                                         'misses': 1,
+                                         'hit_rate': 0.75})
+        cache.clear()
+        self.assertEqual(cache.stats()['size'], 0)
+        self.assertEqual(cache.stats()['hits'], 0)
+
+    def test_threads(self):
+        cache = LRUCache(50)
+
+        def work(n):
+            for i in range(1000):
+                cache.set((n, i % 100), i)
+                cache.get((n, (i + 1) % 100))
+
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(cache), 50)
+        self.assertEqual(cache.hits + cache.misses, 4000)
+
+
+class Connection(object):
+    """Stands in for a ZODB connection, the key of a version cache
+    """
+
+
+class TestSnapshotCacheStats(unittest.TestCase):
+
+    def test_stats_summed_up(self):
+        before = snapshot_cache_stats()
+        jars = [Connection(), Connection()]
+        caches = map(get_snapshot_cache, jars)
+        caches[0].set('a', 1)
+        caches[0].get('a')
+        caches[1].set('b', 2)
+        caches[1].set('c', 3)
+        caches[1].get('b')
+        caches[1].get('d')
+        stats = snapshot_cache_stats()
+        self.assertEqual(stats['caches'], before['caches'] + 2)
+        self.assertEqual(stats['size'], before['size'] + 3)
+        self.assertEqual(stats['maxsize'],
+                         before['maxsize'] + 2 * caches[0].maxsize)
+        self.assertEqual(stats['hits'], before['hits'] + 2)
+        self.assertEqual(stats['misses'], before['misses'] + 1)
+        # the caches are dropped along with their connections
+        del jars, caches
+        self.assertEqual(snapshot_cache_stats()['caches'], before['caches'])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestLRUCache))
+    suite.addTest(unittest.makeSuite(TestSnapshotCacheStats))
+    return suite
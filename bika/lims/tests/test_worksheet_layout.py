@@ -0,0 +1,114 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from bika.lims.utils.worksheet import WorksheetLayout
+
+try:
+    import unittest2 as unittest
+except ImportError: # Python 2.7
+    import unittest
+
+LAYOUT = [
+    {'position': '1', 'type': 'a', 'container_uid': 'ar1',
+     'analysis_uid': 'an1'},
+    {'position': '1', 'type': 'a', 'container_uid': 'ar1',
+     'analysis_uid': 'an2'},
+    {'position': '2', 'type': 'b', 'container_uid': 'blank1',
+     'analysis_uid': 'an3'},
+    {'position': '4', 'type': 'a', 'container_uid': 'ar2',
+     'analysis_uid': 'an4'},
+]
+
+
+class TestWorksheetLayout(unittest.TestCase):
+
+    def setUp(self):
+        self.layout = WorksheetLayout([dict(slot) for slot in LAYOUT])
+
+    def test_lookups(self):
+        layout = self.layout
+        self.assertEqual(len(layout), 4)
+        self.assertTrue('an3' in layout)
+        self.assertFalse('an9' in layout)
+        self.assertEqual(layout.get('an4')['container_uid'], 'ar2')
+        self.assertEqual(layout.get('an9', 'missing'), 'missing')
+        self.assertEqual([s['analysis_uid'] for s in layout.slots_at(1)],
+                         ['an1', 'an2'])
+        self.assertEqual(layout.slots_at('3'), [])
+        self.assertEqual(layout.container_position('ar2'), 4)
+        self.assertEqual(layout.container_position('ar9'), None)
+        self.assertEqual(layout.highest_position(), 4)
+        self.assertEqual(layout.highest_position(minimum=10), 10)
+
+    def test_empty_layout(self):
+        layout = WorksheetLayout()
+        self.assertEqual(len(layout), 0)
+        self.assertEqual(layout.free_position(), 1)
+        self.assertEqual(layout.highest_position(), 0)
+        self.assertEqual(layout.layout(), [])
+
+    def test_add(self):
+        layout = self.layout
+        self.assertEqual(layout.free_position(), 3)
+        slot = layout.add(3, 'd', 'ar1', 'an5')
+        self.assertEqual(slot, {'position': 3, 'type': 'd',
+                                'container_uid': 'ar1',
+                                'analysis_uid': 'an5'})
+        self.assertEqual(layout.get('an5'), slot)
+        self.assertEqual(layout.free_position(), 5)
+        # the container keeps the position of its first slot
+        self.assertEqual(layout.container_position('ar1'), 1)
+        self.assertEqual(layout.layout()[-1], slot)
+
+    def test_remove_slot_of_a_shared_position(self):
+        layout = self.layout
+        layout.remove('an1')
+        self.assertFalse('an1' in layout)
+        self.assertEqual(len(layout), 3)
+        self.assertEqual([s['analysis_uid'] for s in layout.slots_at(1)],
+                         ['an2'])
+        self.assertEqual(layout.container_position('ar1'), 1)
+        # the position is still in use
+        self.assertEqual(layout.free_position(), 3)
+
+    def test_freed_position_reused(self):
+        layout = self.layout
+        self.assertEqual(layout.free_position(), 3)
+        layout.remove('an3')
+        self.assertEqual(layout.slots_at(2), [])
+        self.assertEqual(layout.container_position('blank1'), None)
+        # the freed position is lower than the first free one
+        self.assertEqual(layout.free_position(), 2)
+        layout.add(layout.free_position(), 'c', 'control1', 'an6')
+        self.assertEqual(layout.container_position('control1'), 2)
+        self.assertEqual(layout.free_position(), 3)
+
+    def test_remove_last_slot_of_highest_position(self):
+        layout = self.layout
+        layout.remove('an4')
+        self.assertEqual(layout.highest_position(), 2)
+        self.assertEqual(layout.container_position('ar2'), None)
+        self.assertEqual(layout.free_position(), 3)
+
+    def test_remove_missing(self):
+        self.layout.remove('an9')
+        self.assertEqual(len(self.layout), 4)
+
+    def test_layout_is_a_copy(self):
+        layout = self.layout
+        slots = layout.layout()
+        self.assertEqual([s['analysis_uid'] for s in slots],
+                         ['an1', 'an2', 'an3', 'an4'])
+        slots.pop()
+        self.assertEqual(len(layout.layout()), 4)
+        layout.remove('an2')
+        self.assertEqual([s['analysis_uid'] for s in layout.layout()],
+                         ['an1', 'an3', 'an4'])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestWorksheetLayout))
+    return suite
@@ -0,0 +1,71 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+from Acquisition import aq_inner
+from Acquisition import aq_parent
+from Products.CMFCore.utils import getToolByName
+
+from bika.lims import logger
+
+
+def upgrade(tool):
+    """Upgrade step required for Bika LIMS 3.2.1
+    """
+    portal = aq_parent(aq_inner(tool))
+
+    qi = portal.portal_quickinstaller
+    ufrom = qi.upgradeInfo('bika.lims')['installedVersion']
+    logger.info("Upgrading Bika LIMS: %s -> %s" % (ufrom, '3.2.1'))
+
+    # Setting of the outbox (bika.lims.mailqueue.allow_plain_login)
+    setup = portal.portal_setup
+    setup.runImportStepFromProfile('profile-bika.lims:default',
+                                   'plone.app.registry')
+
+    # Metadata columns used to resolve the dependencies amongst the
+    # analyses of an AR without waking up the analyses (getKeyword,
+    # getServiceUID), to build the evolution charts of the dashboard
+    # (created), the productivity reports and the results matrix of the
+    # multi-AR reports (getFormattedResult)
+    add_metadata_columns(portal, 'bika_analysis_catalog',
+                         ['getKeyword', 'getServiceUID', 'created',
+                          'getEarliness', 'getDuration', 'getServiceTitle',
+                          'getDepartmentUID', 'getResult',
+                          'getFormattedResult'])
+    # Blank flag and supported services of the Reference Samples, read by
+    # applyWorksheetTemplate without waking up the samples, and the sampling
+    # date of the samples, read by the daily samples received report
+    add_metadata_columns(portal, 'bika_catalog',
+                         ['created', 'getBlank', 'getSupportedServiceUIDs',
+                          'getSamplingDate'])
+    # Sort key of the analysis categories, read by their listing
+    add_metadata_columns(portal, 'bika_setup_catalog', ['getSortKey'])
+
+    # The validity of the instruments is kept as a precomputed status
+    bsc = getToolByName(portal, 'bika_setup_catalog')
+    for brain in bsc(portal_type='Instrument'):
+        instrument = brain.getObject()
+        instrument.updateQCStatus()
+        instrument.updateValidityStatus()
+
+    return True
+
+
+def add_metadata_columns(portal, catalog_name, columns):
+    """Adds the metadata columns to the catalog, and recatalogs its objects
+    if any column has been added
+    """
+    catalog = getToolByName(portal, catalog_name)
+    added = []
+    for column in columns:
+        if column in catalog.schema():
+            continue
+        catalog.addColumn(column)
+        added.append(column)
+    if added:
+        logger.info("Added metadata columns to %s: %s. Recataloging..." %
+                    (catalog_name, ', '.join(added)))
+        catalog.refreshCatalog()
+    return added
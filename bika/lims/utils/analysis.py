@@ -13,7 +13,9 @@ from bika.lims.utils import formatDecimalMark
 from Products.Archetypes.event import ObjectInitializedEvent
 from Products.CMFCore.WorkflowCore import WorkflowException
 from Products.CMFPlone.utils import _createObjectByType
+from Products.Archetypes.config import REFERENCE_CATALOG
 from Products.CMFCore.utils import getToolByName
+from zope.annotation.interfaces import IAnnotations
 
 
 def create_analysis(context, service, keyword, interim_fields):
@@ -541,3 +543,146 @@ def get_method_instrument_constraints(context, uids):
             constraints[auid][muid] = targ
             cached_servs[cachedkey][suid][muid] = targ
     return constraints
+
+
+DEPENDENCY_GRAPHS_KEY = 'bika.lims.analysis_dependency_graphs'
+SERVICE_DEPENDENCIES_KEY = 'bika.lims.service_dependencies'
+
+
+def get_request_cache(context, key):
+    """Returns a dictionary stored in the current request's annotations
+    under the key passed in.  If there is no request available (e.g. when
+    running scripts), an empty dictionary that is not stored anywhere is
+    returned, so callers don't need to worry about it.
+    """
+    request = getattr(context, 'REQUEST', None)
+    try:
+        annotations = IAnnotations(request)
+    except TypeError:
+        return {}
+    cache = annotations.get(key, None)
+    if cache is None:
+        cache = annotations[key] = {}
+    return cache
+
+
+class AnalysisDependencyGraph(object):
+    """The dependencies amongst the analyses of an Analysis Request.
+
+    The graph is built from catalog metadata: the keyword and service UID
+    of each analysis come from bika_analysis_catalog, so no analysis is
+    woken up while building it.  The keywords each service depends on are
+    resolved once per service and request, see get_service_dependencies.
+    """
+
+    def __init__(self, ar):
+        self.ar = ar
+        # analysis uid -> keyword, and analysis uid -> id
+        self.keywords = {}
+        self.ids = {}
+        # keyword -> analysis uids with this keyword
+        self.uids = {}
+        # analysis uid -> uids of the analyses it depends on
+        self.dependencies = {}
+        # analysis uid -> uids of the analyses that depend on it
+        self.dependents = {}
+        # keyword -> keywords of the services that depend on it
+        self.dependent_keywords = {}
+        self._build()
+
+    def _build(self):
+        brains = self.ar.getAnalyses()
+        order = [brain.UID for brain in brains]
+        required = {}
+        for brain in brains:
+            uid = brain.UID
+            keyword = brain.getKeyword
+            self.keywords[uid] = keyword
+            self.ids[uid] = brain.id
+            self.uids.setdefault(keyword, []).append(uid)
+            required[uid] = get_service_dependencies(self.ar,
+                                                     brain.getServiceUID)
+
+        for uid in order:
+            deps = [dep for dep in order
+                    if dep != uid and self.keywords[dep] in required[uid]]
+            self.dependencies[uid] = deps
+            for dep in deps:
+                self.dependents.setdefault(dep, []).append(uid)
+                self.dependent_keywords.setdefault(
+                    self.keywords[dep], set()).add(self.keywords[uid])
+
+    def _get_objects(self, uids):
+        objects = []
+        for uid in uids:
+            obj = self.ar._getOb(self.ids[uid], None)
+            if obj is None or obj.UID() != uid:
+                # renamed since the graph was built
+                uc = getToolByName(self.ar, 'uid_catalog')
+                brains = uc(UID=uid)
+                obj = brains[0].getObject() if brains else None
+            if obj is not None:
+                objects.append(obj)
+        return objects
+
+    def getDependencies(self, analysis):
+        """Returns the analyses the analysis passed in depends on
+        """
+        return self._get_objects(self.dependencies.get(analysis.UID(), []))
+
+    def getDependents(self, analysis):
+        """Returns the analyses that depend on the analysis passed in
+        """
+        return self._get_objects(self.dependents.get(analysis.UID(), []))
+
+
+def get_service_dependencies(context, service_uid):
+    """Returns the keywords of the services the calculation of the service
+    passed in depends on.  The result is cached for the current request, so
+    each service and calculation is only woken up once.
+    """
+    cache = get_request_cache(context, SERVICE_DEPENDENCIES_KEY)
+    if service_uid not in cache:
+        keywords = set()
+        rc = getToolByName(context, REFERENCE_CATALOG)
+        service = rc.lookupObject(service_uid) if service_uid else None
+        calculation = service.getCalculation() if service else None
+        if calculation:
+            keywords = set([s.getKeyword()
+                            for s in calculation.getDependentServices()])
+        cache[service_uid] = keywords
+    return cache[service_uid]
+
+
+def get_dependency_graph(ar):
+    """Returns the AnalysisDependencyGraph of the Analysis Request passed in.
+    The graph is built once per request, and shared by all the analyses of
+    the AR.  Returns None if the analysis catalog doesn't have the metadata
+    columns required to build it (upgrade step not run yet).
+    """
+    bac = getToolByName(ar, 'bika_analysis_catalog')
+    schema = bac.schema()
+    if 'getKeyword' not in schema or 'getServiceUID' not in schema:
+        return None
+    graphs = get_request_cache(ar, DEPENDENCY_GRAPHS_KEY)
+    uid = ar.UID()
+    if uid not in graphs:
+        graphs[uid] = AnalysisDependencyGraph(ar)
+    return graphs[uid]
+
+
+def invalidate_dependency_graph(ar):
+    """Discards the dependency graph of the AR for the current request.
+    Must be called whenever analyses are added to or removed from the AR.
+    """
+    graphs = get_request_cache(ar, DEPENDENCY_GRAPHS_KEY)
+    graphs.pop(ar.UID(), None)
+
+
+def invalidate_dependency_caches(context):
+    """Discards all the dependency graphs and service dependencies cached
+    for the current request.  Must be called whenever the calculation of a
+    service or the formula of a calculation change.
+    """
+    get_request_cache(context, DEPENDENCY_GRAPHS_KEY).clear()
+    get_request_cache(context, SERVICE_DEPENDENCIES_KEY).clear()
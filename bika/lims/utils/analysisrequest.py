@@ -9,14 +9,17 @@ from Products.CMFPlone.utils import safe_unicode
 from bika.lims import bikaMessageFactory as _
 from bika.lims import logger
 from bika.lims.idserver import renameAfterCreation
+from bika.lims.idserver import reserved_ids
 from bika.lims.interfaces import ISample, IAnalysisService, IAnalysis
 from bika.lims.utils import tmpID
 from bika.lims.utils import to_utf8
 from bika.lims.utils import encode_header
 from bika.lims.utils import createPdf
 from bika.lims.utils import attachPdf
+from bika.lims.utils.reindex import deferred_reindexing
 from bika.lims.utils.sample import create_sample
 from bika.lims.utils.samplepartition import create_samplepartition
+from bika.lims.utils.services import get_service_keywords
 from Products.CMFCore.WorkflowCore import WorkflowException
 from bika.lims.workflow import doActionFor
 from email.mime.multipart import MIMEMultipart
@@ -30,8 +33,45 @@ import os
 import tempfile
 
 
+def create_analysisrequests(context, request, values_list, analyses=None,
+                            partitions=None, specifications=None, prices=None,
+                            lookups=None, progress=None):
+    """Creates an AR (and its Sample, partitions and analyses) in context
+    for each dict of AR|Sample values in values_list.  The other parameters
+    are the same as for create_analysisrequest, and apply to all the ARs.
+
+    This is a plain loop over create_analysisrequest: every AR is created,
+    and goes through the same transitions, as if create_analysisrequest
+    was called for each one.  The only savings are:
+
+    - the local ID sequences of the ARs and Samples are advanced once for
+      all the ARs (see bika.lims.idserver.reserved_ids).
+    - every object is reindexed once, right before commit, no matter how
+      many times it is modified while the ARs are created (see
+      bika.lims.utils.reindex).
+
+    The services, their interim fields, the specs and the containers looked
+    up are kept in lookups (a new dictionary if not given), as
+    create_analysisrequest does when passed lookups.  progress, if given,
+    is called with the number of ARs created so far after each AR.  Returns
+    the list of new ARs.
+    """
+    lookups = lookups if lookups is not None else {}
+    ars = []
+    with reserved_ids(len(values_list)), deferred_reindexing():
+        for values in values_list:
+            ars.append(create_analysisrequest(
+                context, request, values, analyses,
+                partitions and [dict(p) for p in partitions] or None,
+                specifications, prices, lookups=lookups))
+            if progress:
+                progress(len(ars))
+    return ars
+
+
 def create_analysisrequest(context, request, values, analyses=None,
-                           partitions=None, specifications=None, prices=None):
+                           partitions=None, specifications=None, prices=None,
+                           lookups=None):
     """This is meant for general use and should do everything necessary to
     create and initialise an AR and any other required auxilliary objects
     (Sample, SamplePartition, Analysis...)
@@ -53,6 +93,9 @@ def create_analysisrequest(context, request, values, analyses=None,
     :param prices:
         Allow different prices to be set for analyses.  If not set, prices
         are read from the associated analysis service.
+    :param lookups:
+        A dictionary shared by the ARs created together, where the services,
+        specs and containers are kept once looked up.
     """
 
     # Gather neccesary tools
@@ -101,7 +144,8 @@ def create_analysisrequest(context, request, values, analyses=None,
     # processForm already has created the analyses, but here we create the
     # analyses with specs and prices. This function, even it is called 'set',
     # deletes the old analyses, so eventually we obtain the desired analyses.
-    ar.setAnalyses(service_uids, prices=prices, specs=specifications)
+    ar.setAnalyses(service_uids, prices=prices, specs=specifications,
+                   lookups=lookups)
     # Gettin the ar objects
     analyses = ar.getAnalyses(full_objects=True)
     # Continue to set the state of the AR
@@ -116,8 +160,11 @@ def create_analysisrequest(context, request, values, analyses=None,
             doActionFor(ar, 'receive')
 
     # Set the state of analyses we created.
+    services = lookups.get('services', {}) if lookups is not None else {}
     for analysis in analyses:
-        revers = analysis.getService().getNumberOfRequiredVerifications()
+        service = services.get(analysis.getServiceUID(), (None,))[0]
+        service = service if service else analysis.getService()
+        revers = service.getNumberOfRequiredVerifications()
         analysis.setNumberOfRequiredVerifications(revers)
         doActionFor(analysis, 'sample_due')
         analysis_state = workflow.getInfoFor(analysis, 'review_state')
@@ -140,7 +187,8 @@ def create_analysisrequest(context, request, values, analyses=None,
                 partition['object'] = create_samplepartition(
                     sample,
                     partition,
-                    analyses
+                    analyses,
+                    lookups
                 )
         # If Preservation is required for some partitions,
         # and the SamplingWorkflow is disabled, we need
@@ -211,6 +259,7 @@ def _resolve_items_to_service_uids(items):
     """
     portal = None
     bsc = None
+    keywords = None
     service_uids = []
 
     # Maybe only a single item was passed
@@ -233,8 +282,17 @@ def _resolve_items_to_service_uids(items):
         if (item in service_uids):
             continue
 
-        # Maybe object UID.
+        # Service UID or Keyword, from the shared lookup table
         portal = portal if portal else api.portal.get()
+        keywords = keywords if keywords else get_service_keywords(portal)
+        if item in keywords.by_uid:
+            service_uids.append(item)
+            continue
+        if item in keywords:
+            service_uids.append(keywords.uid(item))
+            continue
+
+        # Maybe object UID.
         bsc = bsc if bsc else getToolByName(portal, 'bika_setup_catalog')
         brains = bsc(UID=item)
         if brains:
@@ -0,0 +1,191 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+""" Background import of ARImports.
+
+Importing a large ARImport creates hundreds of Samples and ARs, and used to
+hold the Zope thread of the request that clicked "Import" for minutes.
+When ARImportBatchSize is set in Bika Setup, the rows are imported by a
+worker thread of the Zope client instead, from a separate ZODB connection,
+committing every ARImportBatchSize rows.  The number of rows committed so
+far is stored in the ImportedRows field of the ARImport, along with the
+ImportStatus, so a failed import resumes from the last committed row (see
+the arimport_resume view).
+"""
+
+from AccessControl import getSecurityManager
+from AccessControl.SecurityManagement import newSecurityManager
+from AccessControl.SecurityManagement import noSecurityManager
+from Products.CMFCore.utils import getToolByName
+from Testing.makerequest import makerequest
+from ZODB.POSException import ConflictError
+from bika.lims import logger
+from zope.component.hooks import getSite
+from zope.component.hooks import setSite
+import Queue
+import threading
+import transaction
+
+ARIMPORT_COMMIT_RETRIES = 5
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def queue_arimport(arimport):
+    """Queues the import of the rows of arimport not imported yet.  The
+    import starts once the current transaction is committed, on behalf of
+    the current user.
+    """
+    arimport.setImportStatus(QUEUED)
+    portal = getToolByName(arimport, 'portal_url').getPortalObject()
+    portal_path = '/'.join(portal.getPhysicalPath())
+    path = '/'.join(arimport.getPhysicalPath())
+    userid = getSecurityManager().getUser().getId()
+    db = portal._p_jar.db()
+
+    def hook(success):
+        if success:
+            arimport_workers.dispatch(db, portal_path, path, userid)
+
+    transaction.get().addAfterCommitHook(hook)
+
+
+def can_resume(arimport):
+    """True if the background import of arimport failed, or is not running
+    anymore (e.g. the Zope client was restarted)
+    """
+    status = arimport.getImportStatus()
+    if status == FAILED:
+        return True
+    if status in (QUEUED, RUNNING):
+        return not arimport_workers.is_running(
+            '/'.join(arimport.getPhysicalPath()))
+    return False
+
+
+class ARImportWorkers(object):
+    """Daemon thread that imports the queued ARImports one after the other,
+    so they don't conflict with each other on the client folders.  Started
+    on the first dispatch.
+    """
+
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.pending = set()
+
+    def is_running(self, path):
+        return path in self.pending
+
+    def dispatch(self, db, portal_path, path, userid):
+        with self.lock:
+            if path in self.pending:
+                return
+            self.pending.add(path)
+            if self.thread is None or not self.thread.isAlive():
+                self.thread = threading.Thread(target=self.work)
+                self.thread.setDaemon(True)
+                self.thread.start()
+        self.queue.put((db, portal_path, path, userid))
+
+    def work(self):
+        while True:
+            db, portal_path, path, userid = self.queue.get()
+            try:
+                self.process(db, portal_path, path, userid)
+            except Exception:
+                logger.exception("ARImport %s failed" % path)
+            finally:
+                with self.lock:
+                    self.pending.discard(path)
+
+    def process(self, db, portal_path, path, userid):
+        # a transaction per batch of rows, until all the rows are imported
+        while True:
+            try:
+                done = self.run(db, portal_path, path, userid, self.step)
+            except Exception as e:
+                logger.exception("ARImport %s failed" % path)
+                self.run(db, portal_path, path, userid, self.fail, str(e))
+                return
+            if done is not False:
+                return
+
+    def run(self, db, portal_path, path, userid, step, *args):
+        """Runs step(arimport, *args) in a transaction of its own, from a
+        separate connection, and returns its result
+        """
+        # The connection uses the transaction manager of this thread: the
+        # deferred reindexing of the ARs created (see
+        # create_analysisrequests) hooks into its current transaction
+        tm = transaction.manager
+        connection = db.open(transaction_manager=tm)
+        site = getSite()
+        try:
+            for attempt in range(ARIMPORT_COMMIT_RETRIES):
+                tm.begin()
+                try:
+                    app = makerequest(connection.root()['Application'])
+                    portal = app.unrestrictedTraverse(portal_path)
+                    setSite(portal)
+                    acl_users = portal.acl_users
+                    user = acl_users.getUserById(userid)
+                    if user is None:
+                        acl_users = app.acl_users
+                        user = acl_users.getUserById(userid)
+                    if user is None:
+                        logger.error("ARImport %s: user %s not found" %
+                                     (path, userid))
+                        tm.abort()
+                        return None
+                    newSecurityManager(None, user.__of__(acl_users))
+                    arimport = app.unrestrictedTraverse(path, None)
+                    if arimport is None:
+                        tm.abort()
+                        return None
+                    result = step(arimport, *args)
+                    tm.commit()
+                    return result
+                except ConflictError:
+                    tm.abort()
+            raise ConflictError("ARImport %s: too many conflicts" % path)
+        except:
+            tm.abort()
+            raise
+        finally:
+            noSecurityManager()
+            setSite(site)
+            connection.close()
+
+    def step(self, arimport):
+        """Imports the next batch of rows.  Returns True once all the rows
+        are imported, False otherwise.
+        """
+        if arimport.getImportStatus() == DONE:
+            return True
+        batch_size = arimport.bika_setup.getARImportBatchSize() or 1
+        total = len(arimport.getSampleData())
+        start = arimport.getImportedRows() or 0
+        stop = min(start + batch_size, total)
+        arimport.setImportStatus(RUNNING)
+        arimport.import_rows(start, stop)
+        arimport.setImportedRows(stop)
+        if stop >= total:
+            arimport.setImportStatus(DONE)
+        arimport.reindexObject()
+        return stop >= total
+
+    def fail(self, arimport, error):
+        arimport.setImportStatus(FAILED)
+        errors = list(arimport.getErrors() or [])
+        errors.append("Row %s: %s" % (arimport.getImportedRows() + 1, error))
+        arimport.setErrors(errors)
+
+
+arimport_workers = ARImportWorkers()
@@ -0,0 +1,98 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+""" Batch calculation of analyses results.
+
+Calculating the analyses one by one with calculateResult(cascade=True)
+walks the dependencies of each analysis again and again, and the order in
+which the analyses are visited decides whether a result is computed from
+the new or from the old results of its dependencies.  The functions below
+build a single dependency graph for all the analyses of a list of ARs
+(e.g. the ARs of an instrument results import), and calculate every
+result once, in topological order.
+"""
+
+from bika.lims import logger
+from collections import OrderedDict
+
+
+def topological_order(dependencies):
+    """Sorts the keys of the dependencies mapping ({key: [keys it depends
+    on]}) so that every key comes after the keys it depends on.  Keys that
+    are not in the mapping are ignored.  The original order is kept amongst
+    the keys that don't depend on each other.  Returns a tuple with the
+    sorted keys and the keys involved in circular dependencies, which are
+    not sorted.
+    """
+    pending = OrderedDict()
+    dependents = {}
+    for key, keys in dependencies.items():
+        keys = set([k for k in keys if k in dependencies and k != key])
+        pending[key] = len(keys)
+        for k in keys:
+            dependents.setdefault(k, []).append(key)
+    ready = [key for key, count in pending.items() if count == 0]
+    ordered = []
+    while ready:
+        key = ready.pop(0)
+        ordered.append(key)
+        for dependent in dependents.get(key, []):
+            pending[dependent] -= 1
+            if pending[dependent] == 0:
+                ready.append(dependent)
+    cyclic = [key for key, count in pending.items() if count > 0]
+    return ordered, cyclic
+
+
+def calculate_results(analyses, override=True):
+    """Calculates the results of the analyses passed in in a single pass.
+    Dependencies that are not in the list are calculated too, but only if
+    they don't have a result yet, as calculateResult(cascade=True) does.
+    Returns the list of analyses with a calculated result.
+    """
+    targets = OrderedDict()
+    for analysis in analyses:
+        # Reference analyses are never calculated
+        if hasattr(analysis, 'calculateResult'):
+            targets[analysis.UID()] = analysis
+
+    nodes = OrderedDict(targets)
+    dependencies = OrderedDict()
+    pending = targets.values()
+    while pending:
+        analysis = pending.pop(0)
+        uid = analysis.UID()
+        if uid in dependencies:
+            continue
+        dependencies[uid] = []
+        for dependency in analysis.getDependencies():
+            depuid = dependency.UID()
+            dependencies[uid].append(depuid)
+            if depuid not in nodes:
+                nodes[depuid] = dependency
+                pending.append(dependency)
+
+    ordered, cyclic = topological_order(dependencies)
+    if cyclic:
+        logger.warn("Circular dependencies amongst analyses %s: results "
+                    "not calculated" % ", ".join(
+                        [nodes[uid].getId() for uid in cyclic]))
+
+    calculated = []
+    for uid in ordered:
+        analysis = nodes[uid]
+        # Dependencies are already calculated, no need to cascade
+        if analysis.calculateResult(uid in targets and override, False):
+            calculated.append(analysis)
+    return calculated
+
+
+def calculate_ar_results(ars, override=True):
+    """Calculates the results of all the analyses of the ARs passed in
+    """
+    analyses = []
+    for ar in ars:
+        analyses.extend(ar.getAnalyses(full_objects=True))
+    return calculate_results(analyses, override)
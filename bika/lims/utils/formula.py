@@ -0,0 +1,94 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+""" Compiled calculation formulas.
+
+Calculation formulas refer to keywords enclosed in square brackets, e.g.
+"[Ca] + [Mg]".  Formulas used to be interpolated with the values of the
+keywords and then evaluated on every calculation.  Here, each formula is
+compiled once into a code object in which every keyword is a named slot,
+and the compiled formulas are kept in a LRU cache, by Calculation UID and
+version.
+"""
+
+from bika.lims.utils.versions import LRUCache
+import math
+import numbers
+import re
+
+# Any text enclosed in square brackets is a keyword
+KEYWORD = re.compile(r"\[([^\]]+)\]")
+
+# Maximum number of compiled formulas kept in the cache
+FORMULA_CACHE_SIZE = 500
+
+# (calculation uid, version_id) -> CompiledFormula
+_formulas = LRUCache(FORMULA_CACHE_SIZE)
+
+
+class CompiledFormula(object):
+    """A formula compiled into a code object with a named slot per keyword
+    """
+
+    def __init__(self, formula):
+        self.formula = formula
+        self.slots = []
+        slots = {}
+
+        def replace(match):
+            key = match.group(1)
+            if key not in slots:
+                slots[key] = '_slot%s' % len(slots)
+                self.slots.append((slots[key], key))
+            return slots[key]
+
+        expression = KEYWORD.sub(replace, formula)
+        self.code = compile(expression.strip(), '<formula>', 'eval')
+
+    @property
+    def keywords(self):
+        return [key for slot, key in self.slots]
+
+    def __call__(self, mapping, context=None):
+        """Evaluates the formula with the values from mapping.  Raises the
+        same errors as interpolating and evaluating the formula did:
+        KeyError if a keyword is missing from the mapping, TypeError if a
+        value is not a number, and ZeroDivisionError.
+        """
+        values = {}
+        for slot, key in self.slots:
+            value = mapping[key]
+            if isinstance(value, bool) \
+                    or not isinstance(value, numbers.Number):
+                raise TypeError("float argument required for '%s'" % key)
+            # values were interpolated with '%f' before: keep the rounding
+            try:
+                values[slot] = float('%f' % value)
+            except TypeError:
+                # e.g. complex numbers
+                raise TypeError("float argument required for '%s'" % key)
+        return eval(self.code, {'math': math, 'context': context}, values)
+
+
+def get_compiled_formula(calculation):
+    """Returns the CompiledFormula for the calculation passed in, compiling
+    it only if it is not in the cache yet or if the formula has changed.
+    """
+    key = (calculation.UID(), getattr(calculation, 'version_id', None))
+    formula = calculation.getMinifiedFormula()
+    compiled = _formulas.get(key, None)
+    if compiled is None or compiled.formula != formula:
+        compiled = CompiledFormula(formula)
+        _formulas.set(key, compiled)
+    return compiled
+
+
+def invalidate_compiled_formulas(uid):
+    """Discards the compiled formulas of all the versions of the calculation
+    with the UID passed in
+    """
+    for key in _formulas.keys():
+        if key[0] == uid:
+            _formulas.pop(key)
@@ -0,0 +1,118 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+""" Summary of the instruments that cannot be used.
+
+The failed instruments viewlet is rendered on every page for the lab
+managers, and the JSON API serves the same summary to monitoring tools.
+The summary is built once per Zope client and cached until either:
+
+- the instruments counter (stored in the portal annotations, so all the
+  clients see it) is bumped by invalidate_failed_instruments.  This is done
+  when an instrument, or its certifications, validations or calibrations
+  are modified, and when the QC status of an instrument changes.
+- the day changes: certifications expire and validations or calibrations
+  start or end on a date basis.
+"""
+
+from Acquisition import aq_inner
+from Acquisition import aq_parent
+from datetime import date
+from Products.CMFCore.utils import getToolByName
+from bika.lims.interfaces import IInstrument
+from zope.annotation.interfaces import IAnnotations
+
+INSTRUMENTS_COUNTER_KEY = 'bika.lims.instruments.counter'
+
+# Reason why the instrument cannot be used -> view of the instrument that
+# shows the details
+FAILURES = (
+    ('validation', 'validations'),
+    ('calibration', 'calibrations'),
+    ('out-of-date', 'certifications'),
+    ('qc-fail', 'referenceanalyses'),
+    ('next-test', 'referenceanalyses'),
+)
+
+# portal path -> (counter, day, summary)
+_summaries = {}
+
+
+def _instruments_counter(portal):
+    return IAnnotations(portal).get(INSTRUMENTS_COUNTER_KEY, 0)
+
+
+def _failure(instrument):
+    """Returns the reason why the instrument cannot be used, or None
+    """
+    if instrument.isValidationInProgress():
+        return 'validation'
+    if instrument.isCalibrationInProgress():
+        return 'calibration'
+    if instrument.isOutOfDate():
+        return 'out-of-date'
+    if not instrument.isQCValid():
+        return 'qc-fail'
+    if instrument.getDisposeUntilNextCalibrationTest():
+        return 'next-test'
+    return None
+
+
+def _build_summary(portal):
+    bsc = getToolByName(portal, 'bika_setup_catalog')
+    portal_path = len(portal.getPhysicalPath())
+    views = dict(FAILURES)
+    failed = dict([(key, []) for key, view in FAILURES])
+    for brain in bsc(portal_type='Instrument', inactive_state='active'):
+        instrument = brain.getObject()
+        failure = _failure(instrument)
+        if failure is None:
+            continue
+        path = instrument.getPhysicalPath()[portal_path:]
+        failed[failure].append({
+            'uid': instrument.UID(),
+            'title': instrument.Title(),
+            'path': '/'.join(path + (views[failure],)),
+        })
+    return {'nr_failed': sum([len(items) for items in failed.values()]),
+            'failed': failed}
+
+
+def get_failed_instruments(context):
+    """Returns the summary of the active instruments that cannot be used: a
+    dict with the number of failed instruments (nr_failed), and the list of
+    instruments for each reason (failed).  Each instrument is a dict with
+    its UID, title, and the path (relative to the portal) of the view that
+    shows why it failed.
+    """
+    portal = getToolByName(context, 'portal_url').getPortalObject()
+    key = '/'.join(portal.getPhysicalPath())
+    counter = _instruments_counter(portal)
+    today = date.today()
+    cached = _summaries.get(key, None)
+    if cached is None or cached[0] != counter or cached[1] != today:
+        cached = (counter, today, _build_summary(portal))
+        _summaries[key] = cached
+    return cached[2]
+
+
+def invalidate_failed_instruments(context):
+    """Forces all the Zope clients to build the summary again
+    """
+    portal = getToolByName(context, 'portal_url').getPortalObject()
+    annotations = IAnnotations(portal)
+    annotations[INSTRUMENTS_COUNTER_KEY] = \
+        annotations.get(INSTRUMENTS_COUNTER_KEY, 0) + 1
+
+
+def update_validity_status(obj):
+    """Updates the validity status of the instrument the certification,
+    validation or calibration passed in belongs to.  Objects still being
+    created outside of the instrument are ignored.
+    """
+    instrument = aq_parent(aq_inner(obj))
+    if IInstrument.providedBy(instrument):
+        instrument.updateValidityStatus()
+        invalidate_failed_instruments(instrument)
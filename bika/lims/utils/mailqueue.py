@@ -0,0 +1,472 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+""" Outbox of the emails sent by Bika LIMS.
+
+Publishing results used to send the emails of every AR from the request
+thread, one SMTP conversation after another, and the emails that could not
+be sent were lost.  Instead, the messages are stored in a persistent
+outbox, in the portal annotations, and delivered by a worker thread of the
+Zope client once the transaction that queued them is committed:
+
+- each message is stored once, without the To header, along with the list
+  of its recipients.  The To header of each recipient is prepended on
+  delivery.
+- the messages are delivered over a single SMTP connection per run, opened
+  with the settings of the MailHost of the portal.  The MAIL, RCPT and DATA
+  commands of each message are pipelined if the server supports it.
+  Only the SMTP settings of the MailHost are used: the messages are not
+  sent through its mailer, so its own queue (smtp_queue) and replacements
+  of the MailHost (e.g. the MockMailHost of the tests) are bypassed.
+- recipients refused with a temporary error (or not reached because of a
+  connection failure) are tried again, OUTBOX_RETRY_DELAY seconds later,
+  doubled after every attempt, up to OUTBOX_MAX_ATTEMPTS attempts.
+- the delivery status of each recipient is stored in the Delivery field of
+  the object the message is about (the ARReport).  Messages are removed
+  from the outbox once delivered, or once they failed for good.
+- the outbox is shared by all the ZEO clients.  A worker claims the
+  messages it is about to send with a lease (its owner id and an expiry
+  date), committed before they are sent, and skips the messages leased by
+  others.  The messages of a client that dies while sending them are
+  taken over by the others once the lease expires.
+
+The worker is started when the database is opened (see
+bika.lims.subscribers.mailqueue), and delivers the messages left in the
+outboxes of the sites by a previous run.
+"""
+
+from BTrees.OOBTree import OOBTree
+from DateTime import DateTime
+from Products.CMFCore.utils import getToolByName
+from Testing.makerequest import makerequest
+from ZODB.POSException import ConflictError
+from bika.lims import logger
+from email.Utils import parseaddr
+from persistent.mapping import PersistentMapping
+from smtplib import CRLF
+from smtplib import SMTP
+from smtplib import SMTPDataError
+from smtplib import SMTPException
+from smtplib import SMTPRecipientsRefused
+from smtplib import SMTPResponseException
+from smtplib import SMTPSenderRefused
+from smtplib import quoteaddr
+from smtplib import quotedata
+from zope.annotation.interfaces import IAnnotations
+import Queue
+import socket
+import threading
+import time
+import transaction
+import uuid
+
+OUTBOX_KEY = 'bika.lims.mailqueue.outbox'
+
+OUTBOX_MAX_ATTEMPTS = 5
+# Seconds before the first retry, doubled after every failed attempt
+OUTBOX_RETRY_DELAY = 60
+OUTBOX_SMTP_TIMEOUT = 30
+OUTBOX_COMMIT_RETRIES = 5
+# Messages claimed per run, and seconds before the claim expires.  A run
+# must be over before the lease expires, even if the SMTP server times out
+OUTBOX_RUN_SIZE = 20
+OUTBOX_LEASE_TIME = OUTBOX_RUN_SIZE * OUTBOX_SMTP_TIMEOUT * 2
+
+QUEUED = 'queued'
+SENT = 'sent'
+FAILED = 'failed'
+
+
+def get_outbox(context):
+    """Returns the OOBTree with the messages not delivered yet, keyed by
+    queue order
+    """
+    portal = getToolByName(context, 'portal_url').getPortalObject()
+    annotations = IAnnotations(portal)
+    if OUTBOX_KEY not in annotations:
+        annotations[OUTBOX_KEY] = OOBTree()
+    return annotations[OUTBOX_KEY]
+
+
+def queue_mail(context, message, recipients):
+    """Queues the message (a MIME string without To header) for the
+    recipients (formatted addresses) passed in.  The delivery status of
+    each recipient is stored in the Delivery field of context, if any.
+    The message is delivered once the current transaction is committed.
+    """
+    recipients = [r for r in recipients if parseaddr(r)[1]]
+    if not recipients:
+        return None
+    portal = getToolByName(context, 'portal_url').getPortalObject()
+    sender = parseaddr(_header(message, 'From'))[1]
+    key = '%015d-%s' % (int(time.time() * 1000), uuid.uuid4().hex[:8])
+    entry = PersistentMapping({
+        'message': message,
+        'sender': sender,
+        'recipients': PersistentMapping(
+            [(r, {'status': QUEUED, 'error': ''}) for r in recipients]),
+        'path': '/'.join(context.getPhysicalPath()),
+        'attempts': 0,
+        'created': DateTime(),
+        'next_attempt': DateTime(),
+        'lease': None,
+    })
+    get_outbox(portal)[key] = entry
+    _set_delivery(context, entry)
+
+    path = '/'.join(portal.getPhysicalPath())
+    db = portal._p_jar.db()
+
+    def hook(success):
+        if success:
+            outbox_worker.dispatch(db, path)
+
+    transaction.get().addAfterCommitHook(hook)
+    return key
+
+
+def _header(message, name):
+    """Returns the value of the header of the MIME string message
+    """
+    prefix = name.lower() + ':'
+    for line in message.split('\n'):
+        line = line.rstrip('\r')
+        if not line:
+            break
+        if line.lower().startswith(prefix):
+            return line[len(prefix):].strip()
+    return ''
+
+
+def _set_delivery(obj, entry):
+    """Stores the delivery status of the recipients of the entry in the
+    Delivery field of obj, if any
+    """
+    field = obj.getField('Delivery') if hasattr(obj, 'getField') else None
+    if field is None:
+        return
+    records = dict([(r['EmailAddress'], r) for r in field.get(obj) or []])
+    for recipient, status in entry['recipients'].items():
+        records[recipient] = {'EmailAddress': recipient,
+                              'Status': status['status'],
+                              'Attempts': str(entry['attempts']),
+                              'Date': DateTime().ISO8601(),
+                              'Error': status['error']}
+    field.set(obj, records.values())
+
+
+def pipelined_sendmail(smtp, sender, recipients, message):
+    """Sends message from sender to the recipients (plain email addresses)
+    through the open SMTP connection smtp, like SMTP.sendmail does, but
+    sending the MAIL, RCPT and DATA commands at once if the server supports
+    PIPELINING (RFC 2920).  Returns the dict of refused recipients.
+    """
+    smtp.ehlo_or_helo_if_needed()
+    if not smtp.has_extn('pipelining'):
+        return smtp.sendmail(sender, recipients, message)
+    commands = ['mail FROM:%s' % quoteaddr(sender)]
+    commands += ['rcpt TO:%s' % quoteaddr(r) for r in recipients]
+    commands.append('data')
+    smtp.send(''.join([command + CRLF for command in commands]))
+    replies = [smtp.getreply() for command in commands]
+    code, response = replies[0]
+    if code != 250:
+        smtp.rset()
+        raise SMTPSenderRefused(code, response, sender)
+    refused = {}
+    for recipient, (code, response) in zip(recipients, replies[1:-1]):
+        if code not in (250, 251):
+            refused[recipient] = (code, response)
+    code, response = replies[-1]
+    if code == 354 and len(refused) == len(recipients):
+        # nobody to send the data to, end it empty
+        smtp.send('.' + CRLF)
+        smtp.getreply()
+        code = None
+    if code != 354:
+        smtp.rset()
+        if len(refused) == len(recipients):
+            raise SMTPRecipientsRefused(refused)
+        raise SMTPDataError(code, response)
+    data = quotedata(message)
+    if data[-2:] != CRLF:
+        data += CRLF
+    smtp.send(data + '.' + CRLF)
+    code, response = smtp.getreply()
+    if code != 250:
+        raise SMTPDataError(code, response)
+    return refused
+
+
+class OutboxWorker(object):
+    """Daemon thread that delivers the messages of the outboxes, started
+    with the database or on the first dispatch.  It runs every time a
+    message is queued, and when the next retry (or the expiry of a lease
+    held by another client) is due.
+    """
+
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        # portal path -> db, of the portals with messages to retry
+        self.portals = {}
+        # identifies the leases of this client
+        self.owner = '%s-%s' % (socket.gethostname(), uuid.uuid4().hex[:8])
+
+    def dispatch(self, db, portal_path):
+        """Delivers the messages of the outbox of the portal.  With no
+        portal_path, the messages of all the sites in db are delivered.
+        """
+        with self.lock:
+            if self.thread is None or not self.thread.isAlive():
+                self.thread = threading.Thread(target=self.work)
+                self.thread.setDaemon(True)
+                self.thread.start()
+        self.queue.put((portal_path, db))
+
+    def start(self, db):
+        """Starts the worker, for the messages left in the outboxes of the
+        sites in db
+        """
+        self.dispatch(db, None)
+
+    def work(self):
+        wait = None
+        while True:
+            try:
+                self.add(*self.queue.get(timeout=wait))
+                # the messages queued meanwhile are delivered in this run
+                while True:
+                    self.add(*self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            waits = []
+            for portal_path, db in self.portals.items():
+                try:
+                    next_run = self.deliver(db, portal_path)
+                except Exception:
+                    logger.exception("Outbox of %s failed" % portal_path)
+                    next_run = OUTBOX_RETRY_DELAY
+                if next_run is None:
+                    del self.portals[portal_path]
+                else:
+                    waits.append(next_run)
+            wait = max(1, min(waits)) if waits else None
+
+    def add(self, portal_path, db):
+        """Adds the portal to the ones with messages to deliver, or the
+        sites in db with messages in the outbox, if portal_path is None
+        """
+        if portal_path is not None:
+            self.portals[portal_path] = db
+            return
+        try:
+            for portal_path in self.outboxes(db):
+                self.portals[portal_path] = db
+        except Exception:
+            logger.exception("Unable to find the outboxes")
+
+    def outboxes(self, db):
+        """Returns the paths of the sites in db with messages in the outbox
+        """
+        tm = transaction.TransactionManager()
+        connection = db.open(transaction_manager=tm)
+        try:
+            app = connection.root()['Application']
+            return ['/'.join(site.getPhysicalPath())
+                    for site in app.objectValues('Plone Site')
+                    if IAnnotations(site).get(OUTBOX_KEY)]
+        finally:
+            tm.abort()
+            connection.close()
+
+    def deliver(self, db, portal_path):
+        """Delivers the messages of the outbox of the portal that are due.
+        Returns the seconds until the next retry, or None.
+        """
+        due, next_run = self.run(db, portal_path, self.due)
+        if not due:
+            return next_run
+        smtp = None
+        try:
+            for key, sender, message, recipients in due:
+                try:
+                    if smtp is None:
+                        smtp = self.connect(db, portal_path)
+                    statuses = self.send(smtp, sender, message, recipients)
+                except (SMTPException, socket.error) as e:
+                    logger.warn("Outbox of %s: %s" % (portal_path, e))
+                    statuses = dict([(r, (QUEUED, str(e)))
+                                     for r in recipients])
+                if QUEUED in [status for status, e in statuses.values()]:
+                    # the connection may be broken, use a new one
+                    smtp = self.close(smtp)
+                retry = self.run(db, portal_path, self.record, key, statuses)
+                if retry is not None:
+                    next_run = retry if next_run is None \
+                        else min(next_run, retry)
+        finally:
+            self.close(smtp)
+        return next_run
+
+    def send(self, smtp, sender, message, recipients):
+        """Sends message to each recipient, with its To header.  Returns a
+        dict recipient -> (status, error)
+        """
+        statuses = {}
+        for index, recipient in enumerate(recipients):
+            address = parseaddr(recipient)[1]
+            data = 'To: %s%s%s' % (recipient, CRLF, message)
+            try:
+                refused = pipelined_sendmail(smtp, sender, [address], data)
+            except SMTPRecipientsRefused as e:
+                refused = e.recipients
+            except SMTPResponseException as e:
+                refused = {address: (e.smtp_code, e.smtp_error)}
+            except (SMTPException, socket.error) as e:
+                # connection lost, the remaining recipients are tried again
+                for remaining in recipients[index:]:
+                    statuses[remaining] = (QUEUED, str(e))
+                break
+            if address in refused:
+                code, error = refused[address]
+                status = FAILED if code >= 500 else QUEUED
+                statuses[recipient] = (status, '%s %s' % (code, error))
+            else:
+                statuses[recipient] = (SENT, '')
+        return statuses
+
+    def connect(self, db, portal_path):
+        """Opens the SMTP connection, with the settings of the MailHost of
+        the portal.  The connection is encrypted with STARTTLS when the
+        MailHost forces TLS (and fails if the server does not support it),
+        or when the server supports it and a login is needed.  The worker
+        does not log in over an unencrypted connection, unless the
+        bika.lims.mailqueue.allow_plain_login record of the registry is set.
+        """
+        settings = self.run(db, portal_path, self.settings)
+        host, port, userid, password, tls, plain_login = settings
+        smtp = SMTP(host, int(port or 25), timeout=OUTBOX_SMTP_TIMEOUT)
+        try:
+            smtp.ehlo()
+            encrypted = False
+            if tls or (userid and smtp.has_extn('starttls')):
+                if not smtp.has_extn('starttls'):
+                    raise SMTPException(
+                        "%s does not support STARTTLS, required by the "
+                        "MailHost" % host)
+                smtp.starttls()
+                smtp.ehlo()
+                encrypted = True
+            if userid:
+                if not encrypted and not plain_login:
+                    raise SMTPException(
+                        "%s does not support STARTTLS, the login would be "
+                        "sent unencrypted" % host)
+                smtp.login(userid, password)
+        except:
+            smtp.close()
+            raise
+        return smtp
+
+    def close(self, smtp):
+        if smtp is not None:
+            try:
+                smtp.quit()
+            except (SMTPException, socket.error):
+                smtp.close()
+        return None
+
+    def run(self, db, portal_path, step, *args):
+        """Runs step(portal, *args) in a transaction of its own, from a
+        separate connection, and returns its result
+        """
+        tm = transaction.TransactionManager()
+        connection = db.open(transaction_manager=tm)
+        try:
+            for attempt in range(OUTBOX_COMMIT_RETRIES):
+                try:
+                    app = makerequest(connection.root()['Application'])
+                    portal = app.unrestrictedTraverse(portal_path)
+                    result = step(portal, *args)
+                    tm.commit()
+                    return result
+                except ConflictError:
+                    tm.abort()
+            raise ConflictError("Outbox of %s: too many conflicts" %
+                                portal_path)
+        except:
+            tm.abort()
+            raise
+        finally:
+            connection.close()
+
+    def settings(self, portal):
+        host = getToolByName(portal, 'MailHost')
+        registry = getToolByName(portal, 'portal_registry')
+        return (host.smtp_host, host.smtp_port,
+                getattr(host, 'smtp_uid', ''), getattr(host, 'smtp_pwd', ''),
+                getattr(host, 'force_tls', False),
+                registry.get('bika.lims.mailqueue.allow_plain_login', False))
+
+    def due(self, portal):
+        """Claims the messages due, up to OUTBOX_RUN_SIZE, and returns them
+        as (key, sender, message, recipients), with the seconds until the
+        next message is due, or None.  The messages leased by others are
+        skipped until their lease expires.  The leases are committed by run
+        before the messages are sent.
+        """
+        now = DateTime()
+        due = []
+        next_run = None
+        for key, entry in get_outbox(portal).items():
+            lease = entry.get('lease', None)
+            if lease and lease['owner'] != self.owner \
+                    and lease['expires'] > now:
+                start = lease['expires']
+            else:
+                start = entry['next_attempt']
+            if start > now or len(due) >= OUTBOX_RUN_SIZE:
+                wait = max(0, (start - now) * 24 * 3600)
+                next_run = wait if next_run is None else min(next_run, wait)
+                continue
+            entry['lease'] = {
+                'owner': self.owner,
+                'expires': now + OUTBOX_LEASE_TIME / (24.0 * 3600)}
+            recipients = [r for r, status in entry['recipients'].items()
+                          if status['status'] == QUEUED]
+            due.append((key, entry['sender'], entry['message'], recipients))
+        return due, next_run
+
+    def record(self, portal, key, statuses):
+        """Stores the statuses of the recipients of the message key.
+        Returns the seconds until the message must be tried again, or None.
+        """
+        outbox = get_outbox(portal)
+        entry = outbox.get(key, None)
+        if entry is None:
+            return None
+        entry['attempts'] += 1
+        entry['lease'] = None
+        for recipient, (status, error) in statuses.items():
+            if status == QUEUED and entry['attempts'] >= OUTBOX_MAX_ATTEMPTS:
+                status = FAILED
+            entry['recipients'][recipient] = {'status': status,
+                                              'error': error}
+            if status == FAILED:
+                logger.error("Email to %s not sent: %s" % (recipient, error))
+        obj = portal.unrestrictedTraverse(entry['path'], None)
+        if obj is not None:
+            _set_delivery(obj, entry)
+        if QUEUED not in [s['status'] for s in entry['recipients'].values()]:
+            del outbox[key]
+            return None
+        delay = OUTBOX_RETRY_DELAY * 2 ** (entry['attempts'] - 1)
+        entry['next_attempt'] = DateTime() + delay / (24.0 * 3600)
+        return delay
+
+
+outbox_worker = OutboxWorker()
@@ -0,0 +1,156 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+""" Paging of catalog results.
+
+The catalog returns lazy sequences: brains are only created when an item
+of the sequence is accessed, and objects are never woken up by the
+functions in this module.  Deep pages are cheap when a cursor is used: the
+query is restricted with a range on the sort index, starting at the last
+value of the previous page, so the catalog only needs to sort the items of
+the requested page.
+"""
+
+import base64
+import json
+
+from DateTime import DateTime
+
+
+def result_count(results):
+    """Returns the number of items matching the query that returned the lazy
+    sequence passed in, without waking up any object.  When the query was
+    limited with sort_limit, the count of all the matching items is
+    returned, not the length of the (limited) sequence.
+    """
+    count = getattr(results, 'actual_result_count', None)
+    if count is None:
+        count = len(results)
+    return count
+
+
+def lazy_slice(results, start=0, stop=None):
+    """Generator that walks through the lazy sequence passed in, from start
+    to stop, creating the brains one by one as they are consumed.  Unlike
+    results[start:], the remainder of the sequence is never loaded.
+    """
+    i = start
+    while stop is None or i < stop:
+        try:
+            item = results[i]
+        except IndexError:
+            return
+        yield item
+        i += 1
+
+
+def encode_cursor(value, uids):
+    """Returns an url-safe string for the sort value of the last item of a
+    page and the UIDs of the items of the page that share this value.
+    """
+    if isinstance(value, DateTime):
+        value = {'DateTime': value.ISO8601()}
+    data = json.dumps({'value': value, 'uids': list(uids)})
+    return base64.urlsafe_b64encode(data)
+
+
+def decode_cursor(cursor):
+    """Returns the (value, uids) tuple encoded in cursor, or (None, []) if
+    the cursor is not valid.
+    """
+    try:
+        data = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        return None, []
+    value = data.get('value', None)
+    if isinstance(value, dict) and 'DateTime' in value:
+        value = DateTime(value['DateTime'])
+    return value, data.get('uids', [])
+
+
+class CatalogPager(object):
+    """Searches a catalog and returns a single page of brains.
+
+    - sort_limit is pushed down to the catalog, so only the brains up to the
+      end of the requested page are sorted.
+    - If a cursor (see next_cursor) is passed in, the query starts right
+      after the last item of the previous page, and limit_from is ignored.
+      Cursors are only available when the sort index is also a metadata
+      column of the catalog, and the query doesn't already search it.
+    - total is computed from the catalog result set and never wakes objects.
+    """
+
+    def __init__(self, catalog, query, page_size=10, limit_from=0,
+                 cursor=None):
+        self.catalog = catalog
+        self.query = dict(query)
+        self.page_size = page_size
+        self.limit_from = limit_from
+        self.cursor = cursor
+        self.sort_on = self.query.get('sort_on', None)
+        sort_order = self.query.get('sort_order', 'ascending') or 'ascending'
+        self.reverse = sort_order[0] in ('d', 'r')
+        self.brains = []
+        self.total = 0
+        self.has_more = False
+        self.next_cursor = None
+
+    def cursor_enabled(self):
+        """Cursors need the value of the sort index for each brain, and a
+        range query on the sort index.
+        """
+        if not self.sort_on or self.sort_on not in self.catalog.schema():
+            return False
+        original = self.query.get(self.sort_on, None)
+        return original is None
+
+    def search(self):
+        """Runs the query and sets brains, total, has_more and next_cursor.
+        Returns the list of brains of the page.
+        """
+        query = dict(self.query)
+        start = self.limit_from
+        value, seen = None, []
+        if self.cursor and self.cursor_enabled():
+            value, seen = decode_cursor(self.cursor)
+        if value is not None:
+            query[self.sort_on] = {
+                'query': value,
+                'range': 'max' if self.reverse else 'min'}
+            start = 0
+        if self.page_size:
+            limit = start + len(seen) + self.page_size + 1
+            query['sort_limit'] = min(limit, query.get('sort_limit', limit))
+
+        results = self.catalog(query)
+        if value is None:
+            self.total = result_count(results)
+        else:
+            # count all the matches, not only the ones after the cursor.
+            # Without sort_on, the catalog doesn't sort at all.
+            count_query = dict(self.query)
+            for key in ('sort_on', 'sort_order', 'sort_limit'):
+                count_query.pop(key, None)
+            self.total = result_count(self.catalog(count_query))
+
+        seen = set(seen)
+        brains = []
+        for brain in lazy_slice(results, start):
+            if brain.UID in seen:
+                continue
+            if self.page_size and len(brains) == self.page_size:
+                self.has_more = True
+                break
+            brains.append(brain)
+        self.brains = brains
+
+        if self.has_more and brains and self.cursor_enabled():
+            last = getattr(brains[-1], self.sort_on, None)
+            uids = [b.UID for b in brains
+                    if getattr(b, self.sort_on, None) == last]
+            if value is not None and last == value:
+                uids.extend(seen)
+            self.next_cursor = encode_cursor(last, uids)
+        return brains
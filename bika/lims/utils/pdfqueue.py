@@ -0,0 +1,321 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+""" Background generation of PDF files.
+
+Rendering a PDF with WeasyPrint takes seconds, and blocks the Zope thread
+that serves the request.  Instead, the HTML of the report is stored in a
+persistent job, in the portal annotations, and the PDF is rendered by a
+pool of worker threads of the Zope client, each one running WeasyPrint in
+a process of its own.  Once rendered, the PDF is stored in a file field of
+the target object (e.g. the ReportFile of a Report) from a separate ZODB
+connection, and the job is marked as done.
+
+Jobs are dispatched once the transaction that queued them is committed.
+Jobs left queued by a client that was restarted are dispatched again when
+their status is polled (see get_job_status).  Reading the jobs or their
+status never writes to the ZODB.  The html of a job is dropped once it is
+done or failed, and the job is removed PDF_JOB_RETENTION days later, when
+another job is queued.
+"""
+
+from BTrees.OOBTree import OOBTree
+from DateTime import DateTime
+from Products.CMFCore.utils import getToolByName
+from Testing.makerequest import makerequest
+from ZODB.POSException import ConflictError
+from bika.lims import logger
+from bika.lims.utils import to_utf8
+from persistent.mapping import PersistentMapping
+from zope.annotation.interfaces import IAnnotations
+import Queue
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import transaction
+
+PDF_JOBS_KEY = 'bika.lims.pdfqueue.jobs'
+
+# Number of PDFs rendered at the same time by each Zope client
+PDF_WORKERS = 2
+# Minutes after which a job not finished is dispatched again
+PDF_JOB_TIMEOUT = 15
+# Days after which the finished jobs are removed
+PDF_JOB_RETENTION = 7
+PDF_COMMIT_RETRIES = 5
+
+# Runs in the worker process: renders the html file into the pdf file
+RENDER_SCRIPT = """
+import sys
+from weasyprint import HTML
+HTML(filename=sys.argv[1], encoding='utf-8').write_pdf(sys.argv[2])
+"""
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def get_jobs(context, create=False):
+    """ Returns the OOBTree with the PDF jobs of the portal, keyed by the
+        UID of the object the PDF is stored in.  If no job was queued yet,
+        returns an empty mapping, unless create is True.
+    """
+    portal = getToolByName(context, 'portal_url').getPortalObject()
+    annotations = IAnnotations(portal)
+    if PDF_JOBS_KEY not in annotations:
+        if not create:
+            return {}
+        annotations[PDF_JOBS_KEY] = OOBTree()
+    return annotations[PDF_JOBS_KEY]
+
+
+def get_job(context, uid):
+    """ Returns the job that renders the PDF of the object with the UID
+        passed in, or None
+    """
+    return get_jobs(context).get(uid, None)
+
+
+def queue_pdf(target, html, fieldname):
+    """ Queues the rendering of html into a PDF, to be stored in the field
+        fieldname of target.  The job is dispatched to the workers once the
+        current transaction is committed.
+    """
+    jobs = get_jobs(target, create=True)
+    prune_jobs(jobs)
+    uid = target.UID()
+    jobs[uid] = PersistentMapping({
+        'status': QUEUED,
+        'path': '/'.join(target.getPhysicalPath()),
+        'fieldname': fieldname,
+        'html': to_utf8(html),
+        'created': DateTime(),
+        'started': None,
+        'finished': None,
+        'error': '',
+    })
+    _dispatch_after_commit(target, uid)
+    return jobs[uid]
+
+
+def prune_jobs(jobs):
+    """ Removes the jobs done or failed more than PDF_JOB_RETENTION days
+        ago
+    """
+    limit = DateTime() - PDF_JOB_RETENTION
+    for uid in [uid for uid, job in jobs.items()
+                if job['status'] in (DONE, FAILED)
+                and job['finished'] and job['finished'] < limit]:
+        del jobs[uid]
+
+
+def get_job_status(context, uid):
+    """ Returns a dict with the status of the job of the object with the
+        UID passed in, for polling.  Jobs not finished PDF_JOB_TIMEOUT
+        minutes after they were queued or started, and not dispatched by
+        this client in the meantime, are dispatched again.
+    """
+    job = get_job(context, uid)
+    if job is None:
+        return {'uid': uid, 'status': None}
+    if job['status'] in (QUEUED, RUNNING) and \
+            (job['started'] or job['created']) < \
+            DateTime() - PDF_JOB_TIMEOUT / (24.0 * 60) and \
+            not pdf_workers.pending(uid):
+        # The job is committed already, so it is dispatched right away
+        portal = getToolByName(context, 'portal_url').getPortalObject()
+        pdf_workers.dispatch(portal._p_jar.db(),
+                             '/'.join(portal.getPhysicalPath()), uid)
+    return {'uid': uid,
+            'status': job['status'],
+            'error': job['error'],
+            'created': job['created'] and job['created'].ISO8601(),
+            'finished': job['finished'] and job['finished'].ISO8601()}
+
+
+def _dispatch_after_commit(context, uid):
+    """ Dispatches the job to the workers once the current transaction is
+        committed, so the workers find the job and its target
+    """
+    portal = getToolByName(context, 'portal_url').getPortalObject()
+    path = '/'.join(portal.getPhysicalPath())
+    db = portal._p_jar.db()
+
+    def hook(success):
+        if success:
+            pdf_workers.dispatch(db, path, uid)
+
+    transaction.get().addAfterCommitHook(hook)
+
+
+def render_pdf(html):
+    """ Renders html into a PDF in a separate process, and returns the PDF
+        data.  Raises RuntimeError if the rendering fails.
+    """
+    html_fd, html_fn = tempfile.mkstemp(suffix='.html')
+    pdf_fd, pdf_fn = tempfile.mkstemp(suffix='.pdf')
+    os.close(pdf_fd)
+    try:
+        with os.fdopen(html_fd, 'wb') as html_file:
+            html_file.write(html)
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(sys.path)
+        process = subprocess.Popen(
+            [sys.executable, '-c', RENDER_SCRIPT, html_fn, pdf_fn],
+            env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError(err.strip().split('\n')[-1] or
+                               "PDF rendering failed")
+        return open(pdf_fn, 'rb').read()
+    finally:
+        for fn in (html_fn, pdf_fn):
+            if os.path.exists(fn):
+                os.remove(fn)
+
+
+def render_pdfs(htmls, workers=PDF_WORKERS):
+    """ Renders the list of htmls into PDFs, workers at a time, each one in
+        a process of its own.  Returns the list of PDF data, in the same
+        order, with None for the PDFs that could not be rendered.
+    """
+    pdfs = [None] * len(htmls)
+    pending = Queue.Queue()
+    for index in range(len(htmls)):
+        pending.put(index)
+
+    def work():
+        while True:
+            try:
+                index = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                pdfs[index] = render_pdf(htmls[index])
+            except Exception as e:
+                logger.error("PDF rendering failed: %s" % e)
+
+    threads = [threading.Thread(target=work)
+               for i in range(min(workers, len(htmls)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return pdfs
+
+
+class PDFWorkers(object):
+    """ Pool of daemon threads that render the queued jobs, started on the
+        first dispatch.  Keeps the time each job was dispatched at, until
+        it is processed, so the polls do not dispatch it again meanwhile.
+    """
+
+    def __init__(self, size=PDF_WORKERS):
+        self.size = size
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.dispatched = {}
+        self.lock = threading.Lock()
+
+    def dispatch(self, db, portal_path, uid):
+        with self.lock:
+            self.threads = [t for t in self.threads if t.isAlive()]
+            while len(self.threads) < self.size:
+                thread = threading.Thread(target=self.work)
+                thread.setDaemon(True)
+                thread.start()
+                self.threads.append(thread)
+            self.dispatched[uid] = time.time()
+        self.queue.put((db, portal_path, uid))
+
+    def pending(self, uid):
+        """ Returns True if the job was dispatched by this client less than
+            PDF_JOB_TIMEOUT minutes ago, and is not processed yet
+        """
+        with self.lock:
+            dispatched = self.dispatched.get(uid, None)
+        return dispatched is not None and \
+            dispatched > time.time() - PDF_JOB_TIMEOUT * 60
+
+    def work(self):
+        while True:
+            db, portal_path, uid = self.queue.get()
+            try:
+                self.process(db, portal_path, uid)
+            except Exception:
+                logger.exception("PDF job for %s failed" % uid)
+            finally:
+                with self.lock:
+                    self.dispatched.pop(uid, None)
+
+    def process(self, db, portal_path, uid):
+        html = self.update(db, portal_path, uid, self.start)
+        if html is None:
+            return
+        try:
+            pdf = render_pdf(html)
+        except Exception as e:
+            self.update(db, portal_path, uid, self.fail, str(e))
+            return
+        self.update(db, portal_path, uid, self.store, pdf)
+
+    def update(self, db, portal_path, uid, step, *args):
+        """ Runs step(app, job, *args) in a transaction of its own, from a
+            separate connection, and returns its result
+        """
+        tm = transaction.TransactionManager()
+        connection = db.open(transaction_manager=tm)
+        try:
+            for attempt in range(PDF_COMMIT_RETRIES):
+                try:
+                    app = makerequest(connection.root()['Application'])
+                    portal = app.unrestrictedTraverse(portal_path)
+                    job = get_jobs(portal).get(uid, None)
+                    if job is None:
+                        return None
+                    result = step(app, job, *args)
+                    tm.commit()
+                    return result
+                except ConflictError:
+                    tm.abort()
+            logger.error("PDF job for %s: too many conflicts" % uid)
+        finally:
+            connection.close()
+
+    def start(self, app, job):
+        if job['status'] == DONE:
+            return None
+        job['status'] = RUNNING
+        job['started'] = DateTime()
+        return job['html']
+
+    def fail(self, app, job, error):
+        job['status'] = FAILED
+        job['error'] = error
+        job['finished'] = DateTime()
+        # a failed job is not retried: the html is not needed anymore
+        job['html'] = ''
+        logger.error("PDF job for %s failed: %s" % (job['path'], error))
+
+    def store(self, app, job, pdf):
+        target = app.unrestrictedTraverse(job['path'], None)
+        if target is None:
+            job['status'] = FAILED
+            job['error'] = "%s not found" % job['path']
+        else:
+            target.getField(job['fieldname']).set(target, pdf)
+            target.reindexObject()
+            job['status'] = DONE
+        # the html is not needed anymore
+        job['html'] = ''
+        job['finished'] = DateTime()
+
+
+pdf_workers = PDFWorkers()
@@ -0,0 +1,277 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+""" Background publication of AR reports.
+
+Publishing hundreds of ARs renders a PDF per AR, and used to hold the Zope
+thread of the request (and its ZODB connection) for the whole run, in a
+single transaction that a ConflictError on any AR made ZPublisher retry
+from scratch, PDFs included.
+
+The request now only renders the results html of each AR, and stores it in
+a persistent publication job, in the portal annotations.  Once the request
+is committed, a worker thread of the Zope client publishes the ARs of the
+job from a separate ZODB connection, on behalf of the user who published,
+PUBLISH_BATCH_SIZE ARs per transaction:
+
+- the PDFs of the batch are rendered outside of any transaction;
+- the ARReports are created, the ARs transitioned and the emails queued,
+  and the transaction is committed.  The ARReports keep the id of the job,
+  so the ARs that already have a report for the job are skipped when the
+  batch is retried after a conflict, or when the job is dispatched again
+  after a restart of the Zope client.
+
+Finished jobs drop their html, and are removed PUBLISH_JOB_RETENTION days
+after they were created.
+"""
+
+from AccessControl.SecurityManagement import newSecurityManager
+from AccessControl.SecurityManagement import noSecurityManager
+from AccessControl import getSecurityManager
+from BTrees.OOBTree import OOBTree
+from DateTime import DateTime
+from Products.CMFCore.utils import getToolByName
+from Testing.makerequest import makerequest
+from ZODB.POSException import ConflictError
+from bika.lims import logger
+from persistent.list import PersistentList
+from persistent.mapping import PersistentMapping
+from zope.annotation.interfaces import IAnnotations
+from zope.component.hooks import getSite
+from zope.component.hooks import setSite
+import Queue
+import threading
+import transaction
+import uuid
+
+PUBLISH_JOBS_KEY = 'bika.lims.publishqueue.jobs'
+
+# Number of ARs published per transaction
+PUBLISH_BATCH_SIZE = 10
+PUBLISH_COMMIT_RETRIES = 5
+# Days after which the finished jobs are removed
+PUBLISH_JOB_RETENTION = 7
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def get_publication_jobs(context, create=False):
+    """ Returns the OOBTree with the publication jobs of the portal, keyed
+        by job id.  If no job was queued yet, returns an empty mapping,
+        unless create is True.
+    """
+    portal = getToolByName(context, 'portal_url').getPortalObject()
+    annotations = IAnnotations(portal)
+    if PUBLISH_JOBS_KEY not in annotations:
+        if not create:
+            return {}
+        annotations[PUBLISH_JOBS_KEY] = OOBTree()
+    return annotations[PUBLISH_JOBS_KEY]
+
+
+def queue_publication(context, items):
+    """ Queues the publication of the ARs of items, a list of dicts with the
+        publication data of each AR (see AnalysisRequestPublishView), where
+        'ar' is the UID of the AR.  The job is dispatched to the worker once
+        the current transaction is committed, and runs on behalf of the
+        current user.  The unfinished jobs left by a restart of the Zope
+        client are dispatched again with it.  Returns the id of the job.
+    """
+    jobs = get_publication_jobs(context, create=True)
+    prune_publication_jobs(jobs)
+    job_id = uuid.uuid4().hex
+    userid = getSecurityManager().getUser().getId()
+    jobs[job_id] = PersistentMapping({
+        'status': QUEUED,
+        'userid': userid,
+        'items': PersistentList(items),
+        'next': 0,
+        'published': PersistentList(),
+        'failed': PersistentList(),
+        'created': DateTime(),
+        'finished': None,
+        'error': '',
+    })
+    portal = getToolByName(context, 'portal_url').getPortalObject()
+    portal_path = '/'.join(portal.getPhysicalPath())
+    db = portal._p_jar.db()
+
+    unfinished = [(key, job['userid']) for key, job in jobs.items()
+                  if job['status'] in (QUEUED, RUNNING)]
+
+    def hook(success):
+        if success:
+            for key, userid in unfinished:
+                publication_worker.dispatch(db, portal_path, key, userid)
+
+    transaction.get().addAfterCommitHook(hook)
+    return job_id
+
+
+def prune_publication_jobs(jobs):
+    """ Removes the finished jobs created more than PUBLISH_JOB_RETENTION
+        days ago
+    """
+    limit = DateTime() - PUBLISH_JOB_RETENTION
+    for job_id in [job_id for job_id, job in jobs.items()
+                   if job['status'] in (DONE, FAILED)
+                   and job['created'] < limit]:
+        del jobs[job_id]
+
+
+def has_report(ar, job_id):
+    """ True if the AR has a report published by the job
+    """
+    return bool([r for r in ar.objectValues('ARReport')
+                 if r.getPublicationJob() == job_id])
+
+
+class PublicationWorker(object):
+    """ Daemon thread that runs the queued publication jobs one after the
+        other.  Started on the first dispatch.
+    """
+
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.pending = set()
+
+    def dispatch(self, db, portal_path, job_id, userid):
+        with self.lock:
+            if job_id in self.pending:
+                return
+            self.pending.add(job_id)
+            if self.thread is None or not self.thread.isAlive():
+                self.thread = threading.Thread(target=self.work)
+                self.thread.setDaemon(True)
+                self.thread.start()
+        self.queue.put((db, portal_path, job_id, userid))
+
+    def work(self):
+        while True:
+            db, portal_path, job_id, userid = self.queue.get()
+            try:
+                self.process(db, portal_path, job_id, userid)
+            except Exception:
+                logger.exception("Publication %s failed" % job_id)
+            finally:
+                with self.lock:
+                    self.pending.discard(job_id)
+
+    def process(self, db, portal_path, job_id, userid):
+        """ Publishes the job a batch at a time, until all the ARs are
+            published
+        """
+        from bika.lims.utils.pdfqueue import render_pdfs
+        while True:
+            try:
+                batch = self.run(db, portal_path, job_id, userid, self.start)
+                if not batch:
+                    return
+                pdfs = render_pdfs([item['html'] for item in batch])
+                self.run(db, portal_path, job_id, userid, self.store,
+                         batch, pdfs)
+            except Exception as e:
+                logger.exception("Publication %s failed" % job_id)
+                self.run(db, portal_path, job_id, userid, self.fail, str(e))
+                return
+
+    def run(self, db, portal_path, job_id, userid, step, *args):
+        """ Runs step(portal, job_id, job, *args) in a transaction of its
+            own, from a separate connection, and returns its result
+        """
+        # The connection uses the transaction manager of this thread, so
+        # the emails queued (see queue_mail) are sent once it is committed
+        tm = transaction.manager
+        connection = db.open(transaction_manager=tm)
+        site = getSite()
+        try:
+            for attempt in range(PUBLISH_COMMIT_RETRIES):
+                tm.begin()
+                try:
+                    app = makerequest(connection.root()['Application'])
+                    portal = app.unrestrictedTraverse(portal_path)
+                    setSite(portal)
+                    acl_users = portal.acl_users
+                    user = acl_users.getUserById(userid)
+                    if user is None:
+                        acl_users = app.acl_users
+                        user = acl_users.getUserById(userid)
+                    if user is None:
+                        logger.error("Publication %s: user %s not found" %
+                                     (job_id, userid))
+                        tm.abort()
+                        return None
+                    newSecurityManager(None, user.__of__(acl_users))
+                    job = get_publication_jobs(portal).get(job_id, None)
+                    if job is None:
+                        tm.abort()
+                        return None
+                    result = step(portal, job_id, job, *args)
+                    tm.commit()
+                    return result
+                except ConflictError:
+                    tm.abort()
+            raise ConflictError("Publication %s: too many conflicts" % job_id)
+        except:
+            tm.abort()
+            raise
+        finally:
+            noSecurityManager()
+            setSite(site)
+            connection.close()
+
+    def start(self, portal, job_id, job):
+        """ Returns the items of the next batch to publish, or None if the
+            job is finished
+        """
+        if job['status'] in (DONE, FAILED):
+            return None
+        if job['next'] >= len(job['items']):
+            job['status'] = DONE
+            job['finished'] = DateTime()
+            # the html is not needed anymore
+            job['items'] = PersistentList()
+            return None
+        job['status'] = RUNNING
+        return [dict(item) for item in
+                job['items'][job['next']:job['next'] + PUBLISH_BATCH_SIZE]]
+
+    def store(self, portal, job_id, job, batch, pdfs):
+        """ Creates the ARReports of the batch, transitions the ARs and
+            queues the emails.  The ARs that already have a report for the
+            job are skipped, as are the ones which PDF could not be rendered.
+        """
+        from bika.lims.browser.analysisrequest.publish import \
+            AnalysisRequestPublishView
+        uc = getToolByName(portal, 'uid_catalog')
+        view = AnalysisRequestPublishView(portal, portal.REQUEST)
+        for item, pdf in zip(batch, pdfs):
+            brains = uc(UID=item['ar'])
+            if not brains:
+                job['failed'].append(item['ar'])
+                continue
+            ar = brains[0].getObject()
+            if has_report(ar, job_id):
+                continue
+            if not pdf:
+                logger.error("Unable to render the PDF of %s" % ar.getId())
+                job['failed'].append(item['ar'])
+                continue
+            view.publishReport(dict(item, ar=ar), pdf, job_id)
+            job['published'].append(item['ar'])
+        job['next'] += len(batch)
+
+    def fail(self, portal, job_id, job, error):
+        job['status'] = FAILED
+        job['error'] = error
+        job['finished'] = DateTime()
+
+
+publication_worker = PublicationWorker()
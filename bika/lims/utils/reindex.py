@@ -0,0 +1,133 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+""" Deferred reindexing of objects.
+
+The workflow scripts of analyses reindex their AR, their Sample and their
+Worksheet on every transition, so transitioning many analyses at once
+reindexes the same objects over and over.  Within deferred_reindexing(),
+reindexObject calls (see bika.lims.monkey.reindex) are queued per object
+instead, the index names are merged, and every queued object is reindexed
+once, right before the transaction is committed.
+
+The indexes in IMMEDIATE_INDEXES (and the metadata, updated along with
+them) are always reindexed at once: workflow scripts decide the cascades
+from the review states stored in the catalog (e.g. "are all the analyses
+of this AR verified?").
+
+Deferred reindexing is only active where it is asked for: the workflow
+transitions of the JSON API (see bika.lims.jsonapi.doactionfor) and the
+bulk creation of ARs (create_analysisrequests).  The workflow actions of
+the listings and views of the site (see WorkflowAction, in
+bika.lims.browser.bika_listing) still reindex at once.
+"""
+
+from bika.lims import logger
+from collections import OrderedDict
+import threading
+import transaction
+
+IMMEDIATE_INDEXES = (
+    'review_state',
+    'worksheetanalysis_review_state',
+    'cancellation_state',
+    'inactive_state',
+    'allowedRolesAndUsers',
+)
+
+# Marks a queued full reindex (all the indexes, and notifyModified)
+ALL = None
+
+_local = threading.local()
+
+
+class ReindexQueue(object):
+    """Objects waiting to be reindexed, with the merged index names, and
+    flushed by a before-commit hook of the transaction they belong to
+    """
+
+    def __init__(self, txn):
+        self.txn = txn
+        self.depth = 0
+        self.objects = OrderedDict()
+        txn.addBeforeCommitHook(self.flush)
+
+    def add(self, obj, idxs):
+        """Queues obj to be reindexed.  Returns the index names that must be
+        reindexed at once, or None if there are none left.
+        """
+        key = '/'.join(obj.getPhysicalPath())
+        idxs = list(idxs or [])
+        if not idxs:
+            immediate = list(IMMEDIATE_INDEXES)
+        else:
+            immediate = [i for i in idxs if i in IMMEDIATE_INDEXES]
+        deferred = [i for i in idxs if i not in IMMEDIATE_INDEXES]
+        if idxs and not deferred:
+            return immediate
+        queued = self.objects.get(key, (obj, set()))[1]
+        if not idxs:
+            queued = ALL
+        elif queued is not ALL:
+            queued.update(deferred)
+        self.objects[key] = (obj, queued)
+        return immediate or None
+
+    def savepoint(self):
+        """Returns the paths of the objects queued so far, to be passed to
+        rollback along with the rollback of a transaction savepoint
+        """
+        return set(self.objects.keys())
+
+    def rollback(self, keys):
+        """Discards the objects queued after savepoint() returned keys
+        """
+        for key in self.objects.keys():
+            if key not in keys:
+                del self.objects[key]
+
+    def flush(self):
+        """Reindexes every queued object once
+        """
+        objects, self.objects = self.objects, OrderedDict()
+        for key, (obj, idxs) in objects.items():
+            if obj.getPhysicalRoot().unrestrictedTraverse(key, None) is None:
+                # removed after it was queued
+                continue
+            if idxs is ALL:
+                obj._old_reindexObject()
+            else:
+                obj._old_reindexObject(idxs=list(idxs))
+        if objects:
+            logger.debug("Deferred reindexing of %s objects" % len(objects))
+
+
+def get_reindex_queue():
+    """Returns the ReindexQueue of the current transaction, if deferred
+    reindexing is active, or None
+    """
+    queue = getattr(_local, 'queue', None)
+    if queue is None or queue.txn is not transaction.get() \
+            or queue.depth == 0:
+        return None
+    return queue
+
+
+class deferred_reindexing(object):
+    """Context manager that defers the reindexing of objects until the
+    current transaction is committed
+    """
+
+    def __enter__(self):
+        queue = getattr(_local, 'queue', None)
+        if queue is None or queue.txn is not transaction.get():
+            queue = ReindexQueue(transaction.get())
+            _local.queue = queue
+        queue.depth += 1
+        return queue
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _local.queue.depth -= 1
+        return False
@@ -0,0 +1,172 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+""" History of the results of the Analysis Requests of a Batch.
+
+Result reports show, next to each result, the previous results of the same
+service in the other ARs of the Batch.  Instead of waking every AR of the
+Batch and their analyses at publication time, each Batch keeps the
+verified (and published) results of its ARs in an annotation, indexed by
+keyword and capture date.  Results are indexed when an analysis is
+verified or published, and removed when it leaves these states (see the
+AfterTransitionEventHandler of the analyses).  The results of an AR are
+moved when the AR is assigned to another Batch (see setBatch of the AR),
+and the results of the ARs that are no longer in the Batch (e.g. deleted)
+are left out when the history is read.  The history of a Batch created
+before this index existed is built on first use.
+
+Only the analyses whose id is their keyword are indexed (not retests), as
+the reports always did.  The formatted results are stored with the
+scientific notation settings of the time they were indexed.
+"""
+
+from BTrees.OOBTree import OOBTree
+from Products.CMFCore.utils import getToolByName
+from zope.annotation.interfaces import IAnnotations
+
+HISTORY_KEY = 'bika.lims.resultshistory'
+UIDS_KEY = 'bika.lims.resultshistory.uids'
+
+HISTORY_STATES = ('verified', 'published')
+
+
+def _date_key(date):
+    return date.timeTime() if date else 0
+
+
+def _history(batch, create=True):
+    """Returns the (keyword -> (capture date, UID) -> result) and the
+    (UID -> keyword, key) trees of the batch, built if needed and create is
+    True
+    """
+    annotations = IAnnotations(batch)
+    history = annotations.get(HISTORY_KEY, None)
+    if history is None and create:
+        annotations[HISTORY_KEY] = OOBTree()
+        annotations[UIDS_KEY] = OOBTree()
+        history = annotations[HISTORY_KEY]
+        rebuild_results_history(batch)
+    return history, annotations.get(UIDS_KEY, None)
+
+
+def _batch_of(analysis):
+    ar = analysis.aq_parent
+    return ar.getBatch() if hasattr(ar, 'getBatch') else None
+
+
+def index_analysis_result(analysis, batch=None):
+    """Adds the result of the analysis to the history of the Batch of its
+    AR, or removes it if the analysis is not verified or published, or has
+    no result
+    """
+    batch = batch or _batch_of(analysis)
+    if not batch or analysis.getId() != analysis.getKeyword():
+        return
+    workflow = getToolByName(analysis, 'portal_workflow')
+    state = workflow.getInfoFor(analysis, 'review_state', '')
+    result = analysis.getResult()
+    if state not in HISTORY_STATES or not result:
+        unindex_analysis_result(analysis, batch)
+        return
+    history, uids = _history(batch)
+    uid = analysis.UID()
+    keyword = analysis.getKeyword()
+    capture_date = analysis.getResultCaptureDate()
+    key = (_date_key(capture_date), uid)
+    unindex_analysis_result(analysis, batch)
+    scinot = analysis.bika_setup.getScientificNotationReport()
+    specs = analysis.getResultsRange()
+    if keyword not in history:
+        history[keyword] = OOBTree()
+    history[keyword][key] = {
+        'uid': uid,
+        'keyword': keyword,
+        'request_uid': analysis.aq_parent.UID(),
+        'request_id': analysis.aq_parent.getId(),
+        'capture_date': capture_date,
+        'result': result,
+        'formatted_result': analysis.getFormattedResult(
+            specs=specs, sciformat=int(scinot)),
+    }
+    uids[uid] = (keyword, key)
+
+
+def unindex_analysis_result(analysis, batch=None):
+    """Removes the result of the analysis from the history of the Batch
+    """
+    batch = batch or _batch_of(analysis)
+    if not batch:
+        return
+    history, uids = _history(batch, create=False)
+    if history is None:
+        return
+    entry = uids.get(analysis.UID(), None)
+    if entry is None:
+        return
+    keyword, key = entry
+    del uids[analysis.UID()]
+    results = history.get(keyword, None)
+    if results is not None and key in results:
+        del results[key]
+
+
+def index_request_results(ar, batch):
+    """Adds the results of the AR to the history of the batch, if the
+    batch has one already
+    """
+    if not batch or _history(batch, create=False)[0] is None:
+        return
+    for analysis in ar.getAnalyses(full_objects=True,
+                                   review_state=HISTORY_STATES):
+        index_analysis_result(analysis, batch)
+
+
+def unindex_request_results(ar, batch):
+    """Removes the results of the AR from the history of the batch
+    """
+    if not batch or _history(batch, create=False)[0] is None:
+        return
+    for analysis in ar.objectValues('Analysis'):
+        unindex_analysis_result(analysis, batch)
+
+
+def get_batch_request_uids(batch):
+    """Returns the UIDs of the ARs of the batch
+    """
+    bc = getToolByName(batch, 'bika_catalog')
+    return set([b.UID for b in bc(portal_type='AnalysisRequest',
+                                  BatchUID=batch.UID())])
+
+
+def rebuild_results_history(batch):
+    """Indexes the results of all the ARs of the batch
+    """
+    history, uids = _history(batch, create=False)
+    history.clear()
+    uids.clear()
+    for ar in batch.getAnalysisRequests():
+        for analysis in ar.getAnalyses(full_objects=True,
+                                       review_state=HISTORY_STATES):
+            index_analysis_result(analysis, batch)
+
+
+def get_previous_results(batch, keyword, exclude_request_uid=None,
+                         request_uids=None):
+    """Returns the results of the service with the keyword passed in, in
+    the ARs of the batch (but the AR with exclude_request_uid), sorted by
+    capture date.  Each result is a dict with the UID, keyword, request_uid,
+    request_id, capture_date, result and formatted_result keys.
+    request_uids are the UIDs of the ARs of the batch, as returned by
+    get_batch_request_uids, looked up if not passed in.
+    """
+    history, uids = _history(batch)
+    results = history.get(keyword, None)
+    if not results:
+        return []
+    if request_uids is None:
+        request_uids = get_batch_request_uids(batch)
+    return [dict(entry) for entry in results.values()
+            if entry['request_uid'] != exclude_request_uid
+            and entry['request_uid'] in request_uids]
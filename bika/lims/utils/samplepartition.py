@@ -19,15 +19,29 @@ def compare_containers(a, b):
     )
 
 
-def set_container_preservation(context, container, data):
+def get_containers(context, uids, lookups=None):
+    """Returns the containers with the given UIDs.  lookups is a dictionary
+    shared by the partitions created together, where the containers found
+    are kept.
+    """
+    containers = lookups.setdefault('containers', {}) \
+        if lookups is not None else {}
+    missing = [uid for uid in uids if uid not in containers]
+    if missing:
+        for proxy in context.bika_setup_catalog(UID=missing):
+            containers[proxy.UID] = proxy.getObject()
+    return [containers[uid] for uid in uids if uid in containers]
+
+
+def set_container_preservation(context, container, data, lookups=None):
     # If container is pre-preserved, set the partition's preservation,
     # and flag the partition to be transitioned below.
     if container:
         if type(container) in (list, tuple):
             container = container[0]
-        proxies = context.bika_setup_catalog(UID=container)
-        container = [_p.getObject() for _p in proxies]
-        container = container[0] if container else None
+        if not hasattr(container, 'getPrePreserved'):
+            container = get_containers(context, [container], lookups)
+            container = container[0] if container else None
         if container:
             prepreserved = container.getPrePreserved()
             preservation = container.getPreservation()
@@ -37,7 +51,7 @@ def set_container_preservation(context, container, data):
     return data.get('preservation_uid', '')
 
 
-def create_samplepartition(context, data, analyses=[]):
+def create_samplepartition(context, data, analyses=[], lookups=None):
     """
     This function creates a partition object.
     :returns: a whole partition object
@@ -45,6 +59,8 @@ def create_samplepartition(context, data, analyses=[]):
     where the most important keys are: part_id and services
     {'part_id':xx, 'container_uid', xxxx, 'services': xxxx, 'part_id':xxx, ...}
     :analyses: A list of full object analyses
+    :lookups: A dictionary shared by the partitions created together, where
+    the containers are kept once found
     """
     partition = _createObjectByType('SamplePartition', context, data['part_id'])
     partition.unmarkCreationFlag()
@@ -56,8 +72,7 @@ def create_samplepartition(context, data, analyses=[]):
         containers = []
         if type(container[0]) is str:
             # UIDs
-            containers = context.bika_setup_catalog(UID=container)
-            containers = [_p.getObject() for _p in containers]
+            containers = get_containers(context, container, lookups)
         elif hasattr(container[0], 'getObject'):
             # Brains
             containers = [_p.getObject() for _p in container]
@@ -69,7 +84,8 @@ def create_samplepartition(context, data, analyses=[]):
             except: pass
             container = containers[0]
     # Set the container and preservation
-    preservation = set_container_preservation(context, container, data)
+    preservation = set_container_preservation(
+        context, container, data, lookups)
     # Add analyses
     partition_services = data['services']
     analyses = [a for a in analyses if a.getServiceUID() in partition_services]
@@ -0,0 +1,95 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+""" Keyword lookup table of the Analysis Services.
+
+Results importers, calculations and the AR add form translate service
+keywords into services (and back) all the time.  The table below maps the
+keyword and the UID of every Analysis Service to its metadata in
+bika_setup_catalog.  It is built once per Zope client, and built again
+when the change counter of the catalog or the services counter (bumped by
+invalidate_service_keywords when a service is modified, and stored in the
+ZODB, so all the clients see it) change.
+"""
+
+from Acquisition import aq_base
+from Products.CMFCore.utils import getToolByName
+from zope.annotation.interfaces import IAnnotations
+
+SERVICES_COUNTER_KEY = 'bika.lims.services.counter'
+
+# Metadata columns kept for each service, if available in the catalog
+SERVICE_COLUMNS = (
+    'UID',
+    'Title',
+    'getKeyword',
+    'getCategoryUID',
+    'getCategoryTitle',
+    'getPointOfCapture',
+    'review_state',
+    'inactive_state',
+)
+
+# catalog path -> ServiceKeywords
+_tables = {}
+
+
+class ServiceKeywords(object):
+    """Metadata of the Analysis Services, by keyword and by UID
+    """
+
+    def __init__(self, catalog, counter=None):
+        self.counter = counter
+        self.by_keyword = {}
+        self.by_uid = {}
+        columns = [c for c in SERVICE_COLUMNS if c in catalog.schema()]
+        for brain in catalog(portal_type='AnalysisService'):
+            data = dict([(c, getattr(brain, c, None)) for c in columns])
+            self.by_keyword[brain.getKeyword] = data
+            self.by_uid[brain.UID] = data
+
+    def get(self, keyword, default=None):
+        return self.by_keyword.get(keyword, default)
+
+    def uid(self, keyword, default=None):
+        data = self.by_keyword.get(keyword, None)
+        return data['UID'] if data else default
+
+    def keyword(self, uid, default=None):
+        data = self.by_uid.get(uid, None)
+        return data['getKeyword'] if data else default
+
+    def __contains__(self, keyword):
+        return keyword in self.by_keyword
+
+
+def _services_counter(context):
+    portal = getToolByName(context, 'portal_url').getPortalObject()
+    return IAnnotations(portal).get(SERVICES_COUNTER_KEY, 0)
+
+
+def get_service_keywords(context):
+    """Returns the ServiceKeywords table of the site, built again if the
+    services changed since it was built
+    """
+    bsc = getToolByName(context, 'bika_setup_catalog')
+    getCounter = getattr(aq_base(bsc), 'getCounter', None)
+    counter = (getCounter and bsc.getCounter(), _services_counter(context))
+    key = '/'.join(bsc.getPhysicalPath())
+    table = _tables.get(key, None)
+    if table is None or table.counter != counter:
+        table = ServiceKeywords(bsc, counter)
+        _tables[key] = table
+    return table
+
+
+def invalidate_service_keywords(context):
+    """Forces all the Zope clients to build the table again.  Must be called
+    whenever an Analysis Service is added, modified or removed.
+    """
+    portal = getToolByName(context, 'portal_url').getPortalObject()
+    annotations = IAnnotations(portal)
+    annotations[SERVICES_COUNTER_KEY] = \
+        annotations.get(SERVICES_COUNTER_KEY, 0) + 1
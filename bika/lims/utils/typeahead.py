@@ -0,0 +1,241 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+""" In-memory n-gram indexes for the type-ahead search of reference widgets.
+
+Reference widgets search the titles (or other fields) of the objects of a
+few portal types on every keystroke.  Instead of filtering all the brains
+of the base query in Python, each (catalog, portal types, fields) triplet
+gets an index that maps every n-gram (up to GRAM_SIZE characters) of the
+lowercase values to the UIDs of the objects.  A lookup intersects the UID
+sets of the n-grams of the search term, so only the objects that contain
+all of them are checked.  The catalog then restricts the candidates to the
+base query through the UID index.
+
+Indexes are shared by all the users of the Zope client, so they are built
+with an unrestricted search, from the catalog metadata alone: only fields
+that are metadata columns of the catalog can be searched through an index.
+Each search goes through the catalog with the query of the widget, so the
+users only get the objects they are allowed to see.
+
+Indexes are built on first use, updated when an object of their portal
+types is modified (see ObjectModifiedEventHandler), and built again in the
+background after MAX_AGE seconds, from a separate ZODB connection, so the
+changes done by other Zope clients are picked up too.  Objects removed are
+left in the index: the catalog query discards them.
+"""
+
+from bika.lims import logger
+from bika.lims.utils import to_utf8
+from time import time
+import threading
+import transaction
+
+GRAM_SIZE = 3
+# Seconds after which an index is built again from the catalog
+MAX_AGE = 600
+# Maximum number of objects returned by a type-ahead search
+SEARCH_LIMIT = 100
+
+# (catalog path, portal types, fields) -> TypeAheadIndex
+_indexes = {}
+_lock = threading.Lock()
+
+
+def _grams(value, size=GRAM_SIZE):
+    """Returns the set of substrings of value up to size characters long
+    """
+    grams = set()
+    for n in range(1, size + 1):
+        for i in range(len(value) - n + 1):
+            grams.add(value[i:i + n])
+    return grams
+
+
+class TypeAheadIndex(object):
+    """N-gram index of the lowercase values of some fields, by UID
+    """
+
+    def __init__(self, size=GRAM_SIZE):
+        self.size = size
+        self.values = {}
+        self.grams = {}
+        self.created = time()
+        self.rebuilding = False
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.values)
+
+    def index(self, uid, values):
+        """Indexes the values (strings) of the object with the UID passed in,
+        replacing the values indexed before
+        """
+        values = tuple([to_utf8(v).lower() for v in values if v])
+        with self.lock:
+            self._unindex(uid)
+            self.values[uid] = values
+            for value in values:
+                for gram in _grams(value, self.size):
+                    self.grams.setdefault(gram, set()).add(uid)
+
+    def unindex(self, uid):
+        with self.lock:
+            self._unindex(uid)
+
+    def _unindex(self, uid):
+        for value in self.values.pop(uid, ()):
+            for gram in _grams(value, self.size):
+                uids = self.grams.get(gram, None)
+                if uids is not None:
+                    uids.discard(uid)
+                    if not uids:
+                        del self.grams[gram]
+
+    def rank(self, uid, term):
+        """0 if a value starts with term, 1 if a word of a value starts with
+        term, 2 otherwise
+        """
+        values = self.values.get(uid, ())
+        if [v for v in values if v.startswith(term)]:
+            return 0
+        if [v for v in values if (' ' + term) in v]:
+            return 1
+        return 2
+
+    def search(self, term):
+        """Returns the set of UIDs with a value that contains term
+        """
+        term = to_utf8(term).lower()
+        with self.lock:
+            if len(term) <= self.size:
+                return set(self.grams.get(term, ()))
+            sets = [self.grams.get(term[i:i + self.size], ())
+                    for i in range(len(term) - self.size + 1)]
+            sets.sort(key=len)
+            uids = set(sets[0])
+            for other in sets[1:]:
+                if not uids:
+                    break
+                uids.intersection_update(other)
+            return set([uid for uid in uids
+                        if [v for v in self.values[uid] if term in v]])
+
+
+def _field_values(obj, fields):
+    values = []
+    schema = obj.Schema()
+    for fieldname in fields:
+        value = getattr(obj, fieldname, None)
+        if not value and fieldname in schema:
+            value = schema[fieldname].get(obj)
+        if callable(value):
+            value = value()
+        if isinstance(value, basestring):
+            values.append(value)
+    return values
+
+
+def _build(catalog, portal_types, fields):
+    """Builds the index of the fields of all the objects of the portal
+    types, whoever can see them.  The fields must be metadata columns.
+    """
+    index = TypeAheadIndex()
+    brains = catalog.unrestrictedSearchResults(portal_type=list(portal_types))
+    for brain in brains:
+        values = [getattr(brain, f, None) for f in fields]
+        index.index(brain.UID,
+                    [v for v in values if isinstance(v, basestring)])
+    return index
+
+
+def _rebuild(db, key):
+    """Builds the index again from a separate connection, and replaces the
+    one in use
+    """
+    tm = transaction.TransactionManager()
+    connection = db.open(transaction_manager=tm)
+    try:
+        app = connection.root()['Application']
+        catalog = app.unrestrictedTraverse(key[0])
+        index = _build(catalog, key[1], key[2])
+        with _lock:
+            _indexes[key] = index
+    except Exception:
+        logger.exception("Type-ahead index %s could not be built" % (key,))
+        with _lock:
+            if key in _indexes:
+                _indexes[key].rebuilding = False
+    finally:
+        tm.abort()
+        connection.close()
+
+
+def get_typeahead_index(catalog, portal_types, fields):
+    """Returns the index of the fields of the objects of the portal types
+    passed in, building it if needed.  An index older than MAX_AGE is
+    returned as is, and built again in the background.
+    """
+    if isinstance(portal_types, basestring):
+        portal_types = [portal_types]
+    key = ('/'.join(catalog.getPhysicalPath()),
+           tuple(sorted(portal_types)), tuple(fields))
+    index = _indexes.get(key, None)
+    if index is None:
+        index = _build(catalog, key[1], key[2])
+        with _lock:
+            _indexes[key] = index
+        return index
+    with _lock:
+        stale = index.created < time() - MAX_AGE and not index.rebuilding
+        if stale:
+            index.rebuilding = True
+    if stale:
+        thread = threading.Thread(target=_rebuild,
+                                  args=(catalog._p_jar.db(), key))
+        thread.setDaemon(True)
+        thread.start()
+    return index
+
+
+def update_typeahead_indexes(obj):
+    """Indexes again the object passed in, in the indexes of its portal type
+    """
+    portal_type = getattr(obj, 'portal_type', None)
+    if not portal_type or not hasattr(obj, 'Schema'):
+        return
+    with _lock:
+        items = [(k, i) for k, i in _indexes.items() if portal_type in k[1]]
+    for key, index in items:
+        index.index(obj.UID(), _field_values(obj, key[2]))
+
+
+def typeahead_search(catalog, query, term, fields=('Title',),
+                     limit=SEARCH_LIMIT):
+    """Searches the catalog with query for the objects with a value in
+    fields that contains term.  Objects with a value that starts with term
+    come first.  Returns at most limit brains, or None if the query doesn't
+    restrict portal_type, or a field is not a metadata column, and the
+    index cannot be used.
+    """
+    portal_types = query.get('portal_type', None)
+    if isinstance(portal_types, dict):
+        portal_types = portal_types.get('query', None)
+    if not portal_types:
+        return None
+    fields = fields or ('Title',)
+    columns = catalog.schema()
+    if [f for f in fields if f not in columns]:
+        return None
+    index = get_typeahead_index(catalog, portal_types, fields)
+    uids = index.search(term)
+    if not uids:
+        return []
+    query = dict(query)
+    query['UID'] = list(uids)
+    term = to_utf8(term).lower()
+    brains = [(index.rank(b.UID, term), b) for b in catalog(query)]
+    brains.sort(key=lambda item: item[0])
+    return [brain for rank, brain in brains[:limit]]
@@ -0,0 +1,158 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+""" Cache of the historical versions of objects.
+
+HistoryAwareReferenceField pins its references to the version of the target
+when the reference was set (e.g. the version of the Analysis Service of an
+analysis), and retrieves that version from portal_repository when the
+target has been modified since.  Retrieving a version unpickles a copy of
+the object from the versions storage, and getService() or getCalculation()
+are called many times per analysis.
+
+A version never changes once it is saved, so the retrieved copies are kept
+in a LRU cache, and never invalidated.  A retrieved copy and its persistent
+subobjects (workflow history, annotations, contents) may be bound to the
+ZODB connection they were loaded from, so there is a cache per connection:
+a connection is only used by one thread at a time, and the copies are
+dropped along with the connection.  The copies are stored without
+acquisition, and wrapped again in the parent of the current object on
+every lookup.
+
+The stats of all the caches are summed up by snapshot_cache_stats(), and
+shown to the managers by the @@snapshot_cache_stats view of the site.
+"""
+
+from Acquisition import aq_base
+from Acquisition import aq_inner
+from Acquisition import aq_parent
+from collections import OrderedDict
+from Products.CMFEditions.ArchivistTool import ArchivistRetrieveError
+import threading
+import weakref
+
+# Maximum number of versions kept in the cache of each ZODB connection
+SNAPSHOT_CACHE_SIZE = 200
+
+_marker = object()
+
+
+class LRUCache(object):
+    """Thread-safe dict with at most maxsize items, that discards the least
+    recently used item first, and counts the hits and the misses
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.items.pop(key, _marker)
+            if value is _marker:
+                self.misses += 1
+                return default
+            # most recently used last
+            self.items[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.items.pop(key, default)
+
+    def keys(self):
+        with self.lock:
+            return self.items.keys()
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Returns the size of the cache, the number of hits and misses,
+        and the hit rate (0 to 1)
+        """
+        lookups = self.hits + self.misses
+        return {'size': len(self.items),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+
+# ZODB connection -> LRUCache of the versions retrieved through it
+snapshot_caches = weakref.WeakKeyDictionary()
+_caches_lock = threading.Lock()
+
+
+def get_snapshot_cache(jar):
+    """Returns the cache of the versions retrieved through the ZODB
+    connection jar
+    """
+    with _caches_lock:
+        cache = snapshot_caches.get(jar, None)
+        if cache is None:
+            cache = snapshot_caches[jar] = LRUCache(SNAPSHOT_CACHE_SIZE)
+        return cache
+
+
+def snapshot_cache_stats():
+    """Returns the stats of the version caches of all the ZODB connections,
+    summed up: the number of caches, their size, the number of hits and
+    misses, and the hit rate (0 to 1)
+    """
+    with _caches_lock:
+        caches = list(snapshot_caches.values())
+    stats = {'caches': len(caches),
+             'size': 0,
+             'maxsize': 0,
+             'hits': 0,
+             'misses': 0}
+    for cache in caches:
+        cache_stats = cache.stats()
+        for key in ('size', 'maxsize', 'hits', 'misses'):
+            stats[key] += cache_stats[key]
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = float(stats['hits']) / lookups if lookups else 0.0
+    return stats
+
+
+def get_version_snapshot(repository, obj, version_id):
+    """Returns the version version_id of obj, retrieved from the repository
+    (portal_repository) or from the cache of the connection of obj.
+    Returns obj if the version cannot be retrieved.
+    """
+    jar = getattr(aq_base(obj), '_p_jar', None)
+    cache = get_snapshot_cache(jar) if jar is not None else None
+    key = (obj.UID(), version_id)
+    snapshot = cache.get(key) if cache is not None else None
+    if snapshot is None:
+        try:
+            snapshot = repository._retrieve(obj,
+                                            selector=version_id,
+                                            preserve=(),
+                                            countPurged=True).object
+        except ArchivistRetrieveError:
+            return obj
+        snapshot = aq_base(snapshot)
+        if cache is not None:
+            cache.set(key, snapshot)
+    return snapshot.__of__(aq_parent(aq_inner(obj)))
@@ -0,0 +1,106 @@
+# This file is part of Bika LIMS
+#
+# Copyright 2011-2016 by it's authors.
+# Some rights reserved. See LICENSE.txt, AUTHORS.txt.
+
+""" Index of the slots of a worksheet layout.
+
+The Layout of a Worksheet is a list of slots, one per analysis, like
+{'position': 1, 'type': 'a', 'container_uid': <AR UID>,
+'analysis_uid': <Analysis UID>}.  Finding the slot of an analysis, the
+position of an AR or the first free position used to scan the whole list
+on every analysis added.  WorksheetLayout indexes the slots by position,
+container UID and analysis UID, so these lookups (and adding a slot) take
+constant time, and the worksheet writes the list back once per batch.
+"""
+
+
+class WorksheetLayout(object):
+    """The slots of a worksheet layout, by position, container UID and
+    analysis UID
+    """
+
+    def __init__(self, layout=None):
+        self.slots = []
+        self.by_analysis = {}
+        self.by_container = {}
+        self.by_position = {}
+        self._free = 1
+        for slot in layout or []:
+            self._index(slot)
+
+    def _index(self, slot):
+        self.slots.append(slot)
+        self.by_analysis[slot['analysis_uid']] = slot
+        self.by_container.setdefault(slot['container_uid'], []).append(slot)
+        self.by_position.setdefault(int(slot['position']), []).append(slot)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, analysis_uid):
+        return analysis_uid in self.by_analysis
+
+    def get(self, analysis_uid, default=None):
+        """Returns the slot of the analysis with the UID passed in
+        """
+        return self.by_analysis.get(analysis_uid, default)
+
+    def slots_at(self, position):
+        """Returns the slots at position
+        """
+        return list(self.by_position.get(int(position), []))
+
+    def container_position(self, container_uid, default=None):
+        """Returns the position of the first slot of the container (AR,
+        Reference Sample...) with the UID passed in
+        """
+        slots = self.by_container.get(container_uid, None)
+        return int(slots[0]['position']) if slots else default
+
+    def free_position(self):
+        """Returns the lowest position without slots
+        """
+        while self._free in self.by_position:
+            self._free += 1
+        return self._free
+
+    def highest_position(self, minimum=0):
+        """Returns the highest position with slots, or minimum if higher
+        """
+        return max([minimum] + self.by_position.keys())
+
+    def add(self, position, slot_type, container_uid, analysis_uid):
+        """Adds a slot and returns it
+        """
+        slot = {'position': position,
+                'type': slot_type,
+                'container_uid': container_uid,
+                'analysis_uid': analysis_uid}
+        self._index(slot)
+        return slot
+
+    def remove(self, analysis_uid):
+        """Removes the slots of the analysis with the UID passed in
+        """
+        slot = self.by_analysis.pop(analysis_uid, None)
+        if slot is None:
+            return
+        self.slots = [s for s in self.slots
+                      if s['analysis_uid'] != analysis_uid]
+        for key, mapping in ((slot['container_uid'], self.by_container),
+                             (int(slot['position']), self.by_position)):
+            slots = [s for s in mapping[key]
+                     if s['analysis_uid'] != analysis_uid]
+            if slots:
+                mapping[key] = slots
+            else:
+                del mapping[key]
+        if int(slot['position']) not in self.by_position:
+            self._free = min(self._free, int(slot['position']))
+
+    def layout(self):
+        """Returns a copy of the list of slots, to be stored in the Layout
+        field
+        """
+        return list(self.slots)